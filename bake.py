@@ -0,0 +1,123 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bakes the template NeRF of a trained model into a sparse voxel grid."""
+
+from absl import app
+from absl import flags
+from absl import logging
+from flax import optim
+import gin
+import jax
+from jax import random
+import tensorflow as tf
+
+from nerfies import baking
+from nerfies import configs
+from nerfies import datasets
+from nerfies import gpath
+from nerfies import model_utils
+from nerfies import models
+
+flags.DEFINE_string('base_folder', None, 'where to store ckpts and logs')
+flags.mark_flag_as_required('base_folder')
+flags.DEFINE_string('data_dir', None, 'input data directory.')
+flags.DEFINE_multi_string('gin_bindings', None, 'Gin parameter bindings.')
+flags.DEFINE_multi_string('gin_configs', (), 'Gin config files.')
+FLAGS = flags.FLAGS
+
+jax.config.parse_flags_with_absl()
+
+
+def main(argv):
+  tf.config.experimental.set_visible_devices([], 'GPU')
+  del argv
+  logging.info('*** Loading Gin configs from: %s', str(FLAGS.gin_configs))
+  gin.parse_config_files_and_bindings(
+      config_files=FLAGS.gin_configs,
+      bindings=FLAGS.gin_bindings,
+      skip_unknown=True)
+
+  exp_config = configs.ExperimentConfig()
+  model_config = configs.ModelConfig(use_stratified_sampling=False)
+  bake_config = configs.BakeConfig()
+
+  exp_dir = gpath.GPath(FLAGS.base_folder)
+  if exp_config.subname:
+    exp_dir = exp_dir / exp_config.subname
+  checkpoint_dir = exp_dir / 'checkpoints'
+  bake_dir = exp_dir / 'baked'
+  bake_dir.mkdir(parents=True, exist_ok=True)
+
+  datasource_spec = exp_config.datasource_spec
+  if datasource_spec is None:
+    datasource_spec = {
+        'type': exp_config.datasource_type,
+        'data_dir': FLAGS.data_dir,
+    }
+  datasource = datasets.from_config(
+      datasource_spec,
+      image_scale=exp_config.image_scale,
+      use_appearance_id=model_config.use_appearance_metadata,
+      use_camera_id=model_config.use_camera_metadata,
+      use_warp_id=model_config.use_warp,
+      use_time=model_config.warp_metadata_encoder_type == 'time',
+      random_seed=exp_config.random_seed,
+      **exp_config.datasource_kwargs)
+
+  params = {}
+  model, params['model'] = models.construct_nerf(
+      random.PRNGKey(exp_config.random_seed),
+      model_config,
+      batch_size=1,
+      appearance_ids=datasource.appearance_ids,
+      camera_ids=datasource.camera_ids,
+      warp_ids=datasource.warp_ids,
+      near=datasource.near,
+      far=datasource.far)
+  optimizer = optim.Adam(0.0).create(params)
+  state = model_utils.TrainState(optimizer=optimizer)
+  state = model_utils.restore_checkpoint(checkpoint_dir, state)
+  step = int(state.optimizer.state.step)
+  model_params = state.optimizer.target['model']
+
+  density_fn = jax.jit(
+      lambda points: model.apply(
+          {'params': model_params}, points,
+          method=models.NerfModel.query_template_density))
+  template_fn = jax.jit(
+      lambda points: model.apply(
+          {'params': model_params}, points,
+          method=models.NerfModel.query_template))
+
+  logging.info('Baking step %d at resolution %d.', step,
+               bake_config.resolution)
+  grid = baking.bake(
+      density_fn,
+      template_fn,
+      resolution=bake_config.resolution,
+      bound=model.occupancy_bound,
+      density_threshold=bake_config.density_threshold,
+      brick_size=bake_config.brick_size,
+      chunk=bake_config.chunk)
+  logging.info('Baked %d of %d bricks (%d vertices).', grid.num_bricks,
+               grid.brick_index.size, grid.num_vertices)
+
+  save_path = bake_dir / f'{step:08d}.npz'
+  baking.save_grid(save_path, grid)
+  logging.info('Saved baked grid to %s', save_path)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -14,7 +14,12 @@
 
 """Evaluation script for Nerf."""
 import collections
+import ctypes
+import ctypes.util
 import functools
+import json
+import os
+import select
 import time
 from typing import Any, Dict, Optional, Sequence
 
@@ -31,6 +36,8 @@ import gin
 import jax
 from jax import numpy as jnp
 from jax import random
+from jax.experimental import multihost_utils
+import numpy as np
 import tensorflow as tf
 
 from nerfies import configs
@@ -40,6 +47,8 @@ from nerfies import gpath
 from nerfies import image_utils
 from nerfies import model_utils
 from nerfies import models
+from nerfies import occupancy
+from nerfies import training
 from nerfies import types
 from nerfies import utils
 from nerfies import visualization as viz
@@ -65,9 +74,22 @@ def compute_multiscale_ssim(image1: jnp.ndarray, image2: jnp.ndarray):
     return tf.image.ssim_multiscale(image1, image2, max_val=1.0)
 
 
+def compute_metrics(batch: Dict[str, jnp.ndarray], render: Dict[str, jnp.ndarray]):
+    """Computes the metrics of a rendered image against the targets."""
+    out = {}
+    if "rgb" in batch:
+        mse = ((render["rgb"] - batch["rgb"]) ** 2).mean()
+        out["mse"] = mse
+        out["psnr"] = utils.compute_psnr(mse)
+        out["ssim"] = compute_multiscale_ssim(batch["rgb"], render["rgb"])
+    if "depth" in batch:
+        out["depth_abs"] = jnp.nanmean(jnp.abs(batch["depth"] - render["med_depth"]))
+    return out
+
+
 def process_batch(
     *,
-    batch: Dict[str, jnp.ndarray],
+    batch: Optional[Dict[str, jnp.ndarray]],
     rng: types.PRNGKey,
     state: model_utils.TrainState,
     tag: str,
@@ -77,11 +99,20 @@ def process_batch(
     render_fn: Any,
     save_dir: Optional[gpath.GPath],
     datasource: datasets.DataSource,
+    render: Optional[Dict[str, jnp.ndarray]] = None,
+    with_targets: bool = True,
 ):
-    """Process and plot a single batch."""
+    """Process and plot a single batch.
+
+    If `render` is given it is used instead of rendering the batch. The
+    metrics are computed on every host but only host 0 writes outputs. If
+    `with_targets` is False only the render is written and `batch` is unused;
+    this is used for renders of other hosts which computed their metrics.
+    """
     item_id = item_id.replace("/", "_")
-    render = render_fn(state, batch, rng=rng)
-    out = {}
+    if render is None:
+        render = render_fn(state, batch, rng=rng)
+    out = compute_metrics(batch, render) if with_targets else {}
     if jax.process_index() != 0:
         return out
 
@@ -120,16 +151,17 @@ def process_batch(
     summary_writer.image(f"disparity-expected/{tag}/{item_id}", disp_exp_viz, step)
     summary_writer.image(f"disparity-median/{tag}/{item_id}", disp_med_viz, step)
     summary_writer.image(f"acc/{tag}/{item_id}", acc_viz, step)
+    if not with_targets:
+        return out
 
     if "rgb" in batch:
         rgb_target = batch["rgb"]
-        mse = ((rgb - batch["rgb"]) ** 2).mean()
-        psnr = utils.compute_psnr(mse)
-        ssim = compute_multiscale_ssim(rgb_target, rgb)
-        out["mse"] = mse
-        out["psnr"] = psnr
-        out["ssim"] = ssim
-        logging.info("\tMetrics: mse=%.04f, psnr=%.02f, ssim=%.02f", mse, psnr, ssim)
+        logging.info(
+            "\tMetrics: mse=%.04f, psnr=%.02f, ssim=%.02f",
+            out["mse"],
+            out["psnr"],
+            out["ssim"],
+        )
 
         rgb_abs_error = viz.colorize(abs(rgb_target - rgb).sum(axis=-1), cmin=0, cmax=1)
         rgb_sq_error = viz.colorize(
@@ -142,7 +174,6 @@ def process_batch(
     if "depth" in batch:
         depth_target = batch["depth"]
         depth_target_viz = colorize_depth(depth_target[..., 0])
-        out["depth_abs"] = jnp.nanmean(jnp.abs(depth_target - depth_med))
         summary_writer.image(f"depth-target/{tag}/{item_id}", depth_target_viz, step)
         depth_med_error = viz.colorize(
             abs(depth_target - depth_med).squeeze(axis=-1), cmin=0, cmax=1
@@ -160,6 +191,38 @@ def process_batch(
     return out
 
 
+def add_test_metadata(batch, step: int, datasource: datasets.DataSource):
+    """Adds random metadata to a batch of test rays."""
+    test_rng = random.PRNGKey(step)
+    shape = batch["origins"][..., :1].shape
+    metadata = {}
+    if datasource.use_appearance_id:
+        appearance_id = random.choice(
+            test_rng, jnp.asarray(datasource.appearance_ids)
+        )
+        logging.info("\tUsing appearance_id = %d", appearance_id)
+        metadata["appearance"] = jnp.full(
+            shape, fill_value=appearance_id, dtype=jnp.uint32
+        )
+    if datasource.use_warp_id:
+        warp_id = random.choice(test_rng, jnp.asarray(datasource.warp_ids))
+        logging.info("\tUsing warp_id = %d", warp_id)
+        metadata["warp"] = jnp.full(shape, fill_value=warp_id, dtype=jnp.uint32)
+    if datasource.use_camera_id:
+        camera_id = random.choice(test_rng, jnp.asarray(datasource.camera_ids))
+        logging.info("\tUsing camera_id = %d", camera_id)
+        metadata["camera"] = jnp.full(
+            shape, fill_value=camera_id, dtype=jnp.uint32
+        )
+    if datasource.use_time:
+        timestamp = random.uniform(test_rng, minval=0.0, maxval=1.0)
+        logging.info("\tUsing time = %d", timestamp)
+        metadata["time"] = jnp.full(
+            shape, fill_value=timestamp, dtype=jnp.uint32
+        )
+    batch["metadata"] = metadata
+
+
 def process_iterator(
     tag: str,
     item_ids: Sequence[str],
@@ -172,40 +235,17 @@ def process_iterator(
     save_dir: Optional[gpath.GPath],
     datasource: datasets.DataSource,
 ):
-    """Process a dataset iterator and compute metrics."""
+    """Process a dataset iterator and compute metrics.
+
+    Returns:
+      A dictionary with the mean of each metric on host 0.
+    """
     save_dir = save_dir / f"{step:08d}" / tag if save_dir else None
     meters = collections.defaultdict(utils.ValueMeter)
     for i, (item_id, batch) in enumerate(zip(item_ids, iterator)):
         logging.info("[%s:%d/%d] Processing %s ", tag, i + 1, len(item_ids), item_id)
         if tag == "test":
-            test_rng = random.PRNGKey(step)
-            shape = batch["origins"][..., :1].shape
-            metadata = {}
-            if datasource.use_appearance_id:
-                appearance_id = random.choice(
-                    test_rng, jnp.asarray(datasource.appearance_ids)
-                )
-                logging.info("\tUsing appearance_id = %d", appearance_id)
-                metadata["appearance"] = jnp.full(
-                    shape, fill_value=appearance_id, dtype=jnp.uint32
-                )
-            if datasource.use_warp_id:
-                warp_id = random.choice(test_rng, jnp.asarray(datasource.warp_ids))
-                logging.info("\tUsing warp_id = %d", warp_id)
-                metadata["warp"] = jnp.full(shape, fill_value=warp_id, dtype=jnp.uint32)
-            if datasource.use_camera_id:
-                camera_id = random.choice(test_rng, jnp.asarray(datasource.camera_ids))
-                logging.info("\tUsing camera_id = %d", camera_id)
-                metadata["camera"] = jnp.full(
-                    shape, fill_value=camera_id, dtype=jnp.uint32
-                )
-            if datasource.use_time:
-                timestamp = random.uniform(test_rng, minval=0.0, maxval=1.0)
-                logging.info("\tUsing time = %d", timestamp)
-                metadata["time"] = jnp.full(
-                    shape, fill_value=timestamp, dtype=jnp.uint32
-                )
-            batch["metadata"] = metadata
+            add_test_metadata(batch, step, datasource)
 
         stats = process_batch(
             batch=batch,
@@ -223,14 +263,265 @@ def process_iterator(
             for k, v in stats.items():
                 meters[k].update(v)
 
+    metrics = {}
     if jax.process_index() == 0:
         for meter_name, meter in meters.items():
+            metrics[meter_name] = float(meter.reduce("mean"))
             summary_writer.scalar(
                 tag=f"metrics-eval/{meter_name}/{tag}",
-                value=meter.reduce("mean"),
+                value=metrics[meter_name],
+                step=step,
+            )
+    return metrics
+
+
+METRIC_NAMES = ("mse", "psnr", "ssim", "depth_abs")
+# The render outputs which are sent to host 0 and their number of channels.
+GATHERED_RENDER_KEYS = (("rgb", 3), ("acc", 1), ("depth", 1), ("med_depth", 1))
+
+
+def pack_render(render):
+    """Packs the gathered outputs of a render into one (H, W, C) array."""
+    return np.concatenate(
+        [
+            np.asarray(render[key], np.float32).reshape(
+                (*render["rgb"].shape[:2], channels)
+            )
+            for key, channels in GATHERED_RENDER_KEYS
+        ],
+        axis=-1,
+    )
+
+
+def unpack_render(packed):
+    """Inverse of `pack_render`."""
+    render = {}
+    start = 0
+    for key, channels in GATHERED_RENDER_KEYS:
+        value = packed[..., start : start + channels]
+        render[key] = value if channels > 1 else value[..., 0]
+        start += channels
+    return render
+
+
+def process_iterator_parallel(
+    tag: str,
+    item_ids: Sequence[str],
+    iterator,
+    rng: types.PRNGKey,
+    state: model_utils.TrainState,
+    step: int,
+    render_fn: Any,
+    summary_writer: tensorboard.SummaryWriter,
+    save_dir: Optional[gpath.GPath],
+    datasource: datasets.DataSource,
+    num_devices: int,
+):
+    """Process a dataset iterator rendering whole images per device.
+
+    The images are assigned to hosts round-robin and rendered in groups of one
+    image per local device with `evaluation.render_images`. The metrics are
+    reduced across hosts once at the end. Only host 0 writes outputs, so with
+    multiple hosts the renders of the other hosts are gathered to host 0 at
+    the end (see `GATHERED_RENDER_KEYS`).
+
+    Returns:
+      A dictionary with the mean of each metric on host 0.
+    """
+    save_dir = save_dir / f"{step:08d}" / tag if save_dir else None
+    host_id = jax.process_index()
+    host_count = jax.process_count()
+    metric_sums = np.zeros(len(METRIC_NAMES), np.float64)
+    metric_counts = np.zeros(len(METRIC_NAMES), np.float64)
+    # The image shape of every item, which is known to all hosts.
+    image_shapes = []
+    # The packed renders of this host which are sent to host 0 (hosts != 0).
+    local_renders = {}
+
+    def _process_group(group):
+        renders = render_fn(state, [batch for _, _, batch in group], rng=rng)
+        for (i, item_id, batch), render in zip(group, renders):
+            if host_id != 0:
+                local_renders[i] = pack_render(render)
+            stats = process_batch(
+                batch=batch,
+                rng=rng,
+                state=state,
+                tag=tag,
+                item_id=item_id,
+                step=step,
+                render_fn=render_fn,
+                summary_writer=summary_writer,
+                save_dir=save_dir,
+                datasource=datasource,
+                render=render,
+            )
+            for j, name in enumerate(METRIC_NAMES):
+                if name in stats:
+                    metric_sums[j] += float(stats[name])
+                    metric_counts[j] += 1
+
+    group = []
+    for i, (item_id, batch) in enumerate(zip(item_ids, iterator)):
+        if isinstance(batch, RemoteItem):
+            image_shapes.append(batch.image_shape)
+        else:
+            image_shapes.append(tuple(batch["origins"].shape[:2]))
+        if i % host_count != host_id:
+            continue
+        logging.info("[%s:%d/%d] Processing %s ", tag, i + 1, len(item_ids), item_id)
+        if tag == "test":
+            add_test_metadata(batch, step, datasource)
+        group.append((i, item_id, batch))
+        if len(group) == num_devices:
+            _process_group(group)
+            group = []
+    if group:
+        _process_group(group)
+
+    # Send the renders of the other hosts to host 0, which only writes them.
+    # The metrics of these images were already computed by their hosts.
+    num_channels = sum(channels for _, channels in GATHERED_RENDER_KEYS)
+    for i, (height, width) in enumerate(image_shapes):
+        owner = i % host_count
+        if owner == 0:
+            continue
+        packed = local_renders.pop(
+            i, np.zeros((height, width, num_channels), np.float32)
+        )
+        packed = multihost_utils.process_allgather(packed)[owner]
+        if host_id == 0:
+            process_batch(
+                batch=None,
+                rng=rng,
+                state=state,
+                tag=tag,
+                item_id=item_ids[i],
                 step=step,
+                render_fn=render_fn,
+                summary_writer=summary_writer,
+                save_dir=save_dir,
+                datasource=datasource,
+                render=unpack_render(packed),
+                with_targets=False,
             )
 
+    # Reduce the metrics of all hosts with a single collective.
+    metrics = np.stack([metric_sums, metric_counts])
+    if host_count > 1:
+        metrics = multihost_utils.process_allgather(metrics).sum(axis=0)
+    means = {}
+    if host_id == 0:
+        for name, total, count in zip(METRIC_NAMES, *metrics):
+            if count > 0:
+                means[name] = float(total / count)
+                summary_writer.scalar(
+                    tag=f"metrics-eval/{name}/{tag}", value=means[name], step=step
+                )
+    return means
+
+
+# An item rendered by another host of which only the image shape is kept.
+RemoteItem = collections.namedtuple("RemoteItem", ["image_shape"])
+
+
+def load_items(item_ids: Sequence[str], iterator, is_local=None):
+    """Loads the batches of the items to evaluate into host memory once.
+
+    Items for which `is_local(index)` is False are replaced by a `RemoteItem`.
+    """
+    items = []
+    for i, (_, batch) in enumerate(zip(item_ids, iterator)):
+        if is_local is None or is_local(i):
+            items.append(jax.device_get(batch))
+        else:
+            items.append(RemoteItem(tuple(batch["origins"].shape[:2])))
+    return items
+
+
+def load_eval_index(path: gpath.GPath):
+    """Loads the metrics of the checkpoints which were already evaluated."""
+    if not path.exists():
+        return {}
+    with path.open("r") as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+def save_eval_index(path: gpath.GPath, index):
+    """Atomically writes the per-checkpoint metrics index."""
+    tmp_path = path.parent / f"{path.name}.tmp"
+    with tmp_path.open("w") as f:
+        json.dump({str(k): v for k, v in sorted(index.items())}, f)
+    tf.io.gfile.rename(str(tmp_path), str(path), overwrite=True)
+
+
+def latest_checkpoint_step(checkpoint_dir: gpath.GPath) -> Optional[int]:
+    """Returns the step of the latest checkpoint without restoring it."""
+    if not checkpoint_dir.exists():
+        return None
+    step = training.read_checkpoint_marker(checkpoint_dir)
+    if step is not None:
+        return step
+    # Checkpoints written before the completion marker existed.
+    path = checkpoints.latest_checkpoint(str(checkpoint_dir))
+    if path is None:
+        return None
+    return int(path.rsplit("_", 1)[-1])
+
+
+# inotify events which are sent when a file is written or renamed into place.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+
+
+def _watch_directory(path: gpath.GPath) -> Optional[int]:
+    """Returns an inotify descriptor which is readable once `path` changes.
+
+    Returns None if the directory cannot be watched, e.g. because it is on a
+    remote filesystem, does not exist yet or the platform has no inotify.
+    """
+    if "://" in str(path):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(
+            fd, os.fsencode(str(path)), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_checkpoint(checkpoint_dir: gpath.GPath, last_step: int, interval=10):
+    """Blocks until there is a checkpoint newer than `last_step`.
+
+    Training writes a completion marker after each checkpoint (see
+    `training.CHECKPOINT_MARKER`). On local filesystems the wait blocks on
+    inotify until the marker is renamed into place. Remote filesystems have
+    no notifications, so there the marker is checked every `interval`
+    seconds. The watch is created before the check so no write is missed.
+    """
+    while True:
+        fd = _watch_directory(checkpoint_dir)
+        try:
+            step = latest_checkpoint_step(checkpoint_dir)
+            if step is not None and step > last_step:
+                return step
+            logging.info("No new checkpoints (latest=%s, last=%d).", step, last_step)
+            if fd is None:
+                time.sleep(interval)
+            else:
+                # The timeout covers writes from other hosts to shared
+                # filesystems, which inotify does not report.
+                select.select([fd], [], [], interval * 30)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
 
 def delete_old_renders(render_dir, max_renders):
     render_paths = sorted(render_dir.iterdir())
@@ -331,6 +622,25 @@ def main(argv):
         test_eval_ids = None
         test_eval_iter = None
 
+    # The rays are decoded once and reused for every checkpoint. When each
+    # host renders whole images, hosts only keep the images they render.
+    is_local = None
+    if eval_config.parallel_images and jax.process_count() > 1:
+        is_local = lambda i: i % jax.process_count() == jax.process_index()
+    eval_items = {
+        "val": (val_eval_ids, load_items(val_eval_ids, val_eval_iter, is_local)),
+        "train": (
+            train_eval_ids,
+            load_items(train_eval_ids, train_eval_iter, is_local),
+        ),
+    }
+    if test_eval_iter:
+        eval_items["test"] = (
+            test_eval_ids,
+            load_items(test_eval_ids, test_eval_iter, is_local),
+        )
+    del train_eval_iter, val_eval_iter, test_eval_iter
+
     rng, key = random.split(rng)
     params = {}
     model, params["model"] = models.construct_nerf(
@@ -348,14 +658,22 @@ def main(argv):
 
     optimizer_def = optim.Adam(0.0)
     optimizer = optimizer_def.create(params)
-    init_state = model_utils.TrainState(optimizer=optimizer)
+    occupancy_grid = None
+    if model_config.use_occupancy_grid:
+        occupancy_grid = occupancy.create_grid(model_config.occupancy_grid_resolution)
+    init_state = model_utils.TrainState(
+        optimizer=optimizer, occupancy_grid=occupancy_grid
+    )
     del params
 
-    def _model_fn(key_0, key_1, params, rays_dict, warp_extra):
-        out = model.apply(
+    def _model_fn(
+        key_0, key_1, params, rays_dict, warp_extra, occupancy_grid, render_model=model
+    ):
+        out = render_model.apply(
             {"params": params},
             rays_dict,
             warp_extra=warp_extra,
+            occupancy_grid=occupancy_grid,
             rngs={"coarse": key_0, "fine": key_1},
             mutable=False,
         )
@@ -364,68 +682,97 @@ def main(argv):
     pmodel_fn = jax.pmap(
         # Note rng_keys are useless in eval mode since there's no randomness.
         _model_fn,
-        in_axes=(0, 0, 0, 0, 0),  # Only distribute the data input.
+        in_axes=(0, 0, 0, 0, 0, 0),  # Only distribute the data input.
         devices=devices_to_use,
         donate_argnums=(3,),  # Donate the 'rays' argument.
         axis_name="batch",
     )
-
-    render_fn = functools.partial(
-        evaluation.render_image,
-        model_fn=pmodel_fn,
-        device_count=n_devices,
-        chunk=eval_config.chunk,
+    # Renders the chunks which overflow the early termination sample budget
+    # so that early termination does not change the renders.
+    fallback_pmodel_fns = evaluation.termination_fallbacks(
+        model,
+        lambda render_model: jax.pmap(
+            functools.partial(_model_fn, render_model=render_model),
+            in_axes=(0, 0, 0, 0, 0, 0),
+            devices=devices_to_use,
+            donate_argnums=(3,),
+            axis_name="batch",
+        ),
     )
 
-    last_step = 0
+    if eval_config.parallel_images:
+        # Each device renders its own image so the outputs are not gathered.
+        def _local_model_fn(
+            key_0, key_1, params, rays_dict, warp_extra, occupancy_grid,
+            render_model=model
+        ):
+            return render_model.apply(
+                {"params": params},
+                rays_dict,
+                warp_extra=warp_extra,
+                occupancy_grid=occupancy_grid,
+                rngs={"coarse": key_0, "fine": key_1},
+                mutable=False,
+            )
+
+        render_fn = functools.partial(
+            evaluation.render_images,
+            model_fn=jax.pmap(
+                _local_model_fn,
+                in_axes=(0, 0, 0, 0, 0, 0),
+                devices=devices_to_use,
+                donate_argnums=(3,),
+            ),
+            fallback_model_fns=evaluation.termination_fallbacks(
+                model,
+                lambda render_model: jax.pmap(
+                    functools.partial(_local_model_fn, render_model=render_model),
+                    in_axes=(0, 0, 0, 0, 0, 0),
+                    devices=devices_to_use,
+                    donate_argnums=(3,),
+                ),
+            ),
+            device_count=n_devices,
+            chunk=eval_config.chunk,
+        )
+        process_fn = functools.partial(
+            process_iterator_parallel, num_devices=n_devices
+        )
+    else:
+        render_fn = functools.partial(
+            evaluation.render_image,
+            model_fn=pmodel_fn,
+            fallback_model_fns=fallback_pmodel_fns,
+            device_count=n_devices,
+            chunk=eval_config.chunk,
+        )
+        process_fn = process_iterator
+
     summary_writer = tensorboard.SummaryWriter(str(summary_dir))
+    # The metrics of evaluated checkpoints so that restarts skip them.
+    index_path = summary_dir / "eval_index.json"
+    eval_index = load_eval_index(index_path)
+    last_step = max(eval_index, default=0)
+    if eval_index:
+        logging.info("Already evaluated %d checkpoints.", len(eval_index))
 
     while True:
-        if not checkpoint_dir.exists():
-            logging.info("No checkpoints yet.")
-            time.sleep(10)
-            continue
-
-        state = checkpoints.restore_checkpoint(checkpoint_dir, init_state)
+        if last_step >= train_config.max_steps:
+            break
+        if eval_config.eval_once and latest_checkpoint_step(checkpoint_dir) == last_step:
+            logging.info("The latest checkpoint %d was already evaluated.", last_step)
+            break
+        step = wait_for_checkpoint(checkpoint_dir, last_step)
+        state = model_utils.restore_checkpoint(checkpoint_dir, init_state, step=step)
         state = jax_utils.replicate(state, devices=devices_to_use)
-        step = int(state.optimizer.state.step[0])
-        if step <= last_step:
-            logging.info("No new checkpoints (%d <= %d).", step, last_step)
-            time.sleep(10)
-            continue
 
         save_dir = renders_dir if eval_config.save_output else None
-        process_iterator(
-            tag="val",
-            item_ids=val_eval_ids,
-            iterator=val_eval_iter,
-            state=state,
-            rng=rng,
-            step=step,
-            render_fn=render_fn,
-            summary_writer=summary_writer,
-            save_dir=save_dir,
-            datasource=datasource,
-        )
-
-        process_iterator(
-            tag="train",
-            item_ids=train_eval_ids,
-            iterator=train_eval_iter,
-            state=state,
-            rng=rng,
-            step=step,
-            render_fn=render_fn,
-            summary_writer=summary_writer,
-            save_dir=save_dir,
-            datasource=datasource,
-        )
-
-        if test_eval_iter:
-            process_iterator(
-                tag="test",
-                item_ids=test_eval_ids,
-                iterator=test_eval_iter,
+        step_metrics = {}
+        for tag, (item_ids, items) in eval_items.items():
+            step_metrics[tag] = process_fn(
+                tag=tag,
+                item_ids=item_ids,
+                iterator=items,
                 state=state,
                 rng=rng,
                 step=step,
@@ -435,13 +782,15 @@ def main(argv):
                 datasource=datasource,
             )
 
+        if jax.process_index() == 0:
+            eval_index[step] = step_metrics
+            save_eval_index(index_path, eval_index)
+
         if save_dir:
             delete_old_renders(renders_dir, eval_config.max_render_checkpoints)
 
         if eval_config.eval_once:
             break
-        if step >= train_config.max_steps:
-            break
         last_step = step
 
 
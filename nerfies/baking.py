@@ -0,0 +1,307 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Baking the template NeRF into a sparse voxel grid for fast rendering.
+
+The baked grid stores the density and a view-independent color of the
+template (canonical) NeRF at the vertices of a voxel grid covering
+[-bound, bound]^3. The grid is split into bricks of `brick_size`^3 cells and
+only the vertices of bricks containing an occupied cell are stored, so the
+memory grows with the occupied volume rather than with the resolution cubed.
+Rendering a baked grid only requires evaluating the warp field followed by a
+trilinear lookup per sample.
+"""
+import io
+from typing import Any, Callable, Dict
+
+from flax import struct
+import jax
+from jax import numpy as jnp
+import numpy as np
+
+from nerfies import gpath
+from nerfies import model_utils
+from nerfies import types
+
+
+@struct.dataclass
+class BakedGrid:
+  """A sparse voxel grid containing the baked template NeRF.
+
+  The grid of R^3 cells is split into (R/B)^3 bricks of B^3 cells. Each stored
+  brick holds all of its (B+1)^3 vertices, including the ones it shares with
+  its neighbors, so that the 8 corners of a cell are always in one brick.
+
+  Attributes:
+    brick_index: (R/B, R/B, R/B) int32 index into `bricks` for each brick or
+      -1 if the brick is empty.
+    bricks: (K, B+1, B+1, B+1, 4) the density and RGB color of the vertices
+      of each stored brick.
+    bound: the half-size of the cube covered by the grid.
+  """
+  brick_index: jnp.ndarray
+  bricks: jnp.ndarray
+  bound: float = struct.field(pytree_node=False, default=1.0)
+
+  @property
+  def brick_size(self):
+    return self.bricks.shape[1] - 1
+
+  @property
+  def resolution(self):
+    return self.brick_index.shape[0] * self.brick_size
+
+  @property
+  def num_bricks(self):
+    return self.bricks.shape[0]
+
+  @property
+  def num_vertices(self):
+    return self.num_bricks * (self.brick_size + 1)**3
+
+
+def _evaluate_in_chunks(fn, points, chunk):
+  """Evaluates `fn` over `points` with a static chunk size."""
+  num_points = points.shape[0]
+  outputs = []
+  for i in range(0, num_points, chunk):
+    chunk_points = points[i:i + chunk]
+    num_chunk_points = chunk_points.shape[0]
+    if num_chunk_points < chunk:
+      chunk_points = np.pad(
+          chunk_points, ((0, chunk - num_chunk_points), (0, 0)), mode='edge')
+    outputs.append(np.asarray(jax.device_get(fn(chunk_points)))
+                   [:num_chunk_points])
+  return np.concatenate(outputs, axis=0)
+
+
+def bake(density_fn: Callable[[np.ndarray], np.ndarray],
+         template_fn: Callable[[np.ndarray], Dict[str, np.ndarray]],
+         resolution: int,
+         bound: float,
+         density_threshold: float,
+         brick_size: int = 8,
+         chunk: int = 65536) -> BakedGrid:
+  """Bakes a template NeRF into a sparse grid.
+
+  The density is evaluated one slab of bricks at a time so that the dense
+  grid of vertices is never held in memory.
+
+  Args:
+    density_fn: a function mapping (N, 3) canonical points to the (N,)
+      density. See `NerfModel.query_template_density`.
+    template_fn: a function mapping (N, 3) canonical points to a dictionary
+      containing the `density` (N,) and view-independent `rgb` (N, 3). This is
+      only evaluated at the vertices of occupied bricks. See
+      `NerfModel.query_template`.
+    resolution: the number of cells along each axis.
+    bound: the half-size of the cube covered by the grid.
+    density_threshold: cells whose vertices all have a density below this are
+      considered empty. Bricks without occupied cells are not stored.
+    brick_size: the number of cells along each axis of a brick. Must divide
+      `resolution`.
+    chunk: the number of points to evaluate at once.
+
+  Returns:
+    The baked grid.
+  """
+  if resolution % brick_size != 0:
+    raise ValueError(f'The resolution {resolution} is not divisible by the '
+                     f'brick size {brick_size}.')
+  num_bricks = resolution // brick_size
+  ticks = np.linspace(-bound, bound, resolution + 1, dtype=np.float32)
+
+  brick_index = np.full((num_bricks,) * 3, fill_value=-1, dtype=np.int32)
+  brick_vertices = []
+  brick_density = []
+  for bx in range(num_bricks):
+    # The vertices of the slab of bricks at bx, including both boundaries.
+    slab_ticks = ticks[bx * brick_size:(bx + 1) * brick_size + 1]
+    vertices = np.stack(
+        np.meshgrid(slab_ticks, ticks, ticks, indexing='ij'), axis=-1)
+    density = _evaluate_in_chunks(
+        density_fn, vertices.reshape((-1, 3)), chunk).reshape(
+            vertices.shape[:-1])
+
+    # A cell is occupied if any of its 8 vertices is above the threshold.
+    vertex_occupied = density > density_threshold
+    cell_occupied = np.zeros((brick_size, resolution, resolution),
+                             dtype=np.bool_)
+    for dx in (0, 1):
+      for dy in (0, 1):
+        for dz in (0, 1):
+          cell_occupied |= vertex_occupied[dx:dx + brick_size,
+                                           dy:dy + resolution,
+                                           dz:dz + resolution]
+    brick_occupied = cell_occupied.reshape(
+        (brick_size, num_bricks, brick_size, num_bricks, brick_size)).any(
+            axis=(0, 2, 4))
+
+    for by, bz in zip(*np.nonzero(brick_occupied)):
+      brick_index[bx, by, bz] = len(brick_density)
+      ys = slice(by * brick_size, (by + 1) * brick_size + 1)
+      zs = slice(bz * brick_size, (bz + 1) * brick_size + 1)
+      brick_vertices.append(vertices[:, ys, zs])
+      brick_density.append(density[:, ys, zs])
+
+  brick_shape = (brick_size + 1,) * 3
+  if brick_density:
+    brick_density = np.stack(brick_density)
+    brick_vertices = np.stack(brick_vertices).reshape((-1, 3))
+    rgb = _evaluate_in_chunks(
+        lambda x: template_fn(x)['rgb'], brick_vertices, chunk)
+  else:
+    brick_density = np.zeros((0, *brick_shape), np.float32)
+    rgb = np.zeros((0, 3), np.float32)
+  rgb = rgb.reshape((-1, *brick_shape, 3))
+  bricks = np.concatenate(
+      [brick_density[..., None], rgb], axis=-1).astype(np.float16)
+
+  return BakedGrid(brick_index=brick_index, bricks=bricks, bound=bound)
+
+
+def lookup(grid: BakedGrid, points):
+  """Trilinearly interpolates the baked grid.
+
+  Args:
+    grid: the baked grid.
+    points: (..., 3) canonical points.
+
+  Returns:
+    density: (...,) the interpolated density.
+    rgb: (..., 3) the interpolated color.
+  """
+  resolution = grid.resolution
+  brick_size = grid.brick_size
+  coords = (points / grid.bound + 1.0) * 0.5 * resolution
+  inside = jnp.all((coords >= 0.0) & (coords <= resolution), axis=-1)
+  coords = jnp.clip(coords, 0.0, resolution - 1e-4)
+  base = jnp.floor(coords).astype(jnp.int32)
+  frac = coords - base
+
+  brick = base // brick_size
+  local = base - brick * brick_size
+  index = grid.brick_index[brick[..., 0], brick[..., 1], brick[..., 2]]
+  occupied = index >= 0
+  index = jnp.maximum(index, 0)
+
+  out = jnp.zeros((*points.shape[:-1], grid.bricks.shape[-1]), jnp.float32)
+  for dx in (0, 1):
+    for dy in (0, 1):
+      for dz in (0, 1):
+        corner = grid.bricks[index,
+                             local[..., 0] + dx,
+                             local[..., 1] + dy,
+                             local[..., 2] + dz].astype(jnp.float32)
+        weight = ((frac[..., 0] if dx else 1.0 - frac[..., 0]) *
+                  (frac[..., 1] if dy else 1.0 - frac[..., 1]) *
+                  (frac[..., 2] if dz else 1.0 - frac[..., 2]))
+        out = out + weight[..., None] * corner
+  out = jnp.where(occupied[..., None], out, 0.0)
+
+  density = jnp.where(inside, out[..., 0], 0.0)
+  rgb = out[..., 1:]
+  return density, rgb
+
+
+def render_rays(grid: BakedGrid,
+                rays_dict: Dict[str, Any],
+                warp_fn: Callable[..., jnp.ndarray],
+                num_samples: int,
+                near: float,
+                far: float,
+                use_white_background: bool = False,
+                use_sample_at_infinity: bool = True):
+  """Renders a batch of rays using a baked grid.
+
+  Args:
+    grid: the baked grid.
+    rays_dict: a dictionary containing `origins`, `directions` and `metadata`.
+    warp_fn: a function mapping (points, metadata) to warped canonical points
+      or None to render the template without deformation.
+    num_samples: the number of samples along each ray.
+    near: the near plane.
+    far: the far plane.
+    use_white_background: composite rendering on to a white background.
+    use_sample_at_infinity: if True adds a sample at infinity.
+
+  Returns:
+    A dictionary with the rendered `rgb`, `depth`, `med_depth` and `acc`.
+  """
+  origins = rays_dict['origins']
+  directions = rays_dict['directions']
+  z_vals, points = model_utils.sample_along_rays(
+      None, origins, directions, num_samples, near, far,
+      use_stratified_sampling=False, use_linear_disparity=False)
+  if warp_fn is not None:
+    points = warp_fn(points, rays_dict['metadata'])
+  density, rgb = lookup(grid, points)
+  return model_utils.volumetric_rendering(
+      rgb, density, z_vals, directions,
+      use_white_background=use_white_background,
+      sample_at_infinity=use_sample_at_infinity)
+
+
+def render_image(grid: BakedGrid,
+                 rays_dict: Dict[str, Any],
+                 render_fn: Callable[..., Dict[str, jnp.ndarray]],
+                 chunk: int = 65536):
+  """Renders an image with a baked grid in chunks.
+
+  Args:
+    grid: the baked grid.
+    rays_dict: a dictionary of (H, W, C) ray arrays.
+    render_fn: a jitted function mapping (grid, rays_dict) to outputs. This is
+      usually a partial of `render_rays`.
+    chunk: the number of rays to render at once.
+
+  Returns:
+    A dictionary of (H, W, ...) rendered maps.
+  """
+  h, w = rays_dict['origins'].shape[:2]
+  rays_dict = jax.tree_map(lambda x: x.reshape((h * w, -1)), rays_dict)
+  num_rays = h * w
+  ret_maps = []
+  for ray_idx in range(0, num_rays, chunk):
+    # pylint: disable=cell-var-from-loop
+    chunk_rays_dict = jax.tree_map(
+        lambda x: x[ray_idx:ray_idx + chunk], rays_dict)
+    ret_maps.append(jax.device_get(render_fn(grid, chunk_rays_dict)))
+  ret_map = jax.tree_multimap(lambda *x: np.concatenate(x, axis=0), *ret_maps)
+  return {k: v.reshape((h, w, *v.shape[1:])) for k, v in ret_map.items()}
+
+
+def save_grid(path: types.PathType, grid: BakedGrid):
+  """Saves a baked grid to disk."""
+  path = gpath.GPath(path)
+  buffer = io.BytesIO()
+  np.savez_compressed(buffer,
+                      brick_index=np.asarray(grid.brick_index),
+                      bricks=np.asarray(grid.bricks),
+                      bound=np.asarray(grid.bound))
+  with path.open('wb') as f:
+    f.write(buffer.getvalue())
+
+
+def load_grid(path: types.PathType) -> BakedGrid:
+  """Loads a baked grid from disk."""
+  path = gpath.GPath(path)
+  with path.open('rb') as f:
+    data = np.load(io.BytesIO(f.read()))
+    if 'brick_index' not in data:
+      raise ValueError(f'{path} was baked with a dense vertex index; bake the '
+                       'checkpoint again.')
+    return BakedGrid(brick_index=data['brick_index'],
+                     bricks=data['bricks'],
+                     bound=float(data['bound']))
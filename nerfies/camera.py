@@ -13,8 +13,12 @@
 # limitations under the License.
 
 """Class for handling cameras."""
+import collections
 import copy
+import hashlib
+import io
 import json
+import threading
 from typing import Tuple, Union, Optional
 
 import numpy as np
@@ -105,6 +109,82 @@ def _radial_and_tangential_undistort(
   return x, y
 
 
+class UndistortionCache:
+  """A least-recently-used cache of local ray maps keyed by intrinsics.
+
+  Undistorting the pixel centers of a camera takes several Newton iterations
+  per pixel but only depends on the intrinsics and image size, which are
+  shared by e.g., all frames of a capture. The (H, W, 3) local ray directions
+  through the pixel centers are computed once per set of intrinsics and kept
+  in memory and, if `cache_dir` is set, on disk.
+  """
+
+  def __init__(self,
+               max_entries: int = 4,
+               cache_dir: Optional[types.PathType] = None):
+    self.max_entries = max_entries
+    self.cache_dir = gpath.GPath(cache_dir) if cache_dir else None
+    self._maps = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _load(self, key):
+    path = self.cache_dir / f'{key}.npy'
+    if not path.exists():
+      return None
+    try:
+      with path.open('rb') as f:
+        return np.load(io.BytesIO(f.read()))
+    except (OSError, ValueError):
+      # A partially written file from an interrupted run.
+      return None
+
+  def _save(self, key, local_rays):
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    buffer = io.BytesIO()
+    np.save(buffer, local_rays)
+    with (self.cache_dir / f'{key}.npy').open('wb') as f:
+      f.write(buffer.getvalue())
+
+  def get(self, camera: 'Camera') -> np.ndarray:
+    """Returns the read-only local ray map of the camera."""
+    key = camera.intrinsics_key()
+    with self._lock:
+      if key in self._maps:
+        self.hits += 1
+        self._maps.move_to_end(key)
+        return self._maps[key]
+      self.misses += 1
+
+    local_rays = self._load(key) if self.cache_dir else None
+    if local_rays is None:
+      local_rays = camera.pixel_to_local_rays(camera.get_pixel_centers())
+      if self.cache_dir:
+        self._save(key, local_rays)
+    local_rays.setflags(write=False)
+
+    with self._lock:
+      self._maps[key] = local_rays
+      while len(self._maps) > self.max_entries:
+        self._maps.popitem(last=False)
+    return local_rays
+
+  def clear(self):
+    with self._lock:
+      self._maps.clear()
+
+
+_UNDISTORTION_CACHE = UndistortionCache()
+
+
+def configure_undistortion_cache(max_entries: int = 4,
+                                 cache_dir: Optional[types.PathType] = None):
+  """Replaces the undistortion cache used by `Camera.get_local_rays`."""
+  global _UNDISTORTION_CACHE
+  _UNDISTORTION_CACHE = UndistortionCache(max_entries, cache_dir)
+
+
 class Camera:
   """Class to handle camera geometry."""
 
@@ -268,6 +348,34 @@ class Camera:
     rays_dir = rays_dir.reshape((*batch_shape, 3))
     return rays_dir
 
+  def intrinsics_key(self) -> str:
+    """Returns a hash of the parameters which determine the local rays."""
+    hasher = hashlib.sha1()
+    hasher.update(np.dtype(self.dtype).str.encode('utf-8'))
+    for value in (self.focal_length, self.principal_point, self.skew,
+                  self.pixel_aspect_ratio, self.radial_distortion,
+                  self.tangential_distortion, self.image_size):
+      hasher.update(np.asarray(value).tobytes())
+    return hasher.hexdigest()
+
+  def get_local_rays(self) -> np.ndarray:
+    """Returns the (H, W, 3) local ray directions of the pixel centers.
+
+    The result is shared between cameras with the same intrinsics and must not
+    be modified.
+    """
+    return _UNDISTORTION_CACHE.get(self)
+
+  def get_rays(self) -> np.ndarray:
+    """Returns the (H, W, 3) world ray directions of the pixel centers.
+
+    This is equivalent to `pixels_to_rays(get_pixel_centers())` but reuses
+    the cached local rays.
+    """
+    rays_dir = np.matmul(self.get_local_rays(), self.orientation)
+    rays_dir /= np.linalg.norm(rays_dir, axis=-1, keepdims=True)
+    return rays_dir
+
   def pixels_to_points(self, pixels: np.ndarray, depth: np.ndarray):
     rays_through_pixels = self.pixels_to_rays(pixels)
     cosa = np.matmul(rays_through_pixels, self.optical_axis)
@@ -424,3 +532,288 @@ class Camera:
 
   def copy(self):
     return copy.deepcopy(self)
+
+
+class CameraBatch:
+  """A batch of cameras stored as stacked parameter arrays.
+
+  Every parameter has a leading batch dimension e.g., `orientation` is
+  (N, 3, 3) and `focal_length` is (N,). The methods mirror those of `Camera`
+  but operate on all cameras at once which avoids a Python loop over cameras
+  when e.g., generating the rays of a long camera path.
+  """
+
+  def __init__(self,
+               orientation: np.ndarray,
+               position: np.ndarray,
+               focal_length: Union[np.ndarray, float],
+               principal_point: np.ndarray,
+               image_size: np.ndarray,
+               skew: Union[np.ndarray, float] = 0.0,
+               pixel_aspect_ratio: Union[np.ndarray, float] = 1.0,
+               radial_distortion: Optional[np.ndarray] = None,
+               tangential_distortion: Optional[np.ndarray] = None,
+               dtype=np.float32):
+    """Constructor for the camera batch.
+
+    Parameters without a batch dimension are broadcast to all cameras.
+    """
+    if radial_distortion is None:
+      radial_distortion = np.array([0.0, 0.0, 0.0], dtype)
+    if tangential_distortion is None:
+      tangential_distortion = np.array([0.0, 0.0], dtype)
+
+    self.orientation = np.array(orientation, dtype)
+    if self.orientation.ndim != 3:
+      raise ValueError('orientation must have shape (N, 3, 3).')
+    batch_size = self.orientation.shape[0]
+
+    def _broadcast(x, shape, x_dtype=dtype):
+      return np.broadcast_to(
+          np.asarray(x, x_dtype), (batch_size, *shape)).copy()
+
+    self.position = _broadcast(position, (3,))
+    self.focal_length = _broadcast(focal_length, ())
+    self.principal_point = _broadcast(principal_point, (2,))
+    self.skew = _broadcast(skew, ())
+    self.pixel_aspect_ratio = _broadcast(pixel_aspect_ratio, ())
+    self.radial_distortion = _broadcast(radial_distortion, (3,))
+    self.tangential_distortion = _broadcast(tangential_distortion, (2,))
+    self.image_size = _broadcast(image_size, (2,), np.uint32)
+    self.dtype = dtype
+
+  @classmethod
+  def from_cameras(cls, cameras, dtype=np.float32):
+    """Stacks a sequence of cameras into a batch."""
+    if not cameras:
+      raise ValueError('Cannot create a camera batch without cameras.')
+    params = [camera.get_parameters() for camera in cameras]
+    return cls(**{k: np.stack([p[k] for p in params]) for k in params[0]},
+               dtype=dtype)
+
+  def to_cameras(self):
+    """Returns the cameras of the batch as a list of `Camera`."""
+    return [self[i] for i in range(len(self))]
+
+  def get_parameters(self):
+    return {
+        'orientation': self.orientation,
+        'position': self.position,
+        'focal_length': self.focal_length,
+        'principal_point': self.principal_point,
+        'skew': self.skew,
+        'pixel_aspect_ratio': self.pixel_aspect_ratio,
+        'radial_distortion': self.radial_distortion,
+        'tangential_distortion': self.tangential_distortion,
+        'image_size': self.image_size,
+    }
+
+  def __len__(self):
+    return self.orientation.shape[0]
+
+  def __getitem__(self, index):
+    """Returns a `Camera` for an integer index and a batch otherwise."""
+    params = {k: v[index] for k, v in self.get_parameters().items()}
+    if np.ndim(index) == 0 and not isinstance(index, slice):
+      return Camera(**params, dtype=self.dtype)
+    return CameraBatch(**params, dtype=self.dtype)
+
+  @property
+  def scale_factor_x(self):
+    return self.focal_length
+
+  @property
+  def scale_factor_y(self):
+    return self.focal_length * self.pixel_aspect_ratio
+
+  @property
+  def has_distortion(self):
+    return bool(np.any(self.radial_distortion != 0.0)
+                or np.any(self.tangential_distortion != 0.0))
+
+  @property
+  def optical_axis(self):
+    return self.orientation[:, 2, :]
+
+  @property
+  def translation(self):
+    return -np.einsum('nij,nj->ni', self.orientation, self.position)
+
+  def _broadcast_batch(self, x: np.ndarray, num_dims: int):
+    """Broadcasts (N or 1, ..., D) to (N, M, D) and returns the batch shape."""
+    x = np.broadcast_to(x, (len(self), *x.shape[1:]))
+    batch_shape = x.shape[1:-1]
+    return x.reshape((len(self), -1, num_dims)), batch_shape
+
+  def pixel_to_local_rays(self, pixels: np.ndarray):
+    """Returns the (N, M, 3) local ray directions for (N, M, 2) pixels."""
+    principal_point = self.principal_point[:, None, :]
+    y = ((pixels[..., 1] - principal_point[..., 1])
+         / self.scale_factor_y[:, None])
+    x = ((pixels[..., 0] - principal_point[..., 0]
+          - y * self.skew[:, None]) / self.scale_factor_x[:, None])
+
+    if self.has_distortion:
+      # Cameras without distortion have a zero residual and are unchanged.
+      x, y = _radial_and_tangential_undistort(
+          x,
+          y,
+          k1=self.radial_distortion[:, None, 0],
+          k2=self.radial_distortion[:, None, 1],
+          k3=self.radial_distortion[:, None, 2],
+          p1=self.tangential_distortion[:, None, 0],
+          p2=self.tangential_distortion[:, None, 1])
+
+    dirs = np.stack([x, y, np.ones_like(x)], axis=-1)
+    return dirs / np.linalg.norm(dirs, axis=-1, keepdims=True)
+
+  def pixels_to_rays(self, pixels: np.ndarray) -> np.ndarray:
+    """Returns the rays for the provided pixels.
+
+    Args:
+      pixels: [N, A1, ..., An, 2] array of pixel positions for each camera. A
+        leading dimension of 1 uses the same pixels for every camera.
+
+    Returns:
+      A [N, A1, ..., An, 3] array of normalized ray directions in world
+        coordinates.
+    """
+    if pixels.shape[-1] != 2:
+      raise ValueError('The last dimension of pixels must be 2.')
+    if pixels.dtype != self.dtype:
+      raise ValueError(f'pixels dtype ({pixels.dtype!r}) must match camera '
+                       f'dtype ({self.dtype!r})')
+
+    pixels, batch_shape = self._broadcast_batch(pixels, 2)
+    local_rays_dir = self.pixel_to_local_rays(pixels)
+    rays_dir = np.einsum('nji,nmj->nmi', self.orientation, local_rays_dir)
+
+    # Normalize rays.
+    rays_dir /= np.linalg.norm(rays_dir, axis=-1, keepdims=True)
+    return rays_dir.reshape((len(self), *batch_shape, 3))
+
+  def points_to_local_points(self, points: np.ndarray):
+    """Transforms (N, M, 3) world points to the frame of each camera."""
+    translated_points = points - self.position[:, None, :]
+    return np.einsum('nij,nmj->nmi', self.orientation, translated_points)
+
+  def project(self, points: np.ndarray):
+    """Projects [N, A1, ..., An, 3] points to [N, A1, ..., An, 2] pixels."""
+    points, batch_shape = self._broadcast_batch(points, 3)
+    local_points = self.points_to_local_points(points)
+
+    # Get normalized local pixel positions.
+    x = local_points[..., 0] / local_points[..., 2]
+    y = local_points[..., 1] / local_points[..., 2]
+    r2 = x**2 + y**2
+
+    # Apply radial distortion.
+    k1, k2, k3 = np.moveaxis(self.radial_distortion[:, None, :], -1, 0)
+    distortion = 1.0 + r2 * (k1 + r2 * (k2 + k3 * r2))
+
+    # Apply tangential distortion.
+    p1, p2 = np.moveaxis(self.tangential_distortion[:, None, :], -1, 0)
+    x_times_y = x * y
+    x = x * distortion + 2.0 * p1 * x_times_y + p2 * (r2 + 2.0 * x**2)
+    y = y * distortion + 2.0 * p2 * x_times_y + p1 * (r2 + 2.0 * y**2)
+
+    # Map the distorted ray to the image plane and return the depth.
+    principal_point = self.principal_point[:, None, :]
+    pixel_x = (self.focal_length[:, None] * x + self.skew[:, None] * y
+               + principal_point[..., 0])
+    pixel_y = (self.scale_factor_y[:, None] * y + principal_point[..., 1])
+
+    pixels = np.stack([pixel_x, pixel_y], axis=-1)
+    return pixels.reshape((len(self), *batch_shape, 2))
+
+  def get_pixel_centers(self):
+    """Returns the (H, W, 2) pixel centers shared by all cameras."""
+    if np.any(self.image_size != self.image_size[0]):
+      raise ValueError('All cameras must have the same image size.')
+    image_size_x, image_size_y = self.image_size[0]
+    xx, yy = np.meshgrid(np.arange(image_size_x, dtype=self.dtype),
+                         np.arange(image_size_y, dtype=self.dtype))
+    return np.stack([xx, yy], axis=-1) + 0.5
+
+  def get_rays(self):
+    """Returns the rays through the pixel centers of every camera.
+
+    Returns:
+      origins: (N, H, W, 3) the ray origins.
+      directions: (N, H, W, 3) the normalized ray directions.
+      pixels: (H, W, 2) the pixel centers.
+    """
+    pixels = self.get_pixel_centers()
+    intrinsics = (self.focal_length, self.principal_point, self.skew,
+                  self.pixel_aspect_ratio, self.radial_distortion,
+                  self.tangential_distortion)
+    if all(np.all(x == x[0]) for x in intrinsics):
+      # Shared intrinsics only need a rotation of the cached local rays.
+      local_rays_dir = self[0].get_local_rays()
+      directions = np.einsum('hwj,nji->nhwi', local_rays_dir, self.orientation)
+      directions /= np.linalg.norm(directions, axis=-1, keepdims=True)
+    else:
+      directions = self.pixels_to_rays(pixels[None])
+    origins = np.broadcast_to(self.position[:, None, None, :],
+                              directions.shape)
+    return origins, directions, pixels
+
+  def scale(self, scale: float):
+    """Scales all cameras of the batch."""
+    if scale <= 0:
+      raise ValueError('scale needs to be positive.')
+
+    new_batch = self.copy()
+    new_batch.focal_length = self.focal_length * scale
+    new_batch.principal_point = self.principal_point * scale
+    new_batch.image_size = np.round(
+        self.image_size * scale).astype(np.uint32)
+    return new_batch
+
+  def look_at(self, position, look_at, up, eps=1e-6):
+    """Creates a copy of the batch whose cameras look at the given points.
+
+    Args:
+      position: A (N, 3) or (3,) array of camera positions.
+      look_at: A (N, 3) or (3,) array of the locations the cameras look at.
+      up: A (N, 3) or (3,) array of up directions, whose projections are
+        parallel to the y-axis of the image planes.
+      eps: a small number to prevent divides by zero.
+
+    Returns:
+      A new batch with the intrinsics of this one which is positioned and
+        looks at the provided coordinates.
+
+    Raises:
+      ValueError: If a camera position and look at position are very close to
+        each other or if an up-vector is parallel to the optical axis.
+    """
+    shape = (len(self), 3)
+    position = np.broadcast_to(np.asarray(position, np.float64), shape)
+    look_at = np.broadcast_to(np.asarray(look_at, np.float64), shape)
+    up = np.broadcast_to(np.asarray(up, np.float64), shape)
+
+    optical_axis = look_at - position
+    norm = np.linalg.norm(optical_axis, axis=-1, keepdims=True)
+    if np.any(norm < eps):
+      raise ValueError('The camera center and look at position are too close.')
+    optical_axis = optical_axis / norm
+
+    right_vector = np.cross(optical_axis, up)
+    norm = np.linalg.norm(right_vector, axis=-1, keepdims=True)
+    if np.any(norm < eps):
+      raise ValueError('The up-vector is parallel to the optical axis.')
+    right_vector = right_vector / norm
+
+    # The rows form a right handed coordinate system for each camera.
+    camera_rotation = np.stack(
+        [right_vector, np.cross(optical_axis, right_vector), optical_axis],
+        axis=-2)
+
+    look_at_batch = self.copy()
+    look_at_batch.position = position.astype(self.dtype)
+    look_at_batch.orientation = camera_rotation.astype(self.dtype)
+    return look_at_batch
+
+  def copy(self):
+    return copy.deepcopy(self)
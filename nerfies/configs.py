@@ -67,6 +67,9 @@ class ModelConfig:
   rgb_channels: int = 3
   # The number of positional encodings for points.
   num_nerf_point_freqs: int = 10
+  # The encoder for the template NeRF points. One of: 'sinusoidal' or
+  # 'hash_grid'. A hash grid allows a much shallower NeRF MLP.
+  nerf_point_encoder_type: str = 'sinusoidal'
   # The number of positional encodings for viewdirs.
   num_nerf_viewdir_freqs: int = 4
   # The number of coarse samples along each ray.
@@ -103,6 +106,47 @@ class ModelConfig:
   warp_metadata_encoder_type: str = 'glo'
   # Additional keyword arguments to pass to the warp field.
   warp_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
+  # The encoder for the warp field points. One of: 'sinusoidal' or
+  # 'hash_grid'. The warp alpha schedule should go up to the number of grid
+  # levels when using a hash grid.
+  warp_point_encoder_type: str = 'sinusoidal'
+  # Keyword arguments for `modules.HashGridEncoder` e.g., `num_levels`.
+  hash_grid_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
+
+  # Whether to skip empty space in the coarse pass using an occupancy grid.
+  use_occupancy_grid: bool = False
+  # The resolution of the occupancy grid along each axis.
+  occupancy_grid_resolution: int = 128
+  # The number of candidate samples per ray tested against the grid.
+  num_occupancy_candidates: int = 256
+  # Cells with a template density above this value are considered occupied.
+  occupancy_density_threshold: float = 0.01
+  # The number of cells the occupied cells are dilated by. The grid is built
+  # from the template (canonical) density but queried at the unwarped
+  # samples, so this must cover the largest expected deformation.
+  occupancy_dilation: int = 4
+
+  # Whether to skip fine samples behind opaque surfaces at inference.
+  use_early_termination: bool = False
+  # The transmittance below which samples are skipped.
+  termination_threshold: float = 1e-3
+  # The fraction of fine samples evaluated when using early termination.
+  # Chunks with more surviving samples are rendered again with the fraction
+  # doubled until they fit.
+  termination_sample_fraction: float = 0.25
+
+  # Whether to resample the coarse samples with a small proposal density MLP
+  # instead of the coarse NeRF MLP. Requires `num_fine_samples > 0`.
+  use_proposal_network: bool = False
+  # The depth of the proposal MLP.
+  proposal_depth: int = 2
+  # The width of the proposal MLP.
+  proposal_width: int = 64
+
+  # The dtype of the NeRF and warp MLP computation. One of: 'float32',
+  # 'bfloat16' or 'float16'. Parameters and volumetric rendering always use
+  # float32.
+  dtype: str = 'float32'
 
 
 @gin.configurable()
@@ -151,16 +195,26 @@ class TrainConfig:
   # The time encoder alpha schedule.
   time_alpha_schedule: ScheduleDef = ('constant', 0.0)
 
+  # The schedule for easing in the levels of the template NeRF hash grid. If
+  # None all levels are used from the start.
+  nerf_alpha_schedule: Optional[ScheduleDef] = None
+
   # Whether to use the elastic regularization loss.
   use_elastic_loss: bool = False
   # The weight of the elastic regularization loss.
   elastic_loss_weight_schedule: ScheduleDef = ('constant', 0.0)
   # Which method to use to reduce the samples for the elastic loss.
   # 'weight' computes a weighted sum using the density weights, and 'median'
-  # selects the sample at the median depth point.
+  # selects the sample at the median depth point. 'topk' computes a weighted
+  # sum over the `elastic_topk` samples with the largest weights. The Jacobian
+  # is only evaluated at the selected samples for 'median' and 'topk'.
   elastic_reduce_method: str = 'weight'
+  # The number of samples used by the 'topk' elastic reduction.
+  elastic_topk: int = 4
   # Which loss method to use for the elastic loss.
   elastic_loss_type: str = 'log_svals'
+  # The weight of the histogram loss which trains the proposal network.
+  proposal_loss_weight: float = 1.0
   # Whether to use background regularization.
   use_background_loss: bool = False
   # The weight for the background loss.
@@ -176,12 +230,49 @@ class TrainConfig:
   # The scale for the warp reg loss.
   warp_reg_loss_scale: float = 0.001
 
+  # How often to refresh the occupancy grid from the template NeRF density.
+  occupancy_update_every: int = 1000
+  # Whether to seed the occupancy grid from the scene points.
+  occupancy_init_from_points: bool = False
+
   # The size of the shuffle buffer size when shuffling the training dataset.
   # This needs to be sufficiently large to contain a diverse set of images in
   # each batch, especially when optimizing GLO embeddings.
   shuffle_buffer_size: int = 5000000
+  # Whether to sample ray batches with the NumPy `RaySampler` instead of a
+  # shuffled tf.data pipeline. `shuffle_buffer_size` is unused if True.
+  use_ray_sampler: bool = True
+  # Whether to sample more rays from images with a high running error. The
+  # RGB loss is reweighted to remain unbiased. Requires `use_ray_sampler`.
+  use_importance_sampling: bool = False
+  # The fraction of rays which are still sampled uniformly.
+  importance_uniform_fraction: float = 0.5
+  # The decay of the running per-image error.
+  importance_error_decay: float = 0.9
+  # How often to update the per-image errors from the training step.
+  importance_update_every: int = 10
+  # Whether to only send the pixel and camera index of each ray to the device
+  # and generate the rays inside the training step. Requires `use_ray_sampler`.
+  use_device_rays: bool = False
+  # Whether to stream images decoded by a process pool into a bounded shuffle
+  # reservoir instead of loading all rays into memory. Requires
+  # `use_ray_sampler` and is incompatible with `use_importance_sampling`.
+  use_streaming_sampler: bool = False
+  # The number of rays held in the streaming reservoir.
+  streaming_reservoir_size: int = 2 ** 22
+  # The number of decoding processes or None to use all CPUs.
+  streaming_num_workers: Optional[int] = None
+
+  # The initial dynamic loss scale or None to disable loss scaling. This is
+  # only needed when the model computes in 'float16'; 'bfloat16' has the
+  # exponent range of float32.
+  loss_scale: Optional[float] = None
+  # The number of consecutive finite steps after which the loss scale doubles.
+  loss_scale_growth_interval: int = 2000
   # How often to save a checkpoint.
   save_every: int = 10000
+  # Whether to write checkpoints from a background thread.
+  async_checkpointing: bool = True
   # How often to log to Tensorboard.
   log_every: int = 500
   # How often to log histograms to Tensorboard.
@@ -201,6 +292,11 @@ class EvalConfig:
   save_output: bool = True
   # The evaluation batch size.
   chunk: int = 8192
+  # If True render whole images on separate devices and hosts instead of
+  # splitting each image across all devices. The metrics are reduced across
+  # hosts once per split and only host 0 writes outputs. This is faster for
+  # many small images since outputs are not gathered for every chunk.
+  parallel_images: bool = False
   # Max render checkpoints. The renders will rotate after this many.
   max_render_checkpoints = 3
 
@@ -210,3 +306,22 @@ class EvalConfig:
   num_train_eval: Optional[int] = 10
   # The number of test examples to evaluate.
   num_test_eval: Optional[int] = 10
+
+
+@gin.configurable()
+@dataclasses.dataclass
+class BakeConfig:
+  """Parameters for baking the template NeRF into a sparse grid."""
+  # The number of voxels along each axis of the baked grid.
+  resolution: int = 256
+  # Voxels whose density is below this value everywhere are not stored.
+  density_threshold: float = 0.5
+  # The number of voxels along each axis of a brick. Only bricks with an
+  # occupied voxel are stored. Must divide the resolution.
+  brick_size: int = 8
+  # The number of points to evaluate at once while baking.
+  chunk: int = 65536
+  # The number of samples per ray when rendering the baked grid.
+  num_samples: int = 256
+  # The number of rays to render at once from the baked grid.
+  render_chunk: int = 8192
@@ -15,6 +15,11 @@
 """Dataset definition and utility package."""
 from nerfies.datasets.core import *
 from nerfies.datasets.nerfies import NerfiesDataSource
+from nerfies.datasets.packed import PackedDataSource
+from nerfies.datasets.sampler import ImportanceRaySampler
+from nerfies.datasets.sampler import iterator_from_sampler
+from nerfies.datasets.sampler import RaySampler
+from nerfies.datasets.streaming import StreamingRaySampler
 
 
 def from_config(spec, **kwargs):
@@ -23,5 +28,7 @@ def from_config(spec, **kwargs):
   ds_type = spec.pop('type')
   if ds_type == 'nerfies':
     return NerfiesDataSource(**spec, **kwargs)
+  if ds_type == 'packed':
+    return PackedDataSource(**spec, **kwargs)
 
   raise ValueError(f'Unknown datasource type {ds_type!r}')
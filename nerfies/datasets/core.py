@@ -16,6 +16,7 @@
 import abc
 import functools
 import itertools
+import os
 from typing import Any, Iterable, Optional, Sequence, Union
 
 from absl import logging
@@ -27,8 +28,12 @@ import tensorflow as tf
 from nerfies import camera as cam
 from nerfies import gpath
 from nerfies import image_utils
+from nerfies import jax_camera
 from nerfies import tf_camera as tfcam
 from nerfies import utils
+from nerfies.datasets import ray_cache
+from nerfies.datasets import sampler
+from nerfies.datasets import streaming
 # pylint: disable=g-direct-tensorflow-import
 from tensorflow.python.data.util import nest
 
@@ -65,7 +70,7 @@ def camera_to_rays(camera: cam.Camera):
 
   img_rays_origin = np.tile(camera.position[None, None, :],
                             image_shape + (1,))
-  img_rays_dir = camera.pixels_to_rays(camera.get_pixel_centers())
+  img_rays_dir = camera.get_rays()
   img_rays_pixels = camera.get_pixel_centers()
 
   return {
@@ -96,6 +101,14 @@ def load_camera(camera_path,
   else:
     raise ValueError('File must have extension .pb or .json.')
 
+  return transform_camera(camera, scale_factor, scene_center, scene_scale)
+
+
+def transform_camera(camera: cam.Camera,
+                     scale_factor=1.0,
+                     scene_center=None,
+                     scene_scale=None) -> cam.Camera:
+  """Scales the image of a camera and moves it into scene coordinates."""
   if scale_factor != 1.0:
     camera = camera.scale(scale_factor)
 
@@ -172,7 +185,7 @@ def _camera_to_rays_fn(item, use_tf_camera=False):
   else:
     camera = cam.Camera(**camera_params)
     pixels = camera.get_pixel_centers()
-    directions = camera.pixels_to_rays(pixels)
+    directions = camera.get_rays()
     origins = np.broadcast_to(camera.position[None, None, :], directions.shape)
   item['origins'] = origins
   item['directions'] = directions
@@ -180,6 +193,15 @@ def _camera_to_rays_fn(item, use_tf_camera=False):
   return item
 
 
+def _image_shape(camera):
+  return tuple(int(x) for x in camera.image_shape)
+
+
+def _item_offsets(cameras):
+  """Returns the offset of each camera's rays in a flattened ray array."""
+  return np.cumsum([0] + [h * w for h, w in map(_image_shape, cameras)])
+
+
 def _tf_broadcast_metadata_fn(item):
   """Broadcasts metadata to the ray shape."""
   shape = tf.shape(item['rgb'])
@@ -205,6 +227,9 @@ class DataSource(abc.ABC):
                train_stride=1,
                val_stride=1,
                preload=True,
+               ray_cache_dir=None,
+               undistortion_cache_dir=None,
+               device_rays=False,
                **_):
     self._train_ids = train_ids
     self._val_ids = val_ids
@@ -218,6 +243,11 @@ class DataSource(abc.ABC):
     self.use_relative_depth = use_relative_depth
     self.rng = np.random.RandomState(random_seed)
     self.preload = preload
+    self.ray_cache_dir = ray_cache_dir
+    self.device_rays = device_rays
+    self.undistortion_cache_dir = undistortion_cache_dir
+    if undistortion_cache_dir:
+      cam.configure_undistortion_cache(cache_dir=undistortion_cache_dir)
     logging.info(
         'Creating datasource of type %s with use_appearance_id=%s, '
         'use_camera_id=%s, use_warp_id=%s, use_depth=%s, use_time=%s',
@@ -310,6 +340,11 @@ class DataSource(abc.ABC):
   def far(self) -> float:
     raise NotImplementedError()
 
+  @property
+  def cache_id(self) -> str:
+    """A string identifying the source data for the ray cache."""
+    raise NotImplementedError()
+
   @property
   def has_metadata(self):
     return self.use_appearance_id or self.use_warp_id or self.use_camera_id
@@ -322,20 +357,38 @@ class DataSource(abc.ABC):
       self,
       cameras: Union[Iterable[tfcam.TFCamera], Iterable[gpath.GPath]],
       flatten=False,
-      shuffle=False):
-    """Creates a tf.data.Dataset from a list of cameras."""
+      shuffle=False,
+      camera_batch_size=16):
+    """Creates a tf.data.Dataset from a list of cameras.
+
+    The rays of up to `camera_batch_size` consecutive cameras with the same
+    image size are generated at once with `camera.CameraBatch`.
+    """
     if isinstance(cameras[0], gpath.GPath) or isinstance(cameras[0], str):
       cameras = utils.parallel_map(self.load_camera, cameras)
 
     def _generator():
-      for camera in cameras:
-        yield {'camera_params': camera.get_parameters()}
+      for _, group in itertools.groupby(cameras, key=_image_shape):
+        group = list(group)
+        for i in range(0, len(group), camera_batch_size):
+          camera_batch = cam.CameraBatch.from_cameras(
+              group[i:i + camera_batch_size])
+          origins, directions, pixels = camera_batch.get_rays()
+          for j in range(len(camera_batch)):
+            yield {
+                'origins': origins[j],
+                'directions': directions[j],
+                'pixels': pixels,
+            }
 
     dataset = tf.data.Dataset.from_generator(
         _generator,
-        output_signature={'camera_params': _TF_CAMERA_PARAMS_SIGNATURE})
-    dataset = dataset.map(
-        functools.partial(_camera_to_rays_fn, use_tf_camera=True), _TF_AUTOTUNE)
+        output_signature={
+            'origins': tf.TensorSpec(shape=(None, None, 3), dtype=tf.float32),
+            'directions': tf.TensorSpec(
+                shape=(None, None, 3), dtype=tf.float32),
+            'pixels': tf.TensorSpec(shape=(None, None, 2), dtype=tf.float32),
+        })
 
     if flatten:
       # Unbatch images to rows.
@@ -371,6 +424,102 @@ class DataSource(abc.ABC):
                                  prefetch_size=prefetch_size,
                                  devices=devices)
 
+  def create_sampler_iterator(self,
+                              item_ids,
+                              batch_size: int,
+                              prefetch_size: int = 0,
+                              devices: Optional[Sequence[Any]] = None):
+    """Creates an iterator of random ray batches without using tf.data.
+
+    Args:
+      item_ids: the item IDs to sample rays from.
+      batch_size: the number of rays in each batch on this host.
+      prefetch_size: the number of batches to prefetch to device.
+      devices: the devices to shard and prefetch batches to.
+
+    Returns:
+      An iterator that returns data batches.
+    """
+    ray_sampler = self.create_ray_sampler(
+        item_ids, batch_size=batch_size, devices=devices)
+    return sampler.iterator_from_sampler(
+        ray_sampler, prefetch_size=prefetch_size, devices=devices)
+
+  def load_jax_cameras(self, item_ids):
+    """Loads the cameras of the given items as a batched `JaxCamera`.
+
+    With `device_rays` the `camera_index` of each ray sampled from
+    `load_flat_rays(item_ids)` indexes into these cameras.
+    """
+    cameras = utils.parallel_map(self.load_camera, item_ids)
+    return jax_camera.JaxCamera.from_cameras(cameras)
+
+  def create_ray_sampler(self,
+                         item_ids,
+                         batch_size: int,
+                         devices: Optional[Sequence[Any]] = None,
+                         use_importance_sampling: bool = False,
+                         **kwargs):
+    """Creates a ray sampler over the rays of the given items.
+
+    Args:
+      item_ids: the item IDs to sample rays from.
+      batch_size: the number of rays in each batch on this host.
+      devices: the devices to shard batches over.
+      use_importance_sampling: if True returns an `ImportanceRaySampler`.
+      **kwargs: extra arguments for the sampler.
+
+    Returns:
+      A `RaySampler` instance.
+    """
+    rays = self.load_flat_rays(item_ids)
+    num_devices = len(devices) if devices else jax.local_device_count()
+    seed = self.rng.randint(2 ** 31) + jax.process_index()
+    if use_importance_sampling:
+      cameras = utils.parallel_map(self.load_camera, item_ids)
+      return sampler.ImportanceRaySampler(
+          rays,
+          item_offsets=_item_offsets(cameras),
+          batch_size=batch_size,
+          seed=seed,
+          num_devices=num_devices,
+          **kwargs)
+    return sampler.RaySampler(
+        rays,
+        batch_size=batch_size,
+        seed=seed,
+        num_devices=num_devices,
+        **kwargs)
+
+  def create_streaming_sampler(self,
+                               item_ids,
+                               batch_size: int,
+                               devices: Optional[Sequence[Any]] = None,
+                               **kwargs):
+    """Creates a sampler which streams the given items into a reservoir.
+
+    Unlike `create_ray_sampler` this does not load all rays into memory.
+    Items are decoded by a process pool, see `streaming.StreamingRaySampler`.
+
+    Args:
+      item_ids: the item IDs to sample rays from.
+      batch_size: the number of rays in each batch on this host.
+      devices: the devices to shard batches over.
+      **kwargs: extra arguments for the sampler.
+
+    Returns:
+      A `StreamingRaySampler` instance.
+    """
+    num_devices = len(devices) if devices else jax.local_device_count()
+    seed = self.rng.randint(2 ** 31) + jax.process_index()
+    return streaming.StreamingRaySampler(
+        self,
+        item_ids,
+        batch_size=batch_size,
+        seed=seed,
+        num_devices=num_devices,
+        **kwargs)
+
   def create_dataset(self,
                      item_ids,
                      flatten=False,
@@ -404,6 +553,10 @@ class DataSource(abc.ABC):
     Returns:
       A tf.data.Dataset instance.
     """
+    if self.ray_cache_dir and flatten:
+      return self._create_cached_rays_dataset(
+          self.load_cached_rays(item_ids), shuffle=shuffle)
+
     load_fn = functools.partial(self.get_item)
     data_list = utils.parallel_map(load_fn, item_ids)
     data_list = [_camera_to_rays_fn(item) for item in data_list]
@@ -446,6 +599,170 @@ class DataSource(abc.ABC):
 
     return tf.data.Dataset.from_tensor_slices(out_dict)
 
+  def _create_cached_rays_dataset(self, rays, shuffle=False,
+                                  block_size=65536):
+    """Creates a dataset which reads the rays from the ray cache.
+
+    The rays are gathered from the memory maps in blocks of `block_size` so
+    the cache is never copied into memory as a whole. When shuffling, the
+    blocks are taken from a permutation which is redrawn every epoch. The
+    indices of each block are sorted for the read and the rays are put back
+    into shuffled order afterwards.
+
+    Args:
+      rays: a (nested) dictionary of (num_rays, ...) arrays, e.g. from
+        `load_cached_rays`.
+      shuffle: whether to shuffle the rays.
+      block_size: the number of rays gathered at once.
+
+    Returns:
+      A tf.data.Dataset of single rays.
+    """
+    num_rays = jax.tree_leaves(rays)[0].shape[0]
+    rng = np.random.RandomState(self.rng.randint(2 ** 31))
+
+    def _generator():
+      if shuffle:
+        indices = rng.permutation(num_rays)
+      for start in range(0, num_rays, block_size):
+        if not shuffle:
+          end = min(start + block_size, num_rays)
+          yield jax.tree_map(lambda x: np.asarray(x[start:end]), rays)  # pylint: disable=cell-var-from-loop
+          continue
+        block = indices[start:start + block_size]
+        order = np.argsort(block)
+        sorted_block = block[order]
+
+        def _gather(x):
+          out = np.empty((len(block), *x.shape[1:]), x.dtype)
+          out[order] = x[sorted_block]  # pylint: disable=cell-var-from-loop
+          return out
+
+        yield jax.tree_map(_gather, rays)
+
+    output_signature = jax.tree_map(
+        lambda x: tf.TensorSpec(shape=(None, *x.shape[1:]),
+                                dtype=tf.as_dtype(x.dtype)),
+        rays)
+    dataset = tf.data.Dataset.from_generator(
+        _generator, output_signature=output_signature)
+    return dataset.unbatch()
+
+  def load_cached_rays(self, item_ids):
+    """Loads the flattened rays of the given items from the ray cache.
+
+    The cache is keyed by `cache_id`, the item IDs, the camera parameters and
+    the enabled metadata. It is written on first use and subsequently opened
+    as read-only memory maps.
+
+    Args:
+      item_ids: the item IDs to load the rays for.
+
+    Returns:
+      A dictionary of (num_rays, ...) arrays with the same structure as a
+      flattened preloaded dataset.
+    """
+    cameras = utils.parallel_map(self.load_camera, item_ids)
+    key = ray_cache.compute_key(
+        self.cache_id, list(item_ids), ray_cache.camera_hash(cameras),
+        self.use_appearance_id, self.use_camera_id, self.use_warp_id,
+        self.use_time, self.use_depth, self.device_rays)
+    cache_dir = os.path.join(self.ray_cache_dir, key)
+    if not ray_cache.is_complete(cache_dir):
+      logging.info('*** Writing ray cache to %s', cache_dir)
+      self._write_ray_cache(cache_dir, item_ids, cameras)
+    return ray_cache.load(cache_dir)
+
+  def load_flat_rays(self, item_ids):
+    """Loads the rays of the given items into contiguous (num_rays, ...) arrays.
+
+    The rays are read from the ray cache if `ray_cache_dir` is set and are
+    otherwise decoded into memory.
+
+    Args:
+      item_ids: the item IDs to load the rays for.
+
+    Returns:
+      A dictionary of (num_rays, ...) arrays. See `load_cached_rays`.
+    """
+    if self.ray_cache_dir:
+      return self.load_cached_rays(item_ids)
+    cameras = utils.parallel_map(self.load_camera, item_ids)
+    offsets = _item_offsets(cameras)
+    arrays = {
+        key: np.empty((int(offsets[-1]), *shape), dtype)
+        for key, (shape, dtype) in self._ray_specs().items()
+    }
+    self._fill_rays(arrays, item_ids, offsets)
+    return ray_cache.unflatten(arrays)
+
+  def _ray_specs(self):
+    """Returns the per-ray shape and dtype of each flattened ray attribute."""
+    specs = {
+        'rgb': ((3,), np.float32),
+        'pixels': ((2,), np.float32),
+    }
+    if self.device_rays:
+      # Rays are generated on device from the pixels, see `load_jax_cameras`.
+      specs['camera_index'] = ((1,), np.int32)
+    else:
+      specs['origins'] = ((3,), np.float32)
+      specs['directions'] = ((3,), np.float32)
+    if self.use_depth:
+      specs['depth'] = ((1,), np.float32)
+    if self.use_appearance_id:
+      specs['metadata.appearance'] = ((1,), np.uint32)
+    if self.use_camera_id:
+      specs['metadata.camera'] = ((1,), np.uint32)
+    if self.use_warp_id:
+      specs['metadata.warp'] = ((1,), np.uint32)
+    if self.use_time:
+      specs['metadata.time'] = ((1,), np.float32)
+    return specs
+
+  def _write_item_rays(self, arrays, item_id, item_index, start, end):
+    """Decodes an item and writes its rays into `arrays[start:end]`.
+
+    Args:
+      arrays: a dictionary of flattened ray arrays, see `_ray_specs`.
+      item_id: the ID of the item to decode.
+      item_index: the index of the item, stored as the `camera_index`.
+      start: the offset of the first ray of the item.
+      end: the offset after the last ray of the item.
+    """
+    item = self.get_item(item_id)
+    if self.device_rays:
+      camera = cam.Camera(**item.pop('camera_params'))
+      item['pixels'] = camera.get_pixel_centers()
+    else:
+      item = _camera_to_rays_fn(item)
+    for key, array in arrays.items():
+      if key == 'camera_index':
+        array[start:end] = item_index
+      elif key.startswith('metadata.'):
+        # Metadata is constant per item so there is no need to broadcast it.
+        array[start:end] = item['metadata'][key[len('metadata.'):]]
+      else:
+        array[start:end] = np.reshape(item[key], (end - start, -1))
+
+  def _fill_rays(self, arrays, item_ids, offsets):
+    """Decodes the given items and writes their rays into `arrays`."""
+
+    def _write_item(i):
+      self._write_item_rays(
+          arrays, item_ids[i], i, offsets[i], offsets[i + 1])
+
+    utils.parallel_map(_write_item, range(len(item_ids)))
+
+  def _write_ray_cache(self, cache_dir, item_ids, cameras):
+    """Decodes the given items and writes their rays to the ray cache."""
+    offsets = _item_offsets(cameras)
+    tmp_dir, arrays = ray_cache.create(
+        cache_dir, int(offsets[-1]), self._ray_specs())
+    self._fill_rays(arrays, item_ids, offsets)
+    item_shapes = [_image_shape(camera) for camera in cameras]
+    ray_cache.finalize(tmp_dir, cache_dir, arrays, item_ids, item_shapes)
+
   def _create_lazy_dataset(self,
                            item_ids,
                            flatten=False,
@@ -121,6 +121,10 @@ class NerfiesDataSource(core.DataSource):
   def far(self):
     return self._far
 
+  @property
+  def cache_id(self):
+    return f'{self.data_dir}@{self.image_scale}x'
+
   @property
   def camera_ext(self):
     if self.camera_type == 'json':
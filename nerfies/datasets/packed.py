@@ -0,0 +1,355 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A single-file scene format and a data source which reads it.
+
+A packed scene stores everything a `NerfiesDataSource` reads from many small
+files in one file:
+
+  [array data][JSON index][index offset][index length][magic]
+
+Arrays are stored raw and aligned so that they can be memory mapped. The
+index maps each array name to its offset, shape and dtype and also contains
+the scene info, dataset IDs and per-item metadata. The index is written last
+so that scenes can be packed in a single sequential pass.
+
+Array names:
+  `rgb/{scale}x/{item_id}`: the decoded (H, W, 3) uint8 image of an item.
+  `camera/{param}`: the stacked parameters of the item cameras, in the order
+    of the `item_ids` in the index. These are unscaled and in the original
+    (not scene) coordinates, as in the camera JSON files.
+  `camera_paths/{name}/{param}`: the stacked test camera parameters.
+  `points`: the optional point cloud of the scene.
+"""
+import json
+import os
+import struct
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from absl import logging
+import cv2
+import numpy as np
+
+from nerfies import camera as cam
+from nerfies import gpath
+from nerfies import types
+from nerfies import utils
+from nerfies.datasets import core
+
+PACKED_VERSION = 1
+_MAGIC = b'NRFPACK1'
+_TRAILER = struct.Struct('<QQ8s')
+_ALIGNMENT = 64
+
+
+class PackedSceneWriter:
+  """Writes a packed scene sequentially."""
+
+  def __init__(self, path: types.PathType):
+    self.path = gpath.GPath(path)
+    self._file = self.path.open('wb')
+    self._offset = 0
+    self._arrays = {}
+
+  def _write(self, data: bytes):
+    self._file.write(data)
+    self._offset += len(data)
+
+  def add_array(self, name: str, array: np.ndarray):
+    """Appends an array to the file."""
+    if name in self._arrays:
+      raise ValueError(f'Array {name!r} was already written.')
+    array = np.ascontiguousarray(array)
+    padding = -self._offset % _ALIGNMENT
+    self._write(b'\0' * padding)
+    self._arrays[name] = {
+        'offset': self._offset,
+        'shape': list(array.shape),
+        'dtype': array.dtype.str,
+    }
+    self._write(array.tobytes())
+
+  def add_cameras(self, prefix: str, cameras: Sequence[cam.Camera]):
+    """Appends a table of camera parameters."""
+    camera_batch = cam.CameraBatch.from_cameras(cameras)
+    for key, value in camera_batch.get_parameters().items():
+      self.add_array(f'{prefix}/{key}', value)
+
+  def close(self, info: Dict[str, Any]):
+    """Writes the index and closes the file.
+
+    Args:
+      info: JSON serializable scene information stored in the index.
+    """
+    index = json.dumps({
+        'version': PACKED_VERSION,
+        'arrays': self._arrays,
+        'info': info,
+    }).encode('utf-8')
+    index_offset = self._offset
+    self._write(index)
+    self._write(_TRAILER.pack(index_offset, len(index), _MAGIC))
+    self._file.close()
+
+
+class PackedScene:
+  """Random access to the arrays of a packed scene.
+
+  Local files are memory mapped once per process and arrays are views into
+  that single mapping. Other files (e.g., on GCS) are read with a ranged read
+  per array. Only the path and the index are pickled so that the scene can be
+  sent to worker processes cheaply; the mapping is reopened lazily there.
+  """
+
+  def __init__(self, path: types.PathType):
+    self.path = gpath.GPath(path)
+    self.is_local = os.path.exists(str(self.path))
+    self._lock = threading.Lock()
+    self._file = None
+    self._mmap = None
+    with self.path.open('rb') as f:
+      f.seek(-_TRAILER.size, os.SEEK_END)
+      index_offset, index_length, magic = _TRAILER.unpack(
+          f.read(_TRAILER.size))
+      if magic != _MAGIC:
+        raise ValueError(f'{self.path} is not a packed scene.')
+      f.seek(index_offset)
+      index = json.loads(f.read(index_length).decode('utf-8'))
+    if index['version'] != PACKED_VERSION:
+      raise ValueError(f'Unsupported packed scene version {index["version"]}.')
+    self.arrays = index['arrays']
+    self.info = index['info']
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_file'] = None
+    state['_mmap'] = None
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def __contains__(self, name: str):
+    return name in self.arrays
+
+  def _get_mmap(self) -> np.ndarray:
+    """Returns the read-only memory map of the whole file."""
+    if self._mmap is None:
+      with self._lock:
+        if self._mmap is None:
+          self._mmap = np.memmap(str(self.path), dtype=np.uint8, mode='r')
+    return self._mmap
+
+  def read(self, name: str) -> np.ndarray:
+    """Returns an array, a read-only view of the memory map for local files."""
+    spec = self.arrays[name]
+    shape = tuple(spec['shape'])
+    dtype = np.dtype(spec['dtype'])
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if self.is_local:
+      # The arrays are aligned in the file so the views are aligned too.
+      offset = spec['offset']
+      data = self._get_mmap()[offset:offset + nbytes]
+      return data.view(dtype).reshape(shape)
+    with self._lock:
+      if self._file is None:
+        self._file = self.path.open('rb')
+      self._file.seek(spec['offset'])
+      data = self._file.read(nbytes)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+  def read_cameras(self, prefix: str) -> cam.CameraBatch:
+    """Reads a table of camera parameters."""
+    params = {
+        key: np.asarray(self.read(f'{prefix}/{key}'))
+        for key in ('orientation', 'position', 'focal_length',
+                    'principal_point', 'skew', 'pixel_aspect_ratio',
+                    'radial_distortion', 'tangential_distortion', 'image_size')
+    }
+    return cam.CameraBatch(**params)
+
+
+def _load_image_uint8(path: types.PathType) -> np.ndarray:
+  with gpath.GPath(path).open('rb') as f:
+    raw_im = np.asarray(bytearray(f.read()), dtype=np.uint8)
+  return cv2.imdecode(raw_im, cv2.IMREAD_COLOR)[:, :, ::-1]  # BGR -> RGB
+
+
+def _load_json(path: gpath.GPath):
+  with path.open('r') as f:
+    return json.load(f)
+
+
+def pack_nerfies_scene(data_dir: types.PathType,
+                       output_path: types.PathType,
+                       image_scales: Sequence[int] = (1,),
+                       camera_paths: Optional[Sequence[str]] = None):
+  """Packs a scene in the `NerfiesDataSource` layout into a single file.
+
+  Args:
+    data_dir: the directory of the scene.
+    output_path: the path of the packed scene.
+    image_scales: the image scales to pack e.g., 4 packs `rgb/4x`.
+    camera_paths: the names of the test camera paths to pack, or None to pack
+      all of them.
+  """
+  data_dir = gpath.GPath(data_dir)
+  dataset_json = _load_json(data_dir / 'dataset.json')
+  train_ids = [str(i) for i in dataset_json['train_ids']]
+  val_ids = [str(i) for i in dataset_json['val_ids']]
+  item_ids = list(dict.fromkeys(train_ids + val_ids))
+  metadata_path = data_dir / 'metadata.json'
+  info = {
+      'scene': _load_json(data_dir / 'scene.json'),
+      'train_ids': train_ids,
+      'val_ids': val_ids,
+      'item_ids': item_ids,
+      'metadata': (_load_json(metadata_path)
+                   if metadata_path.exists() else None),
+      'image_scales': list(image_scales),
+      'camera_paths': [],
+  }
+
+  writer = PackedSceneWriter(output_path)
+  cameras = utils.parallel_map(
+      lambda i: cam.Camera.from_json(data_dir / 'camera' / f'{i}.json'),
+      item_ids)
+  writer.add_cameras('camera', cameras)
+
+  for scale in image_scales:
+    rgb_dir = data_dir / 'rgb' / f'{scale}x'
+    # Decode a few images ahead while writing sequentially.
+    for start in range(0, len(item_ids), 64):
+      chunk_ids = item_ids[start:start + 64]
+      images = utils.parallel_map(
+          lambda i: _load_image_uint8(rgb_dir / f'{i}.png'), chunk_ids)  # pylint: disable=cell-var-from-loop
+      for item_id, image in zip(chunk_ids, images):
+        writer.add_array(f'rgb/{scale}x/{item_id}', image)
+    logging.info('Packed %d images at scale %dx.', len(item_ids), scale)
+
+  camera_paths_dir = data_dir / 'camera-paths'
+  if camera_paths is None:
+    camera_paths = ([p.name for p in sorted(camera_paths_dir.iterdir())]
+                    if camera_paths_dir.exists() else [])
+  for name in camera_paths:
+    paths = sorted((camera_paths_dir / name).glob('*.json'))
+    if not paths:
+      continue
+    path_cameras = utils.parallel_map(cam.Camera.from_json, paths)
+    writer.add_cameras(f'camera_paths/{name}', path_cameras)
+    info['camera_paths'].append(name)
+
+  points_path = data_dir / 'points.npy'
+  if points_path.exists():
+    with points_path.open('rb') as f:
+      writer.add_array('points', np.load(f))
+
+  writer.close(info)
+  logging.info('Packed %d items into %s.', len(item_ids), output_path)
+
+
+class PackedDataSource(core.DataSource):
+  """Data source for scenes packed with `pack_nerfies_scene`."""
+
+  def __init__(
+      self,
+      data_path,
+      image_scale: int,
+      test_camera_trajectory='orbit-extreme',
+      **kwargs):
+    self.data_path = gpath.GPath(data_path)
+    self.scene = PackedScene(data_path)
+    info = self.scene.info
+    if image_scale not in info['image_scales']:
+      raise ValueError(f'Image scale {image_scale} is not packed in '
+                       f'{self.data_path}, available: {info["image_scales"]}')
+    super().__init__(train_ids=info['train_ids'], val_ids=info['val_ids'],
+                     **kwargs)
+    scene = info['scene']
+    self.scene_center = np.array(scene['center'])
+    self.scene_scale = scene['scale']
+    self._near = scene['near']
+    self._far = scene['far']
+    self.test_camera_trajectory = test_camera_trajectory
+    self.image_scale = image_scale
+    self.metadata_dict = info['metadata']
+    self._item_index = {
+        item_id: i for i, item_id in enumerate(info['item_ids'])}
+    self._cameras = self.scene.read_cameras('camera')
+
+  @property
+  def near(self):
+    return self._near
+
+  @property
+  def far(self):
+    return self._far
+
+  @property
+  def cache_id(self):
+    return f'{self.data_path}@{self.image_scale}x'
+
+  def load_rgb(self, item_id):
+    image = self.scene.read(f'rgb/{self.image_scale}x/{item_id}')
+    return np.asarray(image).astype(np.float32) / 255.0
+
+  def _transform_camera(self, camera, scale_factor=1.0):
+    return core.transform_camera(camera,
+                                 scale_factor=scale_factor / self.image_scale,
+                                 scene_center=self.scene_center,
+                                 scene_scale=self.scene_scale)
+
+  def load_camera(self, item_id, scale_factor=1.0):
+    camera = self._cameras[self._item_index[item_id]]
+    return self._transform_camera(camera, scale_factor)
+
+  def load_test_cameras(self, count=None):
+    name = self.test_camera_trajectory
+    if name not in self.scene.info['camera_paths']:
+      logging.warning('test camera path %s is not packed in %s', name,
+                      self.data_path)
+      return []
+    cameras = self.scene.read_cameras(f'camera_paths/{name}').to_cameras()
+    cameras = utils.strided_subset(cameras, count)
+    return [self._transform_camera(camera) for camera in cameras]
+
+  def load_points(self, shuffle=False):
+    points = np.asarray(self.scene.read('points'))
+    points = (points - self.scene_center) * self.scene_scale
+    points = points.astype(np.float32)
+    if shuffle:
+      logging.info('Shuffling points.')
+      shuffled_inds = self.rng.permutation(len(points))
+      points = points[shuffled_inds]
+    logging.info('Loaded %d points.', len(points))
+    return points
+
+  def get_appearance_id(self, item_id):
+    return self.metadata_dict[item_id]['appearance_id']
+
+  def get_camera_id(self, item_id):
+    return self.metadata_dict[item_id]['camera_id']
+
+  def get_warp_id(self, item_id):
+    return self.metadata_dict[item_id]['warp_id']
+
+  def get_time_id(self, item_id):
+    if 'time_id' in self.metadata_dict[item_id]:
+      return self.metadata_dict[item_id]['time_id']
+    else:
+      # Fallback for older datasets.
+      return self.metadata_dict[item_id]['warp_id']
@@ -0,0 +1,154 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An on-disk cache of decoded, flattened rays.
+
+Each cache is a directory containing one `.npy` file per ray attribute (e.g.,
+`rgb.npy`, `origins.npy`, `metadata.warp.npy`) with one row per ray, plus a
+`manifest.json` which is written last and marks the cache as complete. The
+arrays are opened as read-only memory maps so that restarts do not need to
+decode any images and concurrent processes share the same pages.
+
+Memory maps require a local filesystem so the cache directory must be local.
+"""
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Dict, Mapping, Sequence, Tuple
+
+from absl import logging
+import numpy as np
+
+from nerfies import types
+
+# Bump this when the layout of the cache changes.
+CACHE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def camera_hash(cameras) -> str:
+  """Computes a hash of the parameters of a list of cameras."""
+  hasher = hashlib.sha1()
+  for camera in cameras:
+    params = camera.get_parameters()
+    for key in sorted(params.keys()):
+      hasher.update(key.encode('utf-8'))
+      hasher.update(np.asarray(params[key], np.float64).tobytes())
+  return hasher.hexdigest()
+
+
+def compute_key(*parts: Any) -> str:
+  """Computes a cache key from a sequence of JSON serializable parts."""
+  hasher = hashlib.sha1()
+  hasher.update(json.dumps([CACHE_VERSION, *parts]).encode('utf-8'))
+  return hasher.hexdigest()
+
+
+def is_complete(cache_dir: types.PathType) -> bool:
+  """Returns True if the cache exists and was completely written."""
+  return os.path.exists(os.path.join(cache_dir, MANIFEST_NAME))
+
+
+def create(cache_dir: types.PathType,
+           num_rays: int,
+           specs: Mapping[str, Tuple[Tuple[int, ...], Any]]):
+  """Creates writable memory maps for a new cache.
+
+  The arrays are written into a temporary directory next to `cache_dir`
+  which is moved in place by `finalize`.
+
+  Args:
+    cache_dir: the directory of the cache.
+    num_rays: the total number of rays.
+    specs: a mapping from flattened keys (e.g., `metadata.warp`) to the shape
+      of each ray's entry and its dtype.
+
+  Returns:
+    tmp_dir: the temporary directory the arrays are written to.
+    arrays: a dictionary of writable memory maps with shape (num_rays, ...).
+  """
+  cache_dir = os.fspath(cache_dir)
+  tmp_dir = f'{cache_dir}.tmp-{os.getpid()}'
+  if os.path.exists(tmp_dir):
+    shutil.rmtree(tmp_dir)
+  os.makedirs(tmp_dir)
+  arrays = {}
+  for key, (shape, dtype) in specs.items():
+    arrays[key] = np.lib.format.open_memmap(
+        os.path.join(tmp_dir, f'{key}.npy'),
+        mode='w+',
+        dtype=dtype,
+        shape=(num_rays, *shape))
+  return tmp_dir, arrays
+
+
+def finalize(tmp_dir: str,
+             cache_dir: types.PathType,
+             arrays: Dict[str, np.memmap],
+             item_ids: Sequence[str],
+             item_shapes: Sequence[Tuple[int, int]]):
+  """Flushes the arrays and atomically moves the cache into place."""
+  cache_dir = os.fspath(cache_dir)
+  for array in arrays.values():
+    array.flush()
+  manifest = {
+      'version': CACHE_VERSION,
+      'keys': sorted(arrays.keys()),
+      'num_rays': int(next(iter(arrays.values())).shape[0]),
+      'item_ids': list(item_ids),
+      'item_shapes': [list(s) for s in item_shapes],
+  }
+  with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as f:
+    json.dump(manifest, f)
+  try:
+    os.rename(tmp_dir, cache_dir)
+  except OSError:
+    # Another process finished writing the same cache first.
+    logging.info('Ray cache %s already exists, discarding ours.', cache_dir)
+    shutil.rmtree(tmp_dir)
+
+
+def load(cache_dir: types.PathType) -> Dict[str, Any]:
+  """Opens a cache as read-only memory maps.
+
+  Args:
+    cache_dir: the directory of the cache.
+
+  Returns:
+    A nested dictionary of (num_rays, ...) memory maps e.g.,
+    `{'rgb': ..., 'metadata': {'warp': ...}}`.
+  """
+  cache_dir = os.fspath(cache_dir)
+  with open(os.path.join(cache_dir, MANIFEST_NAME), 'r') as f:
+    manifest = json.load(f)
+  arrays = {
+      key: np.load(os.path.join(cache_dir, f'{key}.npy'), mmap_mode='r')
+      for key in manifest['keys']
+  }
+  logging.info('Loaded ray cache %s with %d rays.', cache_dir,
+               manifest['num_rays'])
+  return unflatten(arrays)
+
+
+def unflatten(arrays: Mapping[str, Any]) -> Dict[str, Any]:
+  """Nests flattened keys e.g., `metadata.warp` -> `{'metadata': {'warp'}}`."""
+  out = {}
+  for key, array in arrays.items():
+    *parents, name = key.split('.')
+    node = out
+    for parent in parents:
+      node = node.setdefault(parent, {})
+    node[name] = array
+  return out
@@ -0,0 +1,245 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A NumPy ray batch sampler which does not go through tf.data."""
+import queue
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from flax import jax_utils
+import jax
+import numpy as np
+
+
+class _WorkerError:
+  """Wraps an exception raised by the sampling thread."""
+
+  def __init__(self, error: Exception):
+    self.error = error
+
+
+class RaySampler:
+  """Samples random batches of rays from a contiguous ray store.
+
+  Ray indices are drawn uniformly with replacement so no permutation of the
+  full ray set is ever materialized. The indices of each batch are sorted
+  before gathering which keeps reads from a memory-mapped store mostly
+  sequential. Batches are gathered on a background thread so that the
+  training loop only has to pop them from a queue.
+
+  Batches are gathered into a ring of preallocated buffers rather than fresh
+  arrays. The ring holds every batch which can be alive at once: the queued
+  batches, the one being gathered, the one being consumed and the ones
+  prefetched to device (see `reserve_buffers`). A batch is therefore only
+  valid until that many more batches have been gathered.
+  """
+
+  def __init__(self,
+               rays: Dict[str, Any],
+               batch_size: int,
+               seed: int = 0,
+               num_devices: Optional[int] = None,
+               queue_size: int = 4):
+    """Constructor.
+
+    Args:
+      rays: a (nested) dictionary of (num_rays, ...) arrays, e.g. from
+        `DataSource.load_flat_rays`.
+      batch_size: the number of rays in each batch drawn by this host.
+      seed: the random seed. This should differ between hosts.
+      num_devices: the number of local devices to shard each batch over.
+      queue_size: the number of batches gathered ahead of time.
+    """
+    if num_devices is None:
+      num_devices = jax.local_device_count()
+    if batch_size % num_devices != 0:
+      raise ValueError(f'Batch size {batch_size} must be divisible by the '
+                       f'number of devices {num_devices}.')
+    self.rays = rays
+    self.batch_size = batch_size
+    self.num_devices = num_devices
+    self.num_rays = jax.tree_leaves(rays)[0].shape[0]
+    self.rng = np.random.default_rng(seed)
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._thread = None
+    self._num_buffers = queue_size + 2
+    self._buffers = None
+    self._next_buffer = 0
+
+  def reserve_buffers(self, num_batches: int):
+    """Keeps `num_batches` more batches alive, e.g. while prefetched."""
+    if self._buffers is not None:
+      raise RuntimeError('Buffers must be reserved before the first batch.')
+    self._num_buffers += num_batches
+
+  def _get_buffers(self):
+    """Returns the next (batch_size, ...) buffers of the ring."""
+    if self._buffers is None:
+      self._buffers = [
+          jax.tree_map(
+              lambda x: np.empty((self.batch_size,) + x.shape[1:], x.dtype),
+              self.rays)
+          for _ in range(self._num_buffers)
+      ]
+    buffers = self._buffers[self._next_buffer]
+    self._next_buffer = (self._next_buffer + 1) % self._num_buffers
+    return buffers
+
+  def sample_indices(self) -> np.ndarray:
+    """Draws the ray indices of the next batch."""
+    indices = self.rng.integers(0, self.num_rays, size=self.batch_size)
+    indices.sort()
+    return indices
+
+  def gather(self, indices: np.ndarray) -> Dict[str, Any]:
+    """Gathers a batch sharded into (num_devices, batch_size // D, ...).
+
+    The batch is a view of the next buffers of the ring, see the class
+    docstring for how long it stays valid.
+    """
+
+    def _gather(x, out):
+      # The indices are in range; mode='clip' avoids an intermediate copy
+      # which NumPy makes for `out` with the default mode='raise'.
+      np.take(x, indices, axis=0, out=out, mode='clip')
+      return out.reshape((self.num_devices, -1) + out.shape[1:])
+
+    return jax.tree_map(_gather, self.rays, self._get_buffers())
+
+  def sample(self) -> Dict[str, Any]:
+    """Draws and gathers the next batch."""
+    return self.gather(self.sample_indices())
+
+  def _worker(self):
+    while True:
+      try:
+        batch = self.sample()
+      except Exception as e:  # pylint: disable=broad-except
+        # Hand the error to the consumer, which would otherwise block forever.
+        self._queue.put(_WorkerError(e))
+        return
+      self._queue.put(batch)
+
+  def __iter__(self):
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._worker, daemon=True)
+      self._thread.start()
+    return self
+
+  def __next__(self):
+    batch = self._queue.get()
+    if isinstance(batch, _WorkerError):
+      # Keep raising on later calls since the worker has stopped.
+      self._queue.put(batch)
+      raise batch.error
+    return batch
+
+
+class ImportanceRaySampler(RaySampler):
+  """Samples more rays from images with a high photometric error.
+
+  A running mean of the error of each image is updated from the per-ray
+  errors of the training step (see `update`). Images are drawn with a
+  probability proportional to their number of rays times their error, mixed
+  with uniform sampling, and rays are drawn uniformly within each image.
+  Each batch contains `loss_weights` which correct the loss for the
+  non-uniform sampling, and the `item_index` of each ray.
+  """
+
+  def __init__(self,
+               rays: Dict[str, Any],
+               item_offsets: Sequence[int],
+               batch_size: int,
+               seed: int = 0,
+               num_devices: Optional[int] = None,
+               queue_size: int = 4,
+               uniform_fraction: float = 0.5,
+               error_decay: float = 0.9):
+    """Constructor.
+
+    Args:
+      rays: a (nested) dictionary of (num_rays, ...) arrays.
+      item_offsets: (num_items + 1,) the offset of the rays of each image.
+      batch_size: the number of rays in each batch drawn by this host.
+      seed: the random seed. This should differ between hosts.
+      num_devices: the number of local devices to shard each batch over.
+      queue_size: the number of batches gathered ahead of time.
+      uniform_fraction: the fraction of the sampling distribution which is
+        uniform over all rays. This keeps every ray reachable.
+      error_decay: the decay of the running mean error of each image.
+    """
+    super().__init__(rays, batch_size, seed=seed, num_devices=num_devices,
+                     queue_size=queue_size)
+    self.item_offsets = np.asarray(item_offsets, np.int64)
+    self.item_sizes = np.diff(self.item_offsets)
+    self.uniform_fraction = uniform_fraction
+    self.error_decay = error_decay
+    # NaN marks images which have not been observed yet.
+    self.errors = np.full(len(self.item_sizes), np.nan)
+    self._probs = self._compute_probs()
+
+  def _compute_probs(self):
+    errors = self.errors
+    if np.all(np.isnan(errors)):
+      errors = np.ones_like(errors)
+    else:
+      # Unobserved images get the largest error so they are visited soon.
+      errors = np.where(np.isnan(errors), np.nanmax(errors), errors)
+    uniform = self.item_sizes / self.item_sizes.sum()
+    mass = uniform * np.maximum(errors, 1e-8)
+    return ((1.0 - self.uniform_fraction) * mass / mass.sum()
+            + self.uniform_fraction * uniform)
+
+  def sample(self) -> Dict[str, Any]:
+    probs = self._probs
+    items = self.rng.choice(len(probs), size=self.batch_size, p=probs)
+    indices = self.item_offsets[items] + self.rng.integers(
+        0, self.item_sizes[items])
+    order = np.argsort(indices)
+    indices = indices[order]
+    items = items[order]
+
+    batch = self.gather(indices)
+    # Ratio of the uniform ray probability to the sampled ray probability.
+    weights = (self.item_sizes[items] / self.num_rays) / probs[items]
+    shape = (self.num_devices, -1)
+    batch['loss_weights'] = weights.astype(np.float32).reshape(shape)
+    batch['item_index'] = items.astype(np.int32).reshape(shape)
+    return batch
+
+  def update(self, item_index: np.ndarray, error: np.ndarray):
+    """Updates the running error of each image from per-ray errors."""
+    item_index = np.asarray(item_index).reshape(-1)
+    error = np.asarray(error, np.float64).reshape(-1)
+    num_items = len(self.item_sizes)
+    sums = np.bincount(item_index, weights=error, minlength=num_items)
+    counts = np.bincount(item_index, minlength=num_items)
+    seen = counts > 0
+    batch_errors = sums[seen] / counts[seen]
+    prev_errors = self.errors[seen]
+    self.errors[seen] = np.where(
+        np.isnan(prev_errors), batch_errors,
+        self.error_decay * prev_errors + (1.0 - self.error_decay) * batch_errors)
+    self._probs = self._compute_probs()
+
+
+def iterator_from_sampler(sampler: RaySampler,
+                          prefetch_size: int = 0,
+                          devices: Optional[Sequence[Any]] = None):
+  """Creates an iterator which prefetches sampled batches to device."""
+  sampler.reserve_buffers(prefetch_size)
+  it = iter(sampler)
+  if prefetch_size > 0:
+    it = jax_utils.prefetch_to_device(it, prefetch_size, devices)
+  return it
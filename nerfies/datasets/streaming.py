@@ -0,0 +1,259 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A ray sampler which streams images decoded by a process pool.
+
+This is meant for scenes whose rays do not fit in memory. Worker processes
+decode images and build their rays into shared memory, which avoids both the
+GIL and pickling the decoded arrays. The rays are then inserted into a
+fixed-size shuffle reservoir from which batches are sampled uniformly. Once
+the reservoir is full new rays overwrite random slots so the reservoir always
+contains a mix of many images.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+from typing import Optional, Sequence
+
+from absl import logging
+import numpy as np
+
+from nerfies import camera as cam
+from nerfies.datasets import ray_cache
+from nerfies.datasets import sampler
+
+# The data source used by the worker processes. See `_init_worker`.
+_WORKER_DATASOURCE = None
+_ALIGNMENT = 64
+
+
+def _init_worker(datasource):
+  global _WORKER_DATASOURCE
+  _WORKER_DATASOURCE = datasource
+  # Spawned workers start with the default undistortion cache, so the
+  # configuration of the data source is applied again.
+  if datasource.undistortion_cache_dir:
+    cam.configure_undistortion_cache(
+        cache_dir=datasource.undistortion_cache_dir)
+
+
+def _array_views(buffer, num_rays, layout):
+  """Creates (num_rays, ...) views of the arrays in a shared memory buffer."""
+  return {
+      key: np.ndarray((num_rays, *shape), dtype=np.dtype(dtype),
+                      buffer=buffer, offset=offset)
+      for key, (offset, shape, dtype) in layout.items()
+  }
+
+
+def _load_item(item_index, item_id):
+  """Decodes an item into a new shared memory block.
+
+  Args:
+    item_index: the index of the item in the sampled item IDs.
+    item_id: the ID of the item.
+
+  Returns:
+    The name of the shared memory block, the number of rays and the layout of
+    the arrays in the block. The caller is responsible for unlinking the
+    block.
+  """
+  datasource = _WORKER_DATASOURCE
+  camera = datasource.load_camera(item_id)
+  height, width = (int(x) for x in camera.image_shape)
+  num_rays = height * width
+  layout = {}
+  size = 0
+  for key, (shape, dtype) in datasource._ray_specs().items():  # pylint: disable=protected-access
+    dtype = np.dtype(dtype)
+    layout[key] = (size, tuple(shape), dtype.str)
+    nbytes = num_rays * int(np.prod(shape)) * dtype.itemsize
+    size += -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+  shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+  try:
+    arrays = _array_views(shm.buf, num_rays, layout)
+    datasource._write_item_rays(arrays, item_id, item_index, 0, num_rays)  # pylint: disable=protected-access
+    del arrays
+  except Exception:
+    shm.close()
+    shm.unlink()
+    raise
+  shm.close()
+  return shm.name, num_rays, layout
+
+
+class StreamingRaySampler(sampler.RaySampler):
+  """Samples ray batches from a reservoir filled by a process pool.
+
+  Items are decoded in a shuffled order which is redrawn every epoch. At most
+  `max_pending_items` decoded items wait in shared memory at any time, which
+  bounds the memory used on top of the reservoir.
+  """
+
+  def __init__(self,
+               datasource,
+               item_ids: Sequence[str],
+               batch_size: int,
+               reservoir_size: int = 2 ** 22,
+               num_workers: Optional[int] = None,
+               min_fill_fraction: float = 0.25,
+               seed: int = 0,
+               num_devices: Optional[int] = None,
+               queue_size: int = 4):
+    """Constructor.
+
+    Args:
+      datasource: the data source to decode items with. This is pickled to
+        each worker process.
+      item_ids: the item IDs to sample rays from.
+      batch_size: the number of rays in each batch drawn by this host.
+      reservoir_size: the maximum number of rays held in memory.
+      num_workers: the number of worker processes. Defaults to the number of
+        CPUs.
+      min_fill_fraction: the fraction of the reservoir which must be filled
+        before the first batch is sampled.
+      seed: the random seed. This should differ between hosts.
+      num_devices: the number of local devices to shard each batch over.
+      queue_size: the number of batches gathered ahead of time.
+    """
+    specs = datasource._ray_specs()  # pylint: disable=protected-access
+    reservoir = ray_cache.unflatten({
+        key: np.zeros((reservoir_size, *shape), dtype)
+        for key, (shape, dtype) in specs.items()
+    })
+    super().__init__(reservoir, batch_size, seed=seed,
+                     num_devices=num_devices, queue_size=queue_size)
+    self._flat_reservoir = {
+        key: self._lookup(reservoir, key) for key in specs
+    }
+    self.item_ids = list(item_ids)
+    self.reservoir_size = reservoir_size
+    self.min_fill = max(batch_size, int(min_fill_fraction * reservoir_size))
+    self.min_fill = min(self.min_fill, reservoir_size)
+    self.num_workers = num_workers or multiprocessing.cpu_count()
+    self.max_pending_items = 2 * self.num_workers
+    self.num_filled = 0
+    self.num_items_loaded = 0
+    self._insert_rng = np.random.default_rng(seed + 1)
+    self._lock = threading.Lock()
+    self._filled = threading.Condition(self._lock)
+    # Spawn the workers since forking a process which has initialized JAX is
+    # unsafe.
+    context = multiprocessing.get_context('spawn')
+    self._pool = context.Pool(
+        self.num_workers, initializer=_init_worker, initargs=(datasource,))
+    self._loader_thread = None
+    self._loader_error = None
+
+  @staticmethod
+  def _lookup(tree, key):
+    for part in key.split('.'):
+      tree = tree[part]
+    return tree
+
+  def _insert(self, arrays, num_rays):
+    """Inserts the rays of an item into the reservoir."""
+    with self._lock:
+      num_append = min(num_rays, self.reservoir_size - self.num_filled)
+      slots = np.arange(self.num_filled, self.num_filled + num_append)
+      num_replace = min(num_rays - num_append, self.reservoir_size)
+      if num_replace > 0:
+        # Overwrite random slots once the reservoir is full.
+        slots = np.concatenate([
+            slots,
+            self._insert_rng.integers(0, self.reservoir_size, num_replace)
+        ])
+      ray_indices = np.arange(num_rays)
+      if len(slots) < num_rays:
+        ray_indices = self._insert_rng.choice(
+            num_rays, size=len(slots), replace=False)
+      for key, array in self._flat_reservoir.items():
+        array[slots] = arrays[key][ray_indices]
+      self.num_filled += num_append
+      self.num_items_loaded += 1
+      if self.num_filled >= self.min_fill:
+        self._filled.notify_all()
+
+  def _consume(self, result):
+    name, num_rays, layout = result
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+      arrays = _array_views(shm.buf, num_rays, layout)
+      self._insert(arrays, num_rays)
+      del arrays
+    finally:
+      shm.close()
+      shm.unlink()
+
+  def _loader(self):
+    """Runs `_load_forever` and hands any error to `sample`."""
+    try:
+      self._load_forever()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception('Streaming the rays failed.')
+      with self._lock:
+        self._loader_error = e
+        self._filled.notify_all()
+
+  def _load_forever(self):
+    """Keeps decoding items in a shuffled order and filling the reservoir."""
+    rng = np.random.default_rng(self._insert_rng.integers(2 ** 31))
+    pending = []
+    while True:
+      for item_index in rng.permutation(len(self.item_ids)):
+        pending.append(self._pool.apply_async(
+            _load_item, (int(item_index), self.item_ids[item_index])))
+        if len(pending) >= self.max_pending_items:
+          self._consume(pending.pop(0).get())
+      while pending:
+        self._consume(pending.pop(0).get())
+      logging.info('Streamed an epoch of %d items into the reservoir.',
+                   len(self.item_ids))
+
+  def start_loading(self):
+    if self._loader_thread is None:
+      self._loader_thread = threading.Thread(target=self._loader, daemon=True)
+      self._loader_thread.start()
+
+  def sample(self, timeout: float = 60.0):
+    """Samples a batch once the reservoir is filled enough.
+
+    Args:
+      timeout: the number of seconds between checks that the loader is still
+        alive while waiting for the reservoir to fill.
+
+    Returns:
+      The sampled batch.
+    """
+    self.start_loading()
+    with self._filled:
+      while not self._filled.wait_for(
+          lambda: (self.num_filled >= self.min_fill
+                   or self._loader_error is not None),
+          timeout=timeout):
+        if not self._loader_thread.is_alive():
+          raise RuntimeError('The streaming loader thread has stopped.')
+        logging.info('Waiting for the reservoir to fill (%d/%d rays).',
+                     self.num_filled, self.min_fill)
+      if self._loader_error is not None:
+        raise RuntimeError(
+            'Streaming the rays failed.') from self._loader_error
+      indices = self.rng.integers(0, self.num_filled, size=self.batch_size)
+      indices.sort()
+      return self.gather(indices)
+
+  def close(self):
+    self._pool.terminate()
+
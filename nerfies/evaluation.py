@@ -13,6 +13,7 @@
 # limitations under the License.
 
 """Module for evaluating a trained NeRF."""
+import functools
 import math
 import time
 
@@ -21,8 +22,209 @@ from flax import jax_utils
 import jax
 from jax import tree_util
 import jax.numpy as jnp
+import numpy as np
 
+from nerfies import models
 from nerfies import utils
+from nerfies import warp_cache
+
+
+def _pipeline(dispatch_fn, num_batches):
+  """Yields `dispatch_fn(i)` for each batch after dispatching batch i+1."""
+  pending = dispatch_fn(0) if num_batches > 0 else None
+  for batch_idx in range(num_batches):
+    current = pending
+    if batch_idx + 1 < num_batches:
+      pending = dispatch_fn(batch_idx + 1)
+    yield current
+
+
+def _prepare_chunk(rays_dict, ray_idx, chunk, device_count):
+  """Slices, pads and shards a chunk of flattened rays on the host."""
+  chunk_rays_dict = tree_util.tree_map(
+      lambda x: np.asarray(x[ray_idx:ray_idx + chunk]), rays_dict)
+  num_chunk_rays = chunk_rays_dict['origins'].shape[0]
+  remainder = num_chunk_rays % device_count
+  if remainder != 0:
+    padding = device_count - remainder
+    chunk_rays_dict = tree_util.tree_map(
+        lambda x: np.pad(x, ((0, padding), (0, 0)), mode='edge'),
+        chunk_rays_dict)
+  else:
+    padding = 0
+  # After padding the number of chunk_rays is always divisible by
+  # host_count.
+  host_id = jax.process_index()
+  per_host_rays = (num_chunk_rays + padding) // jax.process_count()
+  chunk_rays_dict = tree_util.tree_map(
+      lambda x: x[(host_id * per_host_rays):((host_id + 1) * per_host_rays)],
+      chunk_rays_dict)
+  return utils.shard(chunk_rays_dict, device_count), padding
+
+
+def termination_fallbacks(model, build_fn):
+  """Returns render functions with growing early termination budgets.
+
+  The functions are only compiled when they are first called, so only the
+  budgets which are actually needed cost a compilation.
+
+  Args:
+    model: the NerfModel which renders the images.
+    build_fn: a function which returns a render function for a model.
+
+  Returns:
+    A list of `(sample_fraction, model_fn)` tuples sorted by the fraction.
+    The fraction doubles from `model.termination_sample_fraction` and the
+    last function renders without early termination. The list is empty if
+    early termination is disabled.
+  """
+  if not model.use_early_termination:
+    return []
+  fallbacks = []
+  fraction = 2 * model.termination_sample_fraction
+  while fraction < 1.0:
+    fallbacks.append(
+        (fraction,
+         build_fn(model.clone(termination_sample_fraction=fraction))))
+    fraction *= 2
+  fallbacks.append((1.0, build_fn(model.clone(use_early_termination=False))))
+  return fallbacks
+
+
+def _num_overflow_samples(ret_map):
+  """Returns the number of samples early termination had no room for."""
+  if 'overflow_samples' not in ret_map:
+    return 0
+  return int(np.sum(ret_map['overflow_samples']))
+
+
+def _merge_fallback_outputs(ret_map, fallback_ret_map):
+  """Replaces the outputs of a chunk with the outputs of a fallback render."""
+  return {
+      key: (fallback_ret_map[key] if key in fallback_ret_map
+            else np.zeros_like(value))
+      for key, value in ret_map.items()
+  }
+
+
+def _render_fallbacks(ret_map, fallback_model_fns, render_fn, ray_idx, chunk):
+  """Renders a chunk again with larger budgets until no samples overflow.
+
+  The first budget tried is the smallest one which holds the survival rate
+  observed in the chunk. Since the samples are compacted per device a budget
+  which holds the average rate may still overflow, so the next larger budget
+  is tried until the chunk fits.
+
+  Args:
+    ret_map: the outputs of the chunk rendered with the initial budget.
+    fallback_model_fns: see `termination_fallbacks`.
+    render_fn: a function which renders the chunk with a model function and
+      returns its outputs.
+    ray_idx: the index of the first ray of the chunk.
+    chunk: the number of rays in the chunk.
+
+  Returns:
+    The outputs of the chunk.
+  """
+  num_overflow = _num_overflow_samples(ret_map)
+  if num_overflow == 0:
+    return ret_map
+  num_alive = float(np.sum(ret_map['alive_samples']))
+  num_skipped = float(np.sum(ret_map['skipped_samples']))
+  survival_rate = num_alive / max(num_alive + num_skipped, 1.0)
+  for fraction, fallback_model_fn in fallback_model_fns:
+    if fraction < survival_rate:
+      continue
+    logging.info('Rendering rays %d-%d again with %.03f of the samples.',
+                 ray_idx, ray_idx + chunk, fraction)
+    fallback_ret_map = render_fn(fallback_model_fn)
+    num_overflow = _num_overflow_samples(fallback_ret_map)
+    ret_map = _merge_fallback_outputs(ret_map, fallback_ret_map)
+    if num_overflow == 0:
+      return ret_map
+  logging.warning(
+      'Early termination dropped %d samples of rays %d-%d; the render '
+      'of these rays is not exact.', num_overflow, ray_idx, ray_idx + chunk)
+  return ret_map
+
+
+def render_image_chunks(
+    state,
+    rays_dict,
+    model_fn,
+    device_count,
+    rng,
+    chunk=8192,
+    default_ret_key=None,
+    warp_extra=None,
+    fallback_model_fns=()):
+  """Renders flattened rays in chunks, yielding each chunk once it is done.
+
+  The rendering is pipelined: chunk i+1 is prepared on the host and
+  dispatched to the devices before the outputs of chunk i are fetched, so the
+  devices do not idle while the host slices and shards the next chunk.
+
+  With early ray termination the fine samples are compacted into a batch of a
+  static size. Chunks with more surviving samples than fit are rendered again
+  with the larger budgets of `fallback_model_fns` so that early termination
+  never changes the render.
+
+  Args:
+    state: model_utils.TrainState.
+    rays_dict: dict of (N, C) ray arrays.
+    model_fn: function, jit-ed render function.
+    device_count: The number of devices to shard batches over.
+    rng: The random number generator.
+    chunk: int, the size of chunks to render sequentially.
+    default_ret_key: either 'fine' or 'coarse'. If None will default to highest.
+    warp_extra: replicated extra warp parameters which override
+      `state.warp_extra`.
+    fallback_model_fns: the same functions as `model_fn` for larger early
+      termination budgets (see `termination_fallbacks`). If empty,
+      overflowing chunks are only logged.
+
+  Yields:
+    A tuple `(start, outputs)` where `outputs` is a dictionary of (n, ...)
+    NumPy arrays for the rays `start` to `start + n`.
+  """
+  if warp_extra is None:
+    warp_extra = state.warp_extra
+  num_rays = rays_dict['origins'].shape[0]
+  _, key_0, key_1 = jax.random.split(rng, 3)
+  key_0 = jax.random.split(key_0, device_count)
+  key_1 = jax.random.split(key_1, device_count)
+  params = state.optimizer.target['model']
+  num_batches = int(math.ceil(num_rays / chunk))
+
+  def _call(fn, ray_idx):
+    chunk_rays_dict, padding = _prepare_chunk(
+        rays_dict, ray_idx, chunk, device_count)
+    # The call returns as soon as the computation is enqueued.
+    return padding, fn(key_0, key_1, params, chunk_rays_dict, warp_extra,
+                       state.occupancy_grid)
+
+  def _fetch(padding, model_out):
+    if not default_ret_key:
+      ret_key = 'fine' if 'fine' in model_out else 'coarse'
+    else:
+      ret_key = default_ret_key
+    ret_map = jax.device_get(jax_utils.unreplicate(model_out[ret_key]))
+    return jax.tree_map(lambda x: utils.unshard(x, padding), ret_map)
+
+  def _dispatch(batch_idx):
+    ray_idx = batch_idx * chunk
+    logging.log_every_n_seconds(
+        logging.INFO, 'Rendering batch %d/%d (%d/%d)', 2.0,
+        batch_idx, num_batches, ray_idx, num_rays)
+    return (ray_idx, *_call(model_fn, ray_idx))
+
+  for ray_idx, padding, model_out in _pipeline(_dispatch, num_batches):
+    ret_map = _fetch(padding, model_out)
+    ret_map = _render_fallbacks(
+        ret_map, fallback_model_fns,
+        lambda fn: _fetch(*_call(fn, ray_idx)),
+        ray_idx, chunk)
+    yield ray_idx, ret_map
 
 
 def render_image(
@@ -32,9 +234,14 @@ def render_image(
     device_count,
     rng,
     chunk=8192,
-    default_ret_key=None):
+    default_ret_key=None,
+    warp_extra=None,
+    fallback_model_fns=()):
   """Render all the pixels of an image (in test mode).
 
+  The chunks are rendered with `render_image_chunks` and written into
+  preallocated host buffers.
+
   Args:
     state: model_utils.TrainState.
     rays_dict: dict, test example.
@@ -43,59 +250,252 @@ def render_image(
     rng: The random number generator.
     chunk: int, the size of chunks to render sequentially.
     default_ret_key: either 'fine' or 'coarse'. If None will default to highest.
+    warp_extra: replicated extra warp parameters which override
+      `state.warp_extra`.
+    fallback_model_fns: see `render_image_chunks`.
 
   Returns:
-    rgb: jnp.ndarray, rendered color image.
-    depth: jnp.ndarray, rendered depth.
-    acc: jnp.ndarray, rendered accumulated weights per pixel.
+    rgb: np.ndarray, rendered color image.
+    depth: np.ndarray, rendered depth.
+    acc: np.ndarray, rendered accumulated weights per pixel.
+    skipped_samples: np.ndarray, the number of samples skipped per pixel by
+      early ray termination. Only present if it is enabled in the model.
+    overflow_samples: np.ndarray, the number of surviving samples per pixel
+      which did not fit into the early termination batch. This is zero
+      unless `fallback_model_fns` is empty.
   """
   h, w = rays_dict['origins'].shape[:2]
   rays_dict = tree_util.tree_map(lambda x: x.reshape((h * w, -1)), rays_dict)
   num_rays = h * w
+  out = {}
+  start_time = time.time()
+  for ray_idx, ret_map in render_image_chunks(
+      state, rays_dict, model_fn, device_count, rng, chunk=chunk,
+      default_ret_key=default_ret_key, warp_extra=warp_extra,
+      fallback_model_fns=fallback_model_fns):
+    for key, value in ret_map.items():
+      if key not in out:
+        out[key] = np.empty((num_rays, *value.shape[1:]), value.dtype)
+      out[key][ray_idx:ray_idx + value.shape[0]] = value
+  logging.info('Rendering took %.04s', time.time() - start_time)
+  if 'skipped_samples' in out:
+    num_skipped = int(out['skipped_samples'].sum())
+    logging.info('Early termination skipped %d samples (%.02f per ray).',
+                 num_skipped, num_skipped / num_rays)
+  return {k: v.reshape((h, w, *v.shape[1:])) for k, v in out.items()}
+
+
+def render_images(
+    state,
+    rays_dicts,
+    model_fn,
+    device_count,
+    rng,
+    chunk=8192,
+    default_ret_key=None,
+    fallback_model_fns=()):
+  """Renders up to `device_count` whole images with one image per device.
+
+  Unlike `render_image`, each device renders the rays of a different image so
+  the outputs never have to be gathered across devices. This is faster for
+  many small images. Smaller images are padded to the size of the largest one
+  and unused devices render a copy of the first image.
+
+  Args:
+    state: model_utils.TrainState.
+    rays_dicts: a list of dicts of (H, W, C) ray arrays.
+    model_fn: function, pmap-ed render function which must not gather its
+      outputs across devices.
+    device_count: The number of devices to shard the images over.
+    rng: The random number generator.
+    chunk: int, the number of rays rendered per device at once.
+    default_ret_key: either 'fine' or 'coarse'. If None will default to highest.
+    fallback_model_fns: see `render_image_chunks`.
+
+  Returns:
+    A list with a dictionary of rendered (H, W, ...) maps for each image. See
+    `render_image`.
+  """
+  num_images = len(rays_dicts)
+  if num_images > device_count:
+    raise ValueError(f'Cannot render {num_images} images on {device_count} '
+                     'devices.')
+  shapes = [rays_dict['origins'].shape[:2] for rays_dict in rays_dicts]
+  max_rays = max(h * w for h, w in shapes)
+
+  def _flatten(x):
+    x = np.asarray(x).reshape((-1, x.shape[-1]))
+    return np.pad(x, ((0, max_rays - x.shape[0]), (0, 0)), mode='edge')
+
+  flat_rays = [tree_util.tree_map(_flatten, rays_dict)
+               for rays_dict in rays_dicts]
+  flat_rays += [flat_rays[0]] * (device_count - num_images)
+  # (device_count, max_rays, C) arrays.
+  rays = tree_util.tree_map(lambda *x: np.stack(x), *flat_rays)
+
   _, key_0, key_1 = jax.random.split(rng, 3)
   key_0 = jax.random.split(key_0, device_count)
   key_1 = jax.random.split(key_1, device_count)
-  host_id = jax.process_index()
-  ret_maps = []
-  start_time = time.time()
-  num_batches = int(math.ceil(num_rays / chunk))
-  for batch_idx in range(num_batches):
-    ray_idx = batch_idx * chunk
-    logging.log_every_n_seconds(
-        logging.INFO, 'Rendering batch %d/%d (%d/%d)', 2.0,
-        batch_idx, num_batches, ray_idx, num_rays)
-    # pylint: disable=cell-var-from-loop
-    chunk_slice_fn = lambda x: x[ray_idx:ray_idx + chunk]
-    chunk_rays_dict = tree_util.tree_map(chunk_slice_fn, rays_dict)
-    num_chunk_rays = chunk_rays_dict['origins'].shape[0]
-    remainder = num_chunk_rays % device_count
-    if remainder != 0:
-      padding = device_count - remainder
-      # pylint: disable=cell-var-from-loop
-      chunk_pad_fn = lambda x: jnp.pad(x, ((0, padding), (0, 0)), mode='edge')
-      chunk_rays_dict = tree_util.tree_map(chunk_pad_fn, chunk_rays_dict)
-    else:
-      padding = 0
-    # After padding the number of chunk_rays is always divisible by
-    # host_count.
-    per_host_rays = num_chunk_rays // jax.process_count()
-    chunk_rays_dict = tree_util.tree_map(
-        lambda x: x[(host_id * per_host_rays):((host_id + 1) * per_host_rays)],
-        chunk_rays_dict)
-    chunk_rays_dict = utils.shard(chunk_rays_dict, device_count)
-    model_out = model_fn(key_0, key_1, state.optimizer.target['model'],
-                         chunk_rays_dict, state.warp_extra)
+  params = state.optimizer.target['model']
+  num_batches = int(math.ceil(max_rays / chunk))
+
+  def _call(fn, ray_idx):
+    chunk_rays = tree_util.tree_map(
+        lambda x: x[:, ray_idx:ray_idx + chunk], rays)
+    return fn(key_0, key_1, params, chunk_rays, state.warp_extra,
+              state.occupancy_grid)
+
+  def _fetch(model_out):
     if not default_ret_key:
       ret_key = 'fine' if 'fine' in model_out else 'coarse'
     else:
       ret_key = default_ret_key
-    ret_map = jax_utils.unreplicate(model_out[ret_key])
-    ret_map = jax.tree_map(lambda x: utils.unshard(x, padding), ret_map)
-    ret_maps.append(ret_map)
-  ret_map = jax.tree_multimap(lambda *x: jnp.concatenate(x, axis=0), *ret_maps)
-  logging.info('Rendering took %.04s', time.time() - start_time)
-  out = {}
-  for key, value in ret_map.items():
-    out[key] = value.reshape((h, w, *value.shape[1:]))
+    return jax.device_get(model_out[ret_key])
+
+  def _dispatch(batch_idx):
+    ray_idx = batch_idx * chunk
+    return ray_idx, _call(model_fn, ray_idx)
+
+  outputs = [{} for _ in range(num_images)]
+  for ray_idx, model_out in _pipeline(_dispatch, num_batches):
+    ret_map = _fetch(model_out)
+    ret_map = _render_fallbacks(
+        ret_map, fallback_model_fns,
+        lambda fn: _fetch(_call(fn, ray_idx)),
+        ray_idx, chunk)
+    for key, value in ret_map.items():
+      for i in range(num_images):
+        if key not in outputs[i]:
+          outputs[i][key] = np.empty(
+              (max_rays, *value.shape[2:]), value.dtype)
+        outputs[i][key][ray_idx:ray_idx + value.shape[1]] = value[i]
+
+  return [{k: v[:h * w].reshape((h, w, *v.shape[1:])) for k, v in out.items()}
+          for out, (h, w) in zip(outputs, shapes)]
+
+
+class VideoRenderer:
+  """Renders camera paths with metadata which is encoded once per frame.
+
+  The metadata of each frame is encoded once and broadcast to every ray rather
+  than being encoded for every sample. If `warp_grid_resolution` is set the
+  warp field is also evaluated on a grid once per deformation code (see
+  `warp_cache`), and frames which share a code skip the warp MLP. This is
+  intended for renders where the deformation is held fixed while the camera
+  moves.
+  """
+
+  def __init__(self,
+               model: models.NerfModel,
+               state,
+               devices=None,
+               chunk=8192,
+               warp_grid_resolution=None,
+               max_cached_warps=4):
+    """Constructor.
+
+    Args:
+      model: the NeRF model.
+      state: the replicated model_utils.TrainState.
+      devices: the devices to render with.
+      chunk: the number of rays to render at once.
+      warp_grid_resolution: if given, the resolution of the cached warp grids.
+      max_cached_warps: the maximum number of warp grids to keep.
+    """
+    self.model = model
+    self.state = state
+    self.devices = devices or jax.local_devices()
+    self.chunk = chunk
+    self.warp_grid_resolution = warp_grid_resolution
+    self.warp_grid_cache = warp_cache.WarpGridCache(max_cached_warps)
+    self.warp_key = ('time' if model.warp_metadata_encoder_type == 'time'
+                     else 'warp')
+
+    params = jax_utils.unreplicate(state.optimizer.target['model'])
+    warp_extra = jax_utils.unreplicate(state.warp_extra)
+
+    def _encode_fn(metadata):
+      return model.apply({'params': params}, metadata, warp_extra,
+                         method=models.NerfModel.encode_metadata)
+
+    def _warp_fn(points, code):
+      metadata = {
+          self.warp_key: jnp.broadcast_to(code, (points.shape[0],
+                                                 code.shape[-1])),
+      }
+      warped = model.apply({'params': params}, points[:, None, :], metadata,
+                           warp_extra, metadata_encoded=True,
+                           method=models.NerfModel.warp_samples)
+      return warped[:, 0]
+
+    def _model_fn(key_0, key_1, params, rays_dict, warp_extra, occupancy_grid,
+                  render_model=model):
+      out = render_model.apply({'params': params},
+                               rays_dict,
+                               warp_extra=warp_extra,
+                               occupancy_grid=occupancy_grid,
+                               metadata_encoded=True,
+                               rngs={'coarse': key_0, 'fine': key_1},
+                               mutable=False)
+      return jax.lax.all_gather(out, axis_name='batch')
+
+    self._encode_fn = jax.jit(_encode_fn)
+    self._warp_fn = jax.jit(_warp_fn)
+    self._pmodel_fn = jax.pmap(
+        _model_fn,
+        in_axes=(0, 0, 0, 0, 0, 0),
+        devices=self.devices,
+        donate_argnums=(3,),
+        axis_name='batch')
+    # Renders chunks which overflow the early termination sample budget.
+    self._fallback_pmodel_fns = termination_fallbacks(
+        model,
+        lambda render_model: jax.pmap(
+            functools.partial(_model_fn, render_model=render_model),
+            in_axes=(0, 0, 0, 0, 0, 0),
+            devices=self.devices,
+            donate_argnums=(3,),
+            axis_name='batch'))
+
+  def _get_warp_grid(self, code):
+    def _compute():
+      grid = warp_cache.compute_warp_grid(
+          functools.partial(self._warp_fn, code=code),
+          resolution=self.warp_grid_resolution,
+          bound=self.model.far)
+      return jax_utils.replicate(grid, self.devices)
+
+    return self.warp_grid_cache.get(code.tobytes(), _compute)
+
+  def render(self, rays_dict, metadata, rng):
+    """Renders a frame.
+
+    Args:
+      rays_dict: a dictionary of (H, W, 3) `origins` and `directions`.
+      metadata: a dictionary of metadata values for the frame, e.g.
+        `{'warp': 0, 'appearance': 0}`.
+      rng: The random number generator.
+
+    Returns:
+      A dictionary of rendered maps. See `render_image`.
+    """
+    metadata = {
+        k: jnp.asarray([v], jnp.float32 if k == 'time' else jnp.uint32)
+        for k, v in metadata.items()
+    }
+    encoded = jax.device_get(self._encode_fn(metadata))
+    h, w = rays_dict['origins'].shape[:2]
+    rays_dict = dict(rays_dict)
+    rays_dict['metadata'] = {
+        k: np.broadcast_to(v, (h, w, v.shape[-1])) for k, v in encoded.items()
+    }
+
+    warp_extra = None
+    if self.warp_grid_resolution and self.model.use_warp:
+      warp_grid = self._get_warp_grid(np.asarray(encoded[self.warp_key]))
+      warp_extra = {**self.state.warp_extra, 'warp_grid': warp_grid}
 
-  return out
+    return render_image(self.state, rays_dict, self._pmodel_fn,
+                        device_count=len(self.devices), rng=rng,
+                        chunk=self.chunk, warp_extra=warp_extra,
+                        fallback_model_fns=self._fallback_pmodel_fns)
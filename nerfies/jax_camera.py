@@ -0,0 +1,209 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A camera implementation in JAX which generates rays on device.
+
+`JaxCamera` mirrors `camera.Camera` but is a pytree of (possibly batched)
+parameters so that it can be passed into jitted and pmapped functions. This
+allows the data pipeline to only send the pixel coordinates and camera index
+of each ray to the device instead of the ray origins and directions.
+"""
+from typing import Any, Dict, Tuple
+
+from flax import struct
+import jax
+from jax import numpy as jnp
+import numpy as np
+
+from nerfies import camera as cam
+
+
+def _radial_and_tangential_undistort(
+    xd: jnp.ndarray,
+    yd: jnp.ndarray,
+    k1: float = 0,
+    k2: float = 0,
+    k3: float = 0,
+    p1: float = 0,
+    p2: float = 0,
+    eps: float = 1e-9,
+    max_iterations=10) -> Tuple[jnp.ndarray, jnp.ndarray]:
+  """Computes undistorted (x, y) from (xd, yd)."""
+  # Initialize from the distorted point.
+  x = xd
+  y = yd
+
+  for _ in range(max_iterations):
+    # The residual only uses arithmetic so it works with JAX arrays.
+    fx, fy, fx_x, fx_y, fy_x, fy_y = cam._compute_residual_and_jacobian(  # pylint: disable=protected-access
+        x=x, y=y, xd=xd, yd=yd, k1=k1, k2=k2, k3=k3, p1=p1, p2=p2)
+    denominator = fy_x * fx_y - fx_x * fy_y
+    x_numerator = fx * fy_y - fy * fx_y
+    y_numerator = fy * fx_x - fx * fy_x
+    valid = jnp.abs(denominator) > eps
+    safe_denominator = jnp.where(valid, denominator, 1.0)
+    step_x = jnp.where(valid, x_numerator / safe_denominator, 0.0)
+    step_y = jnp.where(valid, y_numerator / safe_denominator, 0.0)
+
+    x = x + step_x
+    y = y + step_y
+
+  return x, y
+
+
+@struct.dataclass
+class JaxCamera:
+  """A pytree of camera parameters.
+
+  The parameters may have leading batch dimensions e.g., `orientation` may be
+  (N, 3, 3) and `focal_length` (N,) for N cameras. Indexing a batched camera
+  with an array of camera indices returns the camera of each index, which is
+  how per-ray cameras are gathered.
+  """
+  orientation: jnp.ndarray
+  position: jnp.ndarray
+  focal_length: jnp.ndarray
+  principal_point: jnp.ndarray
+  skew: jnp.ndarray
+  pixel_aspect_ratio: jnp.ndarray
+  radial_distortion: jnp.ndarray
+  tangential_distortion: jnp.ndarray
+  image_size: jnp.ndarray
+
+  @classmethod
+  def from_camera(cls, camera: cam.Camera):
+    """Creates an unbatched camera from a `camera.Camera`."""
+    return cls(**{
+        k: jnp.asarray(v) for k, v in camera.get_parameters().items()})
+
+  @classmethod
+  def from_cameras(cls, cameras):
+    """Creates a batched camera from a sequence of cameras or a CameraBatch."""
+    if not isinstance(cameras, cam.CameraBatch):
+      cameras = cam.CameraBatch.from_cameras(cameras)
+    return cls(**{k: jnp.asarray(v) for k, v in cameras.get_parameters().items()})
+
+  def __getitem__(self, index):
+    return jax.tree_map(lambda x: x[index], self)
+
+  @property
+  def scale_factor_x(self):
+    return self.focal_length
+
+  @property
+  def scale_factor_y(self):
+    return self.focal_length * self.pixel_aspect_ratio
+
+  @property
+  def optical_axis(self):
+    return self.orientation[..., 2, :]
+
+  def pixel_to_local_rays(self, pixels: jnp.ndarray):
+    """Returns the local ray directions for the provided pixels.
+
+    Args:
+      pixels: [..., 2] pixel positions whose leading dimensions broadcast with
+        the batch dimensions of the camera.
+
+    Returns:
+      The [..., 3] normalized local ray directions.
+    """
+    y = ((pixels[..., 1] - self.principal_point[..., 1]) /
+         self.scale_factor_y)
+    x = ((pixels[..., 0] - self.principal_point[..., 0] - y * self.skew) /
+         self.scale_factor_x)
+
+    # Cameras without distortion have a zero residual and are unchanged.
+    x, y = _radial_and_tangential_undistort(
+        x,
+        y,
+        k1=self.radial_distortion[..., 0],
+        k2=self.radial_distortion[..., 1],
+        k3=self.radial_distortion[..., 2],
+        p1=self.tangential_distortion[..., 0],
+        p2=self.tangential_distortion[..., 1])
+
+    dirs = jnp.stack([x, y, jnp.ones_like(x)], axis=-1)
+    return dirs / jnp.linalg.norm(dirs, axis=-1, keepdims=True)
+
+  def pixels_to_rays(self, pixels: jnp.ndarray) -> jnp.ndarray:
+    """Returns the normalized [..., 3] world ray directions of the pixels."""
+    local_rays_dir = self.pixel_to_local_rays(pixels)
+    # Computes orientation.T @ local_rays_dir with broadcasting.
+    rays_dir = jnp.matmul(local_rays_dir[..., None, :], self.orientation)
+    rays_dir = rays_dir[..., 0, :]
+    return rays_dir / jnp.linalg.norm(rays_dir, axis=-1, keepdims=True)
+
+  def pixels_to_points(self, pixels: jnp.ndarray, depth: jnp.ndarray):
+    rays_through_pixels = self.pixels_to_rays(pixels)
+    cosa = jnp.sum(rays_through_pixels * self.optical_axis, axis=-1)
+    return (rays_through_pixels * (depth / cosa)[..., None] + self.position)
+
+  def points_to_local_points(self, points: jnp.ndarray):
+    translated_points = points - self.position
+    return jnp.matmul(self.orientation, translated_points[..., None])[..., 0]
+
+  def project(self, points: jnp.ndarray):
+    """Projects [..., 3] points to [..., 2] pixel positions."""
+    local_points = self.points_to_local_points(points)
+
+    # Get normalized local pixel positions.
+    x = local_points[..., 0] / local_points[..., 2]
+    y = local_points[..., 1] / local_points[..., 2]
+    r2 = x**2 + y**2
+
+    # Apply radial distortion.
+    k1 = self.radial_distortion[..., 0]
+    k2 = self.radial_distortion[..., 1]
+    k3 = self.radial_distortion[..., 2]
+    distortion = 1.0 + r2 * (k1 + r2 * (k2 + k3 * r2))
+
+    # Apply tangential distortion.
+    p1 = self.tangential_distortion[..., 0]
+    p2 = self.tangential_distortion[..., 1]
+    x_times_y = x * y
+    x = x * distortion + 2.0 * p1 * x_times_y + p2 * (r2 + 2.0 * x**2)
+    y = y * distortion + 2.0 * p2 * x_times_y + p1 * (r2 + 2.0 * y**2)
+
+    # Map the distorted ray to the image plane.
+    pixel_x = (self.focal_length * x + self.skew * y
+               + self.principal_point[..., 0])
+    pixel_y = self.scale_factor_y * y + self.principal_point[..., 1]
+    return jnp.stack([pixel_x, pixel_y], axis=-1)
+
+
+def get_pixel_centers(image_shape: Tuple[int, int], dtype=jnp.float32):
+  """Returns the (H, W, 2) pixel centers of an image with a static shape."""
+  height, width = image_shape
+  xx, yy = np.meshgrid(np.arange(width), np.arange(height))
+  return jnp.asarray(np.stack([xx, yy], axis=-1) + 0.5, dtype)
+
+
+def add_rays(cameras: JaxCamera, batch: Dict[str, Any]) -> Dict[str, Any]:
+  """Adds the `origins` and `directions` of a batch of rays.
+
+  Args:
+    cameras: a batched camera with one entry per image.
+    batch: a dictionary containing the (..., 2) `pixels` and the (..., 1)
+      `camera_index` of each ray.
+
+  Returns:
+    A copy of the batch with the (..., 3) `origins` and `directions`.
+  """
+  ray_cameras = cameras[batch['camera_index'][..., 0]]
+  batch = dict(batch)
+  batch['directions'] = ray_cameras.pixels_to_rays(batch['pixels'])
+  batch['origins'] = jnp.broadcast_to(ray_cameras.position,
+                                      batch['directions'].shape)
+  return batch
@@ -13,12 +13,16 @@
 # limitations under the License.
 
 """Helper functions/classes for model definition."""
+from typing import Optional
 
 from flax import linen as nn
 
 # from flax import optim
 import optax
+from flax import serialization
 from flax import struct
+from flax.training import checkpoints
+import jax
 from jax import lax
 from jax import random
 import jax.numpy as jnp
@@ -28,10 +32,55 @@ import jax.numpy as jnp
 class TrainState:
     warp_alpha: jnp.ndarray = 0.0
     time_alpha: jnp.ndarray = 0.0
+    occupancy_grid: Optional[jnp.ndarray] = None
+    nerf_alpha: Optional[jnp.ndarray] = None
+    loss_scale: Optional[jnp.ndarray] = None
+    loss_scale_steps: Optional[jnp.ndarray] = None
 
     @property
     def warp_extra(self):
-        return {"alpha": self.warp_alpha, "time_alpha": self.time_alpha}
+        return {
+            "alpha": self.warp_alpha,
+            "time_alpha": self.time_alpha,
+            "nerf_alpha": self.nerf_alpha,
+        }
+
+
+def _fill_missing_state(state_dict, default_state_dict):
+    """Adds the entries of `default_state_dict` missing from `state_dict`."""
+    if not isinstance(state_dict, dict) or not isinstance(default_state_dict, dict):
+        return state_dict
+    filled = dict(state_dict)
+    for key, default in default_state_dict.items():
+        if key in filled:
+            filled[key] = _fill_missing_state(filled[key], default)
+        else:
+            filled[key] = default
+    return filled
+
+
+def restore_checkpoint(checkpoint_dir, target, step=None):
+    """Restores a checkpoint, tolerating fields added to `target` since.
+
+    `TrainState` gained fields (e.g., `occupancy_grid` and `loss_scale`) which
+    are missing from older checkpoints. `from_state_dict` fails on missing
+    fields, so they are filled in from `target` before deserializing.
+
+    Args:
+      checkpoint_dir: the checkpoint directory.
+      target: the state to restore into. It provides the missing fields.
+      step: the step to restore, or None for the latest checkpoint.
+
+    Returns:
+      The restored state, or `target` if there is no checkpoint.
+    """
+    state_dict = checkpoints.restore_checkpoint(checkpoint_dir, None, step=step)
+    if state_dict is None:
+        return target
+    state_dict = _fill_missing_state(
+        state_dict, serialization.to_state_dict(target)
+    )
+    return serialization.from_state_dict(target, state_dict)
 
 
 def sample_along_rays(
@@ -83,6 +132,102 @@ def sample_along_rays(
     )
 
 
+def sample_along_rays_occupancy(
+    key,
+    origins,
+    directions,
+    num_coarse_samples,
+    near,
+    far,
+    occupancy_fn,
+    num_candidates,
+    use_stratified_sampling,
+    use_linear_disparity,
+):
+    """Samples along the rays while skipping empty space.
+
+    A dense set of cheap candidate samples is tested against the occupancy
+    grid and the coarse samples are then drawn only from the occupied
+    intervals. This keeps the shapes static so that fewer coarse samples can
+    be used for the same sampling density in occupied space.
+
+    Consecutive samples may straddle empty space, so the distance between them
+    overestimates the length of the volume they stand for. The returned
+    `occupied_cdf` gives the occupied length along each ray so that
+    `occupied_interval_lengths` can compute the exact intervals for
+    `volumetric_rendering`.
+
+    Args:
+      key: jnp.ndarray, random generator key.
+      origins: ray origins.
+      directions: ray directions.
+      num_coarse_samples: int, the number of samples to return.
+      near: float, near clip.
+      far: float, far clip.
+      occupancy_fn: a function mapping points to a boolean occupancy mask.
+      num_candidates: int, the number of candidate samples to test.
+      use_stratified_sampling: use stratified sampling.
+      use_linear_disparity: sampling linearly in disparity rather than depth.
+
+    Returns:
+      z_vals: jnp.ndarray, [batch_size, num_coarse_samples], sampled z values.
+      points: jnp.ndarray, [batch_size, num_coarse_samples, 3], sampled points.
+      occupied_cdf: a tuple of the [batch_size, num_candidates + 1] candidate
+        bin edges and the occupied length along the ray up to each edge.
+    """
+    candidate_key, key = random.split(key)
+    candidate_z_vals, candidate_points = sample_along_rays(
+        candidate_key,
+        origins,
+        directions,
+        num_candidates,
+        near,
+        far,
+        use_stratified_sampling=False,
+        use_linear_disparity=use_linear_disparity,
+    )
+    occupied = occupancy_fn(candidate_points).astype(candidate_z_vals.dtype)
+    # Rays which only pass through empty space fall back to uniform sampling
+    # since every bin then has the same (epsilon) weight.
+    bins = jnp.concatenate(
+        [
+            jnp.full_like(candidate_z_vals[..., :1], near),
+            0.5 * (candidate_z_vals[..., 1:] + candidate_z_vals[..., :-1]),
+            jnp.full_like(candidate_z_vals[..., :1], far),
+        ],
+        axis=-1,
+    )
+    z_vals = piecewise_constant_pdf(
+        key, bins, occupied, num_coarse_samples, use_stratified_sampling
+    )
+    z_vals = jnp.sort(z_vals, axis=-1)
+    occupied_lengths = jnp.cumsum(occupied * (bins[..., 1:] - bins[..., :-1]), axis=-1)
+    occupied_lengths = jnp.concatenate(
+        [jnp.zeros_like(occupied_lengths[..., :1]), occupied_lengths], axis=-1
+    )
+    return (
+        z_vals,
+        (origins[..., None, :] + z_vals[..., :, None] * directions[..., None, :]),
+        (bins, occupied_lengths),
+    )
+
+
+def occupied_interval_lengths(occupied_cdf, z_vals):
+    """Computes the occupied length between consecutive samples.
+
+    Args:
+      occupied_cdf: the bin edges and occupied lengths returned by
+        `sample_along_rays_occupancy`.
+      z_vals: (B, S) sorted sample depths, e.g. of the coarse or fine samples.
+
+    Returns:
+      A (B, S - 1) array of the occupied length between consecutive samples.
+    """
+    bins, occupied_lengths = occupied_cdf
+    cdf = jax.vmap(jnp.interp)(z_vals, bins, occupied_lengths)
+    return cdf[..., 1:] - cdf[..., :-1]
+
+
 def volumetric_rendering(
     rgb,
     sigma,
@@ -91,6 +236,8 @@ def volumetric_rendering(
     use_white_background,
     sample_at_infinity=True,
     return_weights=False,
+    termination_threshold=None,
+    interval_lengths=None,
     eps=1e-10,
 ):
     """Volumetric Rendering Function.
@@ -103,6 +250,11 @@ def volumetric_rendering(
       use_white_background: whether to assume a white background or not.
       sample_at_infinity: if True adds a sample at infinity.
       return_weights: if True returns the weights in the dictionary.
+      termination_threshold: if given, samples whose transmittance has fallen
+        below this value are dropped (early ray termination).
+      interval_lengths: an optional array of size (B,S-1) which replaces the
+        distance between consecutive samples, e.g. to exclude skipped empty
+        space (see `occupied_interval_lengths`).
       eps: a small number to prevent numerical issues.
 
     Returns:
@@ -112,11 +264,16 @@ def volumetric_rendering(
         acc: an array of size (B,) containing the accumulated density.
         weights: an array of size (B,S) containing the weight of each sample.
     """
+    # The cumulative product underflows in reduced precision.
+    rgb = rgb.astype(jnp.float32)
+    sigma = sigma.astype(jnp.float32)
     # TODO(keunhong): remove this hack.
     last_sample_z = 1e10 if sample_at_infinity else 1e-19
+    if interval_lengths is None:
+        interval_lengths = z_vals[..., 1:] - z_vals[..., :-1]
     dists = jnp.concatenate(
         [
-            z_vals[..., 1:] - z_vals[..., :-1],
+            interval_lengths,
             jnp.broadcast_to([last_sample_z], z_vals[..., :1].shape),
         ],
         -1,
@@ -131,6 +288,8 @@ def volumetric_rendering(
         ],
         axis=-1,
     )
+    if termination_threshold is not None:
+        accum_prod = jnp.where(accum_prod >= termination_threshold, accum_prod, 0.0)
     weights = alpha * accum_prod
 
     rgb = (weights[..., None] * rgb).sum(axis=-2)
@@ -154,6 +313,61 @@ def volumetric_rendering(
     return out
 
 
+def early_termination_mask(coarse_z_vals, coarse_weights, z_vals, threshold):
+    """Computes which samples lie before the ray becomes opaque.
+
+    The transmittance is estimated from the coarse pass: a sample is kept if
+    it lies before the first coarse sample whose transmittance is below
+    `threshold`.
+
+    Args:
+      coarse_z_vals: (B, Sc) the depths of the coarse samples.
+      coarse_weights: (B, Sc) the weights of the coarse samples.
+      z_vals: (B, S) the depths of the samples to mask.
+      threshold: the transmittance below which samples are dropped.
+
+    Returns:
+      A (B, S) boolean mask which is True for samples which should be kept.
+    """
+    # Transmittance before each coarse sample.
+    transmittance = 1.0 - jnp.concatenate(
+        [
+            jnp.zeros_like(coarse_weights[..., :1]),
+            jnp.cumsum(coarse_weights[..., :-1], axis=-1),
+        ],
+        axis=-1,
+    )
+    terminated = transmittance < threshold
+    stop_z = jnp.min(jnp.where(terminated, coarse_z_vals, jnp.inf), axis=-1)
+    return z_vals <= stop_z[..., None]
+
+
+def compact_samples(mask, capacity):
+    """Computes the indices of the samples kept by `mask` in a dense batch.
+
+    Samples are gathered in sample-major order so that if more than `capacity`
+    samples are alive the farthest samples of the longest rays are the ones
+    left out. The caller must detect this (i.e., `mask.sum() > capacity`) and
+    evaluate those rays densely.
+
+    Args:
+      mask: (B, S) a boolean mask of the samples to keep.
+      capacity: the static size of the compacted batch.
+
+    Returns:
+      ray_indices: (capacity,) the ray index of each compacted sample.
+      sample_indices: (capacity,) the sample index of each compacted sample.
+      valid: (capacity,) True for entries which refer to a kept sample.
+    """
+    num_rays, num_samples = mask.shape
+    flat_mask = mask.T.reshape(-1)
+    (flat_indices,) = jnp.nonzero(flat_mask, size=capacity, fill_value=0)
+    valid = jnp.arange(capacity) < flat_mask.sum()
+    sample_indices = flat_indices // num_rays
+    ray_indices = flat_indices % num_rays
+    return ray_indices, sample_indices, valid
+
+
 def piecewise_constant_pdf(
     key, bins, weights, num_coarse_samples, use_stratified_sampling
 ):
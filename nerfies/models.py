@@ -13,10 +13,12 @@
 # limitations under the License.
 
 """Different model implementation plus a general port for all the models."""
+import functools
 from typing import Any, Dict, Mapping, Optional, Tuple, Sequence
 
 from flax import linen as nn
 import immutabledict
+import jax
 from jax import random
 import jax.numpy as jnp
 
@@ -24,7 +26,9 @@ from nerfies import configs
 from nerfies import glo
 from nerfies import model_utils
 from nerfies import modules
+from nerfies import occupancy
 from nerfies import types
+from nerfies import warp_cache
 from nerfies import warping
 
 
@@ -71,6 +75,38 @@ class NerfModel(nn.Module):
       use_rgb_condition: whether to feed the appearance metadata to the rgb
         branch.
       warp_kwargs: extra keyword arguments for the warp field.
+      use_occupancy_grid: if True the coarse samples skip the empty cells of the
+        occupancy grid passed to `__call__`.
+      num_occupancy_candidates: the number of candidate samples per ray which
+        are tested against the occupancy grid.
+      use_early_termination: if True and stratified sampling is disabled (i.e.,
+        at inference) fine samples behind the point where the coarse
+        transmittance drops below `termination_threshold` are skipped.
+      termination_threshold: the transmittance below which samples are
+        skipped.
+      termination_sample_fraction: the fraction of fine samples which are
+        evaluated by the MLP when using early termination. The surviving
+        samples are compacted into a dense batch of this size. Rays with
+        surviving samples which did not fit are reported in
+        `overflow_samples` and must be rendered again with a larger fraction
+        (see `evaluation.termination_fallbacks`).
+      nerf_point_encoder_type: the encoder for the template NeRF points, either
+        'sinusoidal' or 'hash_grid'. The hash grid is annealed by the
+        `nerf_alpha` in `warp_extra` if it is given.
+      warp_point_encoder_type: the encoder for the warp field points. It is
+        annealed by the warp alpha.
+      hash_grid_kwargs: extra arguments for `modules.HashGridEncoder`. The grid
+        bound defaults to the far plane.
+      use_proposal_network: if True the coarse samples are resampled using the
+        weights of a small proposal density MLP instead of the coarse NeRF
+        MLP. The NeRF MLP is then only evaluated at the fine samples, which
+        include the coarse samples. The proposal is trained with
+        `training.compute_proposal_loss` using `out['proposal']`.
+      proposal_depth: the depth of the proposal MLP.
+      proposal_width: the width of the proposal MLP.
+      dtype: the dtype of the NeRF and warp MLP computation e.g.,
+        `jnp.bfloat16`. Parameters, encodings and volumetric rendering stay in
+        float32.
     """
 
     num_coarse_samples: int
@@ -120,6 +156,18 @@ class NerfModel(nn.Module):
     use_alpha_condition: bool = False
     use_rgb_condition: bool = False
     warp_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
+    use_occupancy_grid: bool = False
+    num_occupancy_candidates: int = 256
+    use_early_termination: bool = False
+    termination_threshold: float = 1e-3
+    termination_sample_fraction: float = 0.25
+    nerf_point_encoder_type: str = "sinusoidal"
+    warp_point_encoder_type: str = "sinusoidal"
+    hash_grid_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
+    use_proposal_network: bool = False
+    proposal_depth: int = 2
+    proposal_width: int = 64
+    dtype: types.Dtype = jnp.float32
 
     metadata_encoded: bool = False
 
@@ -144,9 +192,23 @@ class NerfModel(nn.Module):
             num_features=model.num_warp_features,
             num_batch_dims=num_batch_dims,
             metadata_encoder_type=model.warp_metadata_encoder_type,
+            points_encoder_type=model.warp_point_encoder_type,
+            hash_grid_kwargs=model.hash_grid_config,
+            dtype=model.dtype,
             **model.warp_kwargs,
         )
 
+    @property
+    def template_level(self):
+        """The NeRF MLP which represents the template."""
+        return "fine" if self.use_proposal_network else "coarse"
+
+    @property
+    def hash_grid_config(self):
+        return immutabledict.immutabledict(
+            {"bound": self.far, **self.hash_grid_kwargs}
+        )
+
     # Inside nerfies/models.py, within the NerfModel class definition
 
     def setup(self):
@@ -190,9 +252,18 @@ class NerfModel(nn.Module):
             self.warp_field = self.create_warp_field(self, num_batch_dims=2)
             print("Warp_field initialized.")
 
-        self.point_encoder = model_utils.vmap_module(
-            modules.SinusoidalEncoder, num_batch_dims=2
-        )(num_freqs=self.num_nerf_point_freqs)
+        if self.nerf_point_encoder_type == "hash_grid":
+            self.point_encoder = model_utils.vmap_module(
+                modules.HashGridEncoder, in_axes=(0, None), num_batch_dims=2
+            )(**self.hash_grid_config)
+        elif self.nerf_point_encoder_type == "sinusoidal":
+            self.point_encoder = model_utils.vmap_module(
+                modules.SinusoidalEncoder, in_axes=(0, None), num_batch_dims=2
+            )(num_freqs=self.num_nerf_point_freqs)
+        else:
+            raise ValueError(
+                f"Unknown point encoder type {self.nerf_point_encoder_type!r}"
+            )
         self.viewdir_encoder = model_utils.vmap_module(
             modules.SinusoidalEncoder, num_batch_dims=1
         )(num_freqs=self.num_nerf_viewdir_freqs)
@@ -218,8 +289,24 @@ class NerfModel(nn.Module):
                 features=self.num_camera_features,
             )
 
-        nerf_mlps = {
-            "coarse": modules.NerfMLP(
+        nerf_mlps = {}
+        if self.use_proposal_network:
+            if self.num_fine_samples <= 0:
+                raise ValueError("The proposal network requires fine samples.")
+            self.proposal_point_encoder = model_utils.vmap_module(
+                modules.SinusoidalEncoder, num_batch_dims=2
+            )(num_freqs=self.num_nerf_point_freqs)
+            self.proposal_mlp = modules.MLP(
+                depth=self.proposal_depth,
+                width=self.proposal_width,
+                hidden_activation=self.activation,
+                hidden_init=jax.nn.initializers.glorot_uniform(),
+                output_init=jax.nn.initializers.glorot_uniform(),
+                output_channels=1,
+                dtype=self.dtype,
+            )
+        else:
+            nerf_mlps["coarse"] = modules.NerfMLP(
                 trunk_depth=self.nerf_trunk_depth,
                 trunk_width=self.nerf_trunk_width,
                 rgb_branch_depth=self.nerf_rgb_branch_depth,
@@ -228,8 +315,8 @@ class NerfModel(nn.Module):
                 skips=self.nerf_skips,
                 alpha_channels=self.alpha_channels,
                 rgb_channels=self.rgb_channels,
+                dtype=self.dtype,
             )
-        }
         if self.num_fine_samples > 0:
             nerf_mlps["fine"] = modules.NerfMLP(
                 trunk_depth=self.nerf_trunk_depth,
@@ -240,6 +327,7 @@ class NerfModel(nn.Module):
                 skips=self.nerf_skips,
                 alpha_channels=self.alpha_channels,
                 rgb_channels=self.rgb_channels,
+                dtype=self.dtype,
             )
         self.nerf_mlps = nerf_mlps
 
@@ -256,6 +344,124 @@ class NerfModel(nn.Module):
     # or parts of its state and access these attributes.
     # --- End of IMPORTANT ---
 
+    @property
+    def occupancy_bound(self):
+        """The half-size of the cube covered by the occupancy grid."""
+        return self.far
+
+    def query_template_density(self, points):
+        """Evaluates the density of the template NeRF at canonical points.
+
+        This is used to refresh the occupancy grid. The conditions are built
+        like in `query_template` with a fixed view direction and the first
+        embedding of each metadata encoder.
+
+        Args:
+          points: (N, 3) points in the canonical frame.
+
+        Returns:
+          (N,) the density at each point.
+        """
+        num_points = points.shape[0]
+        points_embed = self.point_encoder(points[:, None, :], None)
+        viewdirs = jnp.broadcast_to(jnp.array([0.0, 0.0, 1.0]), (num_points, 3))
+        conditions = self.get_condition_inputs(
+            viewdirs, self._default_template_metadata(num_points))
+        raw = self.nerf_mlps[self.template_level](points_embed, *conditions)
+        return self.sigma_activation(raw["alpha"][:, 0, 0])
+
+    @staticmethod
+    def _default_template_metadata(num_points):
+        return {
+            "appearance": jnp.zeros((num_points, 1), jnp.uint32),
+            "camera": jnp.zeros((num_points, 1), jnp.uint32),
+        }
+
+    def query_template(self, points, metadata=None):
+        """Evaluates the template NeRF with a view-independent color.
+
+        The color is averaged over the six axis-aligned view directions. If the
+        model is conditioned on metadata and `metadata` is None, the first
+        embedding of each encoder is used.
+
+        Args:
+          points: (N, 3) points in the canonical frame.
+          metadata: optional metadata dictionary with (N, 1) arrays.
+
+        Returns:
+          A dictionary containing the (N,) `density` and the (N, 3) `rgb`.
+        """
+        num_points = points.shape[0]
+        if metadata is None:
+            metadata = self._default_template_metadata(num_points)
+        points_embed = self.point_encoder(points[:, None, :], None)
+        axes = jnp.concatenate([jnp.eye(3), -jnp.eye(3)], axis=0)
+        rgbs = []
+        for viewdir in axes:
+            viewdirs = jnp.broadcast_to(viewdir, (num_points, 3))
+            conditions = self.get_condition_inputs(viewdirs, metadata)
+            raw = self.nerf_mlps[self.template_level](points_embed, *conditions)
+            rgbs.append(nn.sigmoid(raw["rgb"][:, 0]))
+        return {
+            "density": self.sigma_activation(raw["alpha"][:, 0, 0]),
+            "rgb": jnp.mean(jnp.stack(rgbs, axis=0), axis=0),
+        }
+
+    def warp_samples(self, points, metadata, warp_extra, metadata_encoded=False):
+        """Warps (B, S, 3) samples into the canonical frame."""
+        if not self.use_warp:
+            return points
+        warp_out = self._apply_warp(points, metadata, warp_extra, False, metadata_encoded)
+        return warp_out["warped_points"]
+
+    def warp_jacobian(self, points, metadata, warp_extra, metadata_encoded=False):
+        """Computes the (B, S, 3, 3) Jacobian of the warp at (B, S, 3) samples."""
+        warp_out = self._apply_warp(points, metadata, warp_extra, True, metadata_encoded)
+        return warp_out["jacobian"]
+
+    def _apply_warp(
+        self, points, metadata, warp_extra, return_jacobian, metadata_encoded
+    ):
+        metadata_channels = self.num_warp_features if metadata_encoded else 1
+        warp_metadata = (
+            metadata["time"]
+            if self.warp_metadata_encoder_type == "time"
+            else metadata["warp"]
+        )
+        warp_metadata = jnp.broadcast_to(
+            warp_metadata[:, jnp.newaxis, :],
+            shape=(*points.shape[:2], metadata_channels),
+        )
+        return self.warp_field(
+            points, warp_metadata, warp_extra, return_jacobian, metadata_encoded
+        )
+
+    def encode_metadata(self, metadata, warp_extra):
+        """Encodes the metadata of a single frame.
+
+        The result can be broadcast to every ray of the frame and passed to
+        `__call__` with `metadata_encoded=True` so that the metadata encoders
+        are not evaluated per sample.
+
+        Args:
+          metadata: a dictionary of (1,) metadata arrays.
+          warp_extra: the extra warp parameters.
+
+        Returns:
+          A dictionary with the (C,) embedding of each metadata entry.
+        """
+        encoded = {}
+        if self.use_appearance_metadata:
+            encoded["appearance"] = self.appearance_encoder(metadata["appearance"])
+        if self.use_camera_metadata:
+            encoded["camera"] = self.camera_encoder(metadata["camera"])
+        if self.use_warp:
+            key = "time" if self.warp_metadata_encoder_type == "time" else "warp"
+            encoded[key] = self.warp_field.encode_metadata(
+                metadata[key], warp_extra.get("time_alpha")
+            )
+        return encoded
+
     def get_condition_inputs(self, viewdirs, metadata, metadata_encoded=False):
         """Create the condition inputs for the NeRF template."""
         trunk_conditions = []
@@ -314,7 +520,24 @@ class NerfModel(nn.Module):
         metadata_encoded=False,
         return_points=False,
         return_weights=False,
+        sample_mask=None,
+        termination_threshold=None,
+        occupied_cdf=None,
     ):
+        """Renders the samples along a batch of rays.
+
+        If `occupied_cdf` is given (see `sample_along_rays_occupancy`) the
+        distance between samples only counts the occupied space between them.
+
+        If `sample_mask` is given only the masked samples are evaluated. They
+        are compacted into a dense batch of `termination_sample_fraction` of
+        the samples and the remaining samples are given zero density. The
+        warp Jacobian is not computed in this case. The output then contains
+        the number of `skipped_samples` behind the termination depth of each
+        ray, the number of `alive_samples` in front of it and the number of
+        `overflow_samples` which were alive but did not fit into the batch. The render of a ray is only exact if it has no
+        overflow samples.
+        """
 
         print(f"--- Entering NerfModel.render_samples (level: {level}) ---")
         # Add checks for inputs if needed, but during init they should be JAX arrays
@@ -353,17 +576,158 @@ class NerfModel(nn.Module):
                 f"warp_metadata after broadcast_to type: {type(warp_metadata)}"
             )  # Should be JAX array
 
+        if sample_mask is not None:
+            num_rays, num_samples = sample_mask.shape
+            capacity = max(
+                1, int(num_rays * num_samples * self.termination_sample_fraction)
+            )
+            ray_indices, sample_indices, valid = model_utils.compact_samples(
+                sample_mask, capacity
+            )
+            # Evaluate the compacted samples as a batch of single-sample rays.
+            points = points[ray_indices, sample_indices][:, jnp.newaxis, :]
+            if use_warp:
+                warp_metadata = warp_metadata[ray_indices, sample_indices][
+                    :, jnp.newaxis, :
+                ]
+            gather = lambda c: None if c is None else c[ray_indices]
+            trunk_condition = gather(trunk_condition)
+            alpha_condition = gather(alpha_condition)
+            rgb_condition = gather(rgb_condition)
+            use_warp_jacobian = False
+            num_kept = jnp.zeros((num_rays,), jnp.float32).at[ray_indices].add(
+                valid.astype(jnp.float32)
+            )
+            num_alive = sample_mask.sum(axis=-1).astype(jnp.float32)
+            out["skipped_samples"] = num_samples - num_alive
+            out["alive_samples"] = num_alive
+            out["overflow_samples"] = num_alive - num_kept
+
+        if use_warp and warp_extra.get("warp_grid") is not None:
+            # Warp with a cached displacement grid. See `warp_cache`.
+            points = warp_cache.warp_points(warp_extra["warp_grid"], points, self.far)
+        elif use_warp:
             # Call to warp_field.__call__ happens here
             print("Calling warp_field...")
             warp_out = self.warp_field(
                 points, warp_metadata, warp_extra, use_warp_jacobian, metadata_encoded
             )
             print("Warp_field called.")
-            # ... rest of the method
-        # ... rest of render_samples
+            points = warp_out["warped_points"]
+            if "jacobian" in warp_out:
+                out["warp_jacobian"] = warp_out["jacobian"]
+            if return_points and sample_mask is None:
+                out["warped_points"] = warp_out["warped_points"]
+
+        points_embed = self.point_encoder(points, warp_extra.get("nerf_alpha"))
+
+        raw = self.nerf_mlps[level](
+            points_embed, trunk_condition, alpha_condition, rgb_condition
+        )
+        rgb = nn.sigmoid(raw["rgb"])
+        sigma = self.sigma_activation(jnp.squeeze(raw["alpha"], axis=-1))
+        interval_lengths = None
+        if occupied_cdf is not None:
+            interval_lengths = model_utils.occupied_interval_lengths(
+                occupied_cdf, z_vals
+            )
+        if sample_mask is not None:
+            # Scatter the compacted samples back. Padding entries all point to
+            # the first sample so they are added as zeros.
+            rgb = jnp.zeros((num_rays, num_samples, 3), rgb.dtype).at[
+                ray_indices, sample_indices
+            ].add(jnp.where(valid[:, None], rgb[:, 0], 0.0))
+            sigma = jnp.zeros((num_rays, num_samples), sigma.dtype).at[
+                ray_indices, sample_indices
+            ].add(jnp.where(valid, sigma[:, 0], 0.0))
+        out.update(
+            model_utils.volumetric_rendering(
+                rgb,
+                sigma,
+                z_vals,
+                directions,
+                use_white_background=self.use_white_background,
+                sample_at_infinity=self.use_sample_at_infinity,
+                return_weights=True,
+                termination_threshold=termination_threshold,
+                interval_lengths=interval_lengths,
+            )
+        )
         print(f"--- Exiting NerfModel.render_samples ---")
         return out
 
+    def render_proposal(
+        self,
+        points,
+        z_vals,
+        directions,
+        metadata,
+        warp_extra,
+        metadata_encoded,
+        occupied_cdf=None,
+    ):
+        """Computes the sample weights of the proposal density MLP.
+
+        The proposal is evaluated at the unwarped samples and conditioned on the
+        per-ray warp embedding so that neither the warp field nor the NeRF MLP
+        are evaluated at the coarse samples.
+
+        Returns:
+          A dictionary with the (B, S) `z_vals` and `weights` of the samples.
+        """
+        inputs = [self.proposal_point_encoder(points)]
+        if self.use_warp:
+            key = "time" if self.warp_metadata_encoder_type == "time" else "warp"
+            if metadata_encoded:
+                warp_embed = metadata[key]
+            else:
+                warp_embed = self.warp_field.encode_metadata(
+                    metadata[key], warp_extra.get("time_alpha")
+                )
+            inputs.append(
+                jnp.broadcast_to(
+                    warp_embed[:, jnp.newaxis, :],
+                    (*points.shape[:2], warp_embed.shape[-1]),
+                )
+            )
+        raw = self.proposal_mlp(jnp.concatenate(inputs, axis=-1))
+        sigma = self.sigma_activation(jnp.squeeze(raw, axis=-1))
+        interval_lengths = None
+        if occupied_cdf is not None:
+            interval_lengths = model_utils.occupied_interval_lengths(
+                occupied_cdf, z_vals
+            )
+        weights = model_utils.volumetric_rendering(
+            jnp.zeros_like(points),
+            sigma,
+            z_vals,
+            directions,
+            use_white_background=False,
+            sample_at_infinity=self.use_sample_at_infinity,
+            return_weights=True,
+            interval_lengths=interval_lengths,
+        )["weights"]
+        return {"z_vals": z_vals, "weights": weights}
+
+    def select_warp_jacobian(
+        self, ret, points, metadata, warp_extra, metadata_encoded, reduce, topk
+    ):
+        """Computes the warp Jacobian at the samples used by the elastic loss."""
+        weights = jax.lax.stop_gradient(ret["weights"])
+        if reduce == "median":
+            indices = model_utils.compute_depth_index(weights)[..., None]
+        elif reduce == "topk":
+            _, indices = jax.lax.top_k(weights, topk)
+        else:
+            raise ValueError(f"Unknown warp Jacobian reduction {reduce!r}")
+        ret["warp_jacobian"] = self.warp_jacobian(
+            jnp.take_along_axis(points, indices[..., None], axis=-2),
+            metadata,
+            warp_extra,
+            metadata_encoded,
+        )
+        ret["warp_jacobian_weights"] = jnp.take_along_axis(weights, indices, axis=-1)
+
     def __call__(  # This method is traced during model.init
         self,
         rays_dict: Dict[str, Any],
@@ -374,7 +738,19 @@ class NerfModel(nn.Module):
         return_weights=False,
         return_warp_jacobian=False,
         deterministic=False,
+        occupancy_grid=None,
+        warp_jacobian_reduce=None,
+        warp_jacobian_topk=1,
     ):
+        """Renders a batch of rays.
+
+        If `warp_jacobian_reduce` is given the warp Jacobian is only computed at
+        the samples which the elastic loss uses: the median depth sample
+        ('median') or the `warp_jacobian_topk` samples with the largest weights
+        ('topk'). The output of the first NeRF level (coarse, or fine when using
+        the proposal network) then contains the (B, K, 3, 3) `warp_jacobian` and
+        the (B, K) `warp_jacobian_weights` of the selected samples.
+        """
 
         print(f"--- Entering NerfModel.__call__ ---")
         # Add checks for inputs received during init
@@ -394,51 +770,115 @@ class NerfModel(nn.Module):
 
         # Evaluate coarse samples.
         print("Sampling coarse rays...")
-        z_vals, points = (
-            model_utils.sample_along_rays(  # Error could be here too if inputs are wrong type
+        occupied_cdf = None
+        if self.use_occupancy_grid and occupancy_grid is not None:
+            occupancy_fn = functools.partial(
+                occupancy.query, occupancy_grid, bound=self.occupancy_bound
+            )
+            z_vals, points, occupied_cdf = model_utils.sample_along_rays_occupancy(
                 self.make_rng("coarse"),
                 origins,
                 directions,
-                self.num_coarse_samples,  # This is an integer, fine
-                self.near,  # Float, fine
-                self.far,  # Float, fine
-                self.use_stratified_sampling,  # Bool, fine
-                self.use_linear_disparity,  # Bool, fine
+                self.num_coarse_samples,
+                self.near,
+                self.far,
+                occupancy_fn,
+                self.num_occupancy_candidates,
+                self.use_stratified_sampling,
+                self.use_linear_disparity,
+            )
+        else:
+            z_vals, points = (
+                model_utils.sample_along_rays(  # Error could be here too if inputs are wrong type
+                    self.make_rng("coarse"),
+                    origins,
+                    directions,
+                    self.num_coarse_samples,  # This is an integer, fine
+                    self.near,  # Float, fine
+                    self.far,  # Float, fine
+                    self.use_stratified_sampling,  # Bool, fine
+                    self.use_linear_disparity,  # Bool, fine
+                )
             )
-        )
         print("Coarse rays sampled.")
-        print("Rendering coarse samples...")
-        coarse_ret = self.render_samples(  # Calls render_samples
-            "coarse",
-            points,
-            z_vals,
-            directions,
-            viewdirs,
-            metadata,
-            warp_extra,
-            use_warp=use_warp,
-            use_warp_jacobian=return_warp_jacobian or self.use_warp_jacobian,
-            metadata_encoded=metadata_encoded,
-            return_points=return_points,
-            return_weights=True,
+        use_warp_jacobian = return_warp_jacobian or self.use_warp_jacobian
+        reduce_warp_jacobian = (
+            use_warp and use_warp_jacobian and warp_jacobian_reduce is not None
         )
-        print("Coarse samples rendered.")
-        out = {"coarse": coarse_ret}
+        # The Jacobian is computed by the first level which evaluates the NeRF.
+        jacobian_level = self.template_level
+        out = {}
+        if self.use_proposal_network:
+            out["proposal"] = self.render_proposal(
+                points,
+                z_vals,
+                directions,
+                metadata,
+                warp_extra,
+                metadata_encoded,
+                occupied_cdf=occupied_cdf,
+            )
+            coarse_weights = out["proposal"]["weights"]
+        else:
+            print("Rendering coarse samples...")
+            out["coarse"] = self.render_samples(  # Calls render_samples
+                "coarse",
+                points,
+                z_vals,
+                directions,
+                viewdirs,
+                metadata,
+                warp_extra,
+                use_warp=use_warp,
+                use_warp_jacobian=use_warp_jacobian and not reduce_warp_jacobian,
+                metadata_encoded=metadata_encoded,
+                return_points=return_points,
+                return_weights=True,
+                occupied_cdf=occupied_cdf,
+            )
+            coarse_weights = out["coarse"]["weights"]
+            print("Coarse samples rendered.")
+            if reduce_warp_jacobian:
+                self.select_warp_jacobian(
+                    out["coarse"],
+                    points,
+                    metadata,
+                    warp_extra,
+                    metadata_encoded,
+                    warp_jacobian_reduce,
+                    warp_jacobian_topk,
+                )
 
         # Evaluate fine samples.
         if self.num_fine_samples > 0:
             print("Sampling fine rays...")
+            coarse_z_vals = z_vals
             z_vals_mid = 0.5 * (z_vals[..., 1:] + z_vals[..., :-1])
             z_vals, points = model_utils.sample_pdf(  # Error could be here too
                 self.make_rng("fine"),
                 z_vals_mid,
-                coarse_ret["weights"][..., 1:-1],
+                coarse_weights[..., 1:-1],
                 origins,
                 directions,
+                z_vals,
                 self.num_fine_samples,  # Integer, fine
                 self.use_stratified_sampling,  # Bool, fine
             )
             print("Fine rays sampled.")
+            sample_mask = None
+            termination_threshold = None
+            if self.use_early_termination and not self.use_stratified_sampling:
+                termination_threshold = self.termination_threshold
+                sample_mask = model_utils.early_termination_mask(
+                    coarse_z_vals,
+                    coarse_weights,
+                    z_vals,
+                    termination_threshold,
+                )
+            if jacobian_level == "fine":
+                fine_warp_jacobian = use_warp_jacobian and not reduce_warp_jacobian
+            else:
+                fine_warp_jacobian = return_warp_jacobian
             print("Rendering fine samples...")
             out["fine"] = self.render_samples(  # Calls render_samples again
                 "fine",
@@ -449,18 +889,36 @@ class NerfModel(nn.Module):
                 metadata,
                 warp_extra,
                 use_warp=use_warp,
-                use_warp_jacobian=return_warp_jacobian,
+                use_warp_jacobian=fine_warp_jacobian,
                 metadata_encoded=metadata_encoded,
                 return_points=return_points,
-                return_weights=return_weights,
+                return_weights=True,
+                sample_mask=sample_mask,
+                termination_threshold=termination_threshold,
+                occupied_cdf=occupied_cdf,
             )
             print("Fine samples rendered.")
+            if self.use_proposal_network:
+                # The proposal weights are supervised by the fine weights.
+                out["proposal"]["target_z_vals"] = z_vals
+                out["proposal"]["target_weights"] = jax.lax.stop_gradient(
+                    out["fine"]["weights"]
+                )
+            if reduce_warp_jacobian and jacobian_level == "fine":
+                self.select_warp_jacobian(
+                    out["fine"],
+                    points,
+                    metadata,
+                    warp_extra,
+                    metadata_encoded,
+                    warp_jacobian_reduce,
+                    warp_jacobian_topk,
+                )
 
         if not return_weights:
-            if "weights" in out["coarse"]:
-                del out["coarse"]["weights"]
-            if "fine" in out and "weights" in out["fine"]:
-                del out["fine"]["weights"]
+            for level in ("coarse", "fine"):
+                if level in out and "weights" in out[level]:
+                    del out[level]["weights"]
 
         print(f"--- Exiting NerfModel.__call__ ---")
         return out
@@ -553,6 +1011,18 @@ def construct_nerf(
         warp_field_type=config.warp_field_type,
         warp_metadata_encoder_type=config.warp_metadata_encoder_type,
         warp_kwargs=immutabledict.immutabledict(config.warp_kwargs),
+        nerf_point_encoder_type=config.nerf_point_encoder_type,
+        warp_point_encoder_type=config.warp_point_encoder_type,
+        hash_grid_kwargs=immutabledict.immutabledict(config.hash_grid_kwargs),
+        use_occupancy_grid=config.use_occupancy_grid,
+        num_occupancy_candidates=config.num_occupancy_candidates,
+        use_early_termination=config.use_early_termination,
+        termination_threshold=config.termination_threshold,
+        termination_sample_fraction=config.termination_sample_fraction,
+        use_proposal_network=config.use_proposal_network,
+        proposal_depth=config.proposal_depth,
+        proposal_width=config.proposal_width,
+        dtype=jnp.dtype(config.dtype),
     )
 
     init_rays_dict = {
@@ -19,12 +19,16 @@ from typing import Optional, Tuple
 from flax import linen as nn
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 from nerfies import types
 
 
 class MLP(nn.Module):
-  """Basic MLP class with hidden layers and an output layers."""
+  """Basic MLP class with hidden layers and an output layers.
+
+  The layers compute in `dtype` while the parameters are kept in float32.
+  """
   depth: int
   width: int
   hidden_init: types.Initializer = nn.initializers.xavier_uniform()
@@ -34,6 +38,7 @@ class MLP(nn.Module):
   output_activation: Optional[types.Activation] = lambda x: x
   use_bias: bool = True
   skips: Tuple[int] = tuple()
+  dtype: types.Dtype = jnp.float32
 
   @nn.compact
   def __call__(self, x):
@@ -43,6 +48,7 @@ class MLP(nn.Module):
           self.width,
           use_bias=self.use_bias,
           kernel_init=self.hidden_init,
+          dtype=self.dtype,
           name=f'hidden_{i}')
       if i in self.skips:
         x = jnp.concatenate([x, inputs], axis=-1)
@@ -54,6 +60,7 @@ class MLP(nn.Module):
           self.output_channels,
           use_bias=self.use_bias,
           kernel_init=self.output_init,
+          dtype=self.dtype,
           name='logit')
       x = logit_layer(x)
       if self.output_activation is not None:
@@ -76,6 +83,7 @@ class NerfMLP(nn.Module):
     rgb_channels: int, the number of rgb_channelss.
     condition_density: if True put the condition at the begining which
       conditions the density of the field.
+    dtype: the dtype of the computation. The outputs are always float32.
   """
   trunk_depth: int = 8
   trunk_width: int = 256
@@ -90,6 +98,7 @@ class NerfMLP(nn.Module):
 
   activation: types.Activation = nn.relu
   skips: Tuple[int] = (4,)
+  dtype: types.Dtype = jnp.float32
 
   @nn.compact
   def __call__(self, x, trunk_condition, alpha_condition, rgb_condition):
@@ -105,7 +114,9 @@ class NerfMLP(nn.Module):
       raw: [batch, num_coarse_samples, rgb_channels+alpha_channels].
     """
     dense = functools.partial(
-        nn.Dense, kernel_init=jax.nn.initializers.glorot_uniform())
+        nn.Dense,
+        kernel_init=jax.nn.initializers.glorot_uniform(),
+        dtype=self.dtype)
 
     feature_dim = x.shape[-1]
     num_samples = x.shape[1]
@@ -125,19 +136,22 @@ class NerfMLP(nn.Module):
                     width=self.trunk_width,
                     hidden_activation=self.activation,
                     hidden_init=jax.nn.initializers.glorot_uniform(),
-                    skips=self.skips)
+                    skips=self.skips,
+                    dtype=self.dtype)
     rgb_mlp = MLP(depth=self.rgb_branch_depth,
                   width=self.rgb_branch_width,
                   hidden_activation=self.activation,
                   hidden_init=jax.nn.initializers.glorot_uniform(),
                   output_init=jax.nn.initializers.glorot_uniform(),
-                  output_channels=self.rgb_channels)
+                  output_channels=self.rgb_channels,
+                  dtype=self.dtype)
     alpha_mlp = MLP(depth=self.alpha_branch_depth,
                     width=self.alpha_branch_width,
                     hidden_activation=self.activation,
                     hidden_init=jax.nn.initializers.glorot_uniform(),
                     output_init=jax.nn.initializers.glorot_uniform(),
-                    output_channels=self.alpha_channels)
+                    output_channels=self.alpha_channels,
+                    dtype=self.dtype)
 
     if trunk_condition is not None:
       trunk_condition = broadcast_condition(trunk_condition)
@@ -163,9 +177,12 @@ class NerfMLP(nn.Module):
       rgb_input = x
     rgb = rgb_mlp(rgb_input)
 
+    # Rendering accumulates over samples so it always runs in float32.
     return {
-        'rgb': rgb.reshape((-1, num_samples, self.rgb_channels)),
-        'alpha': alpha.reshape((-1, num_samples, self.alpha_channels)),
+        'rgb': rgb.reshape(
+            (-1, num_samples, self.rgb_channels)).astype(jnp.float32),
+        'alpha': alpha.reshape(
+            (-1, num_samples, self.alpha_channels)).astype(jnp.float32),
     }
 
 
@@ -294,6 +311,140 @@ class AnnealedSinusoidalEncoder(nn.Module):
     return 0.5 * (1 + jnp.cos(jnp.pi * x + jnp.pi))
 
 
+def _hash_grid_table_init(key, shape, dtype=jnp.float32):
+  return jax.random.uniform(key, shape, dtype, minval=-1e-4, maxval=1e-4)
+
+
+class HashGridEncoder(nn.Module):
+  """A multiresolution hash-grid encoding of a single point.
+
+  Each level is a grid whose vertices hold learned features. Coarse levels
+  with fewer vertices than the table size are indexed densely and finer levels
+  are hashed. The features of the 8 vertices around the point are trilinearly
+  interpolated and the levels are concatenated.
+
+  If `alpha` is given the levels are eased in one by one as alpha goes from 0
+  to `num_levels` using the same window as `AnnealedSinusoidalEncoder`.
+
+  Attributes:
+    num_levels: the number of grid levels.
+    features_per_level: the number of features stored per vertex.
+    log2_hashmap_size: the log (base 2) of the table size of each level.
+    base_resolution: the resolution of the coarsest level.
+    max_resolution: the resolution of the finest level.
+    bound: the grid covers [-bound, bound]^3. Points outside are clamped.
+    use_identity: if True prepend the point to the features.
+  """
+  num_levels: int = 16
+  features_per_level: int = 2
+  log2_hashmap_size: int = 19
+  base_resolution: int = 16
+  max_resolution: int = 2048
+  bound: float = 1.0
+  use_identity: bool = True
+
+  # Primes used by the spatial hash function from Teschner et al. 2003.
+  primes = (1, 2654435761, 805459861)
+
+  def level_resolutions(self) -> np.ndarray:
+    if self.num_levels > 1:
+      growth = np.exp(
+          (np.log(self.max_resolution) - np.log(self.base_resolution))
+          / (self.num_levels - 1))
+    else:
+      growth = 1.0
+    return np.floor(
+        self.base_resolution * growth ** np.arange(self.num_levels))
+
+  @nn.compact
+  def __call__(self, x, alpha: Optional[float] = None):
+    table_size = 2 ** self.log2_hashmap_size
+    table = self.param(
+        'table', _hash_grid_table_init,
+        (self.num_levels, table_size, self.features_per_level))
+
+    resolutions = self.level_resolutions()
+    # Levels whose vertices all fit in the table are indexed without hashing.
+    use_dense = (resolutions + 1) ** 3 <= table_size
+
+    # (L, 3) position of the point in each level's vertex coordinates.
+    normalized = jnp.clip((x / self.bound + 1.0) * 0.5, 0.0, 1.0)
+    scaled = normalized[None, :] * resolutions[:, None]
+    base = jnp.floor(scaled)
+    frac = scaled - base
+    base = base.astype(jnp.uint32)
+
+    # (8, 3) offsets of the corners of a cell.
+    offsets = np.stack(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij'),
+                       axis=-1).reshape((8, 3)).astype(np.uint32)
+    # (L, 8, 3) integer vertex coordinates.
+    corners = base[:, None, :] + offsets[None, :, :]
+
+    strides = np.stack([np.ones_like(resolutions),
+                        resolutions + 1,
+                        (resolutions + 1) ** 2], axis=-1)
+    strides = np.where(use_dense[:, None], strides, 0).astype(np.uint32)
+    dense_index = jnp.sum(corners * strides[:, None, :], axis=-1)
+    primes = np.asarray(self.primes, dtype=np.uint32)
+    hashed = corners * primes
+    hashed_index = hashed[..., 0] ^ hashed[..., 1] ^ hashed[..., 2]
+    index = jnp.where(use_dense[:, None], dense_index, hashed_index)
+    index = (index % table_size).astype(jnp.int32)
+
+    # (L, 8, F) vertex features.
+    level_index = np.arange(self.num_levels)[:, None]
+    vertex_features = table[level_index, index]
+    # (L, 8) trilinear weights.
+    weights = jnp.prod(
+        jnp.where(offsets[None, :, :] == 1,
+                  frac[:, None, :], 1.0 - frac[:, None, :]),
+        axis=-1)
+    features = jnp.sum(weights[..., None] * vertex_features, axis=-2)
+
+    if alpha is not None:
+      window = AnnealedSinusoidalEncoder.cosine_easing_window(
+          0, self.num_levels - 1, self.num_levels, alpha)
+      features = window[:, None] * features
+
+    features = features.flatten()
+    if self.use_identity:
+      features = jnp.concatenate([x, features], axis=-1)
+    return features
+
+
+def create_point_encoder(encoder_type: str,
+                         num_freqs: int,
+                         min_freq_log2: int = 0,
+                         max_freq_log2: Optional[int] = None,
+                         use_identity: bool = True,
+                         annealed: bool = False,
+                         hash_grid_kwargs=None):
+  """Creates a point encoder.
+
+  Args:
+    encoder_type: either 'sinusoidal' or 'hash_grid'.
+    num_freqs: the number of frequencies of the sinusoidal encoder.
+    min_freq_log2: the lower frequency of the sinusoidal encoder.
+    max_freq_log2: the upper frequency of the sinusoidal encoder.
+    use_identity: if True the encoding includes the point itself.
+    annealed: if True the sinusoidal encoder requires an `alpha`.
+    hash_grid_kwargs: extra arguments for `HashGridEncoder`.
+
+  Returns:
+    An encoder module which is called as `encoder(x, alpha)`.
+  """
+  if encoder_type == 'sinusoidal':
+    encoder_cls = AnnealedSinusoidalEncoder if annealed else SinusoidalEncoder
+    return encoder_cls(num_freqs=num_freqs,
+                       min_freq_log2=min_freq_log2,
+                       max_freq_log2=max_freq_log2,
+                       use_identity=use_identity)
+  elif encoder_type == 'hash_grid':
+    return HashGridEncoder(use_identity=use_identity,
+                           **(hash_grid_kwargs or {}))
+  raise ValueError(f'Unknown point encoder type {encoder_type!r}')
+
+
 class TimeEncoder(nn.Module):
   """Encodes a timestamp to an embedding."""
   num_freqs: int
@@ -0,0 +1,158 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Occupancy grids for empty-space skipping.
+
+The grid is a boolean voxel grid covering the cube [-bound, bound]^3 where
+`bound` is the far plane of the scene. Points outside of the grid are always
+considered occupied so that the grid can only ever remove samples from space
+that is known to be empty.
+"""
+from typing import Callable
+
+import jax
+from jax import numpy as jnp
+import numpy as np
+
+
+def create_grid(resolution: int, occupied: bool = True) -> np.ndarray:
+  """Creates a grid where every cell is either occupied or empty."""
+  return np.full((resolution,) * 3, fill_value=occupied, dtype=np.bool_)
+
+
+def cell_centers(resolution: int, bound: float) -> np.ndarray:
+  """Returns the world-space centers of each cell with shape (R, R, R, 3)."""
+  ticks = (np.arange(resolution, dtype=np.float32) + 0.5) / resolution
+  ticks = (2.0 * ticks - 1.0) * bound
+  grid = np.stack(np.meshgrid(ticks, ticks, ticks, indexing='ij'), axis=-1)
+  return grid.astype(np.float32)
+
+
+def points_to_indices(points, resolution: int, bound: float):
+  """Converts world-space points to integer grid indices.
+
+  Args:
+    points: (..., 3) the points to convert.
+    resolution: the resolution of the grid.
+    bound: the half-size of the cube covered by the grid.
+
+  Returns:
+    indices: (..., 3) the integer grid indices (clipped to the grid).
+    inside: (...,) a mask which is True if the point lies inside the grid.
+  """
+  normalized = (points / bound + 1.0) * 0.5
+  inside = jnp.all((normalized >= 0.0) & (normalized < 1.0), axis=-1)
+  indices = jnp.floor(normalized * resolution).astype(jnp.int32)
+  indices = jnp.clip(indices, 0, resolution - 1)
+  return indices, inside
+
+
+def query(grid, points, bound: float):
+  """Returns True for each point that lies in an occupied (or outside) cell."""
+  resolution = grid.shape[0]
+  indices, inside = points_to_indices(points, resolution, bound)
+  occupied = grid[indices[..., 0], indices[..., 1], indices[..., 2]]
+  return jnp.where(inside, occupied, True)
+
+
+def dilate(grid: np.ndarray, radius: int = 1) -> np.ndarray:
+  """Dilates the occupied cells of a grid by `radius` cells."""
+  if radius <= 0:
+    return grid
+  out = grid.copy()
+  for axis in range(3):
+    dilated = out.copy()
+    for shift in range(1, radius + 1):
+      dilated |= np.roll(out, shift, axis=axis)
+      dilated |= np.roll(out, -shift, axis=axis)
+    out = dilated
+  return out
+
+
+def grid_from_points(points: np.ndarray,
+                     resolution: int,
+                     bound: float,
+                     dilation: int = 2) -> np.ndarray:
+  """Seeds an occupancy grid from a point cloud.
+
+  Args:
+    points: (N, 3) points in scene coordinates e.g., from
+      `NerfiesDataSource.load_points`.
+    resolution: the resolution of the grid.
+    bound: the half-size of the cube covered by the grid.
+    dilation: the number of cells to dilate each point by to account for
+      sparse reconstructions and deformation.
+
+  Returns:
+    A boolean occupancy grid.
+  """
+  grid = create_grid(resolution, occupied=False)
+  normalized = (np.asarray(points) / bound + 1.0) * 0.5
+  inside = np.all((normalized >= 0.0) & (normalized < 1.0), axis=-1)
+  indices = np.floor(normalized[inside] * resolution).astype(np.int32)
+  grid[indices[:, 0], indices[:, 1], indices[:, 2]] = True
+  return dilate(grid, dilation)
+
+
+def grid_from_density(density_fn: Callable[[np.ndarray], np.ndarray],
+                      resolution: int,
+                      bound: float,
+                      threshold: float,
+                      rng: np.random.RandomState,
+                      chunk: int = 65536,
+                      dilation: int = 1) -> np.ndarray:
+  """Computes an occupancy grid by thresholding a density field.
+
+  The density is evaluated at a jittered point inside each cell so that
+  repeated updates eventually cover the whole volume of each cell.
+
+  Args:
+    density_fn: a function mapping (N, 3) points to (N,) densities. This is
+      usually the jitted template NeRF density.
+    resolution: the resolution of the grid.
+    bound: the half-size of the cube covered by the grid.
+    threshold: cells with density above this value are considered occupied.
+    rng: the random state used to jitter the sample positions.
+    chunk: the number of points to evaluate at once.
+    dilation: the number of cells to dilate the result by. The template
+      density lives in the canonical frame so dilating provides some slack
+      for the deformation between observation and canonical space.
+
+  Returns:
+    A boolean occupancy grid.
+  """
+  cell_size = 2.0 * bound / resolution
+  points = cell_centers(resolution, bound).reshape((-1, 3))
+  jitter = rng.uniform(-0.5, 0.5, size=points.shape) * cell_size
+  points = (points + jitter).astype(np.float32)
+
+  num_points = points.shape[0]
+  densities = []
+  for i in range(0, num_points, chunk):
+    chunk_points = points[i:i + chunk]
+    num_chunk_points = chunk_points.shape[0]
+    if num_chunk_points < chunk:
+      # Pad to keep a static shape for the jitted density function.
+      chunk_points = np.pad(
+          chunk_points, ((0, chunk - num_chunk_points), (0, 0)), mode='edge')
+    chunk_density = jax.device_get(density_fn(chunk_points))
+    densities.append(np.asarray(chunk_density)[:num_chunk_points])
+  density = np.concatenate(densities, axis=0).reshape((resolution,) * 3)
+
+  return dilate(density > threshold, dilation)
+
+
+def occupancy_fraction(grid) -> float:
+  """Returns the fraction of cells which are occupied."""
+  return float(np.mean(np.asarray(grid)))
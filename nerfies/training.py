@@ -13,10 +13,13 @@
 # limitations under the License.
 
 """Library to training NeRFs."""
+from concurrent import futures
 import functools
+import json
 from typing import Any
 from typing import Callable
 from typing import Dict
+from typing import Optional
 
 from absl import logging
 from flax import struct
@@ -26,7 +29,10 @@ from jax import lax
 from jax import numpy as jnp
 from jax import random
 from jax import vmap
+import tensorflow as tf
 
+from nerfies import gpath
+from nerfies import jax_camera
 from nerfies import model_utils
 from nerfies import models
 from nerfies import utils
@@ -41,18 +47,79 @@ class ScalarParams:
   warp_reg_loss_scale: float = 0.001
   background_loss_weight: float = 0.0
   background_noise_std: float = 0.001
+  proposal_loss_weight: float = 1.0
 
 
-def save_checkpoint(path, state, keep=2):
-  """Save the state to a checkpoint."""
-  state_to_save = jax.device_get(jax.tree_map(lambda x: x[0], state))
+# Written next to the checkpoints once a checkpoint is completely saved.
+CHECKPOINT_MARKER = 'checkpoint_complete.json'
+
+
+def write_checkpoint_marker(path, step, checkpoint_path):
+  """Atomically records that the checkpoint of `step` is completely saved."""
+  marker_path = gpath.GPath(path, CHECKPOINT_MARKER)
+  tmp_path = gpath.GPath(path, f'{CHECKPOINT_MARKER}.tmp')
+  with tmp_path.open('w') as f:
+    json.dump({'step': int(step), 'path': str(checkpoint_path)}, f)
+  tf.io.gfile.rename(str(tmp_path), str(marker_path), overwrite=True)
+
+
+def read_checkpoint_marker(path):
+  """Returns the step of the last completely saved checkpoint or None."""
+  marker_path = gpath.GPath(path, CHECKPOINT_MARKER)
+  if not marker_path.exists():
+    return None
+  with marker_path.open('r') as f:
+    return json.load(f)['step']
+
+
+def _write_checkpoint(path, state_to_save, keep):
+  # Flax writes to a temporary file which is renamed into place, and removes
+  # all but the last `keep` checkpoints. The marker is written last so that
+  # readers never see a step whose checkpoint is not there yet.
   step = state_to_save.optimizer.state.step
   checkpoint_path = checkpoints.save_checkpoint(
       path, state_to_save, step, keep=keep)
+  write_checkpoint_marker(path, step, checkpoint_path)
   logging.info('Saved checkpoint: step=%d, path=%s', int(step), checkpoint_path)
   return checkpoint_path
 
 
+def save_checkpoint(path, state, keep=2):
+  """Save the state to a checkpoint."""
+  state_to_save = jax.device_get(jax.tree_map(lambda x: x[0], state))
+  return _write_checkpoint(path, state_to_save, keep)
+
+
+class AsyncCheckpointer:
+  """Saves checkpoints from a background thread.
+
+  `save` copies the replicated state to host memory and returns; serializing
+  and writing the checkpoint happen on a worker thread. At most one save is in
+  flight so a save waits for the previous one to finish. Call `wait` before
+  exiting to make sure the last checkpoint is written.
+  """
+
+  def __init__(self, path, keep=2):
+    self.path = path
+    self.keep = keep
+    self._executor = futures.ThreadPoolExecutor(max_workers=1)
+    self._future = None
+
+  def save(self, state):
+    """Snapshots the state and writes it asynchronously."""
+    self.wait()
+    state_to_save = jax.device_get(jax.tree_map(lambda x: x[0], state))
+    self._future = self._executor.submit(
+        _write_checkpoint, self.path, state_to_save, self.keep)
+
+  def wait(self):
+    """Blocks until the pending save is written and re-raises its errors."""
+    if self._future is not None:
+      future, self._future = self._future, None
+      return future.result()
+    return None
+
+
 @jax.jit
 def nearest_rotation_svd(matrix, eps=1e-6):
   """Computes the nearest rotation using SVD."""
@@ -135,6 +202,82 @@ def compute_background_loss(
   return loss
 
 
+def _outer_weights(t0_starts, t0_ends, t1, w1):
+  """Sums the weights of the intervals of `t1` overlapping each interval."""
+  cw1 = jnp.concatenate(
+      [jnp.zeros_like(w1[..., :1]), jnp.cumsum(w1, axis=-1)], axis=-1)
+  num_intervals = w1.shape[-1]
+  search = jnp.vectorize(
+      lambda t, q, side: jnp.searchsorted(t, q, side=side),
+      signature='(n),(m)->(m)',
+      excluded={2})
+  idx_lo = jnp.clip(search(t1, t0_starts, 'right') - 1, 0, num_intervals)
+  idx_hi = jnp.clip(search(t1, t0_ends, 'left'), 0, num_intervals)
+  return (jnp.take_along_axis(cw1, idx_hi, axis=-1)
+          - jnp.take_along_axis(cw1, idx_lo, axis=-1))
+
+
+def compute_proposal_loss(z_vals, weights, target_z_vals, target_weights,
+                          eps=1e-7):
+  """Computes the histogram bound loss of the proposal network.
+
+  The proposal weights summed over the intervals overlapping each interval of
+  the target histogram must bound the target weight from above. See
+  Mip-NeRF 360 (Barron et al., 2022).
+
+  Args:
+    z_vals: (B, S) the sample depths of the proposal.
+    weights: (B, S) the proposal weights.
+    target_z_vals: (B, T) the sample depths of the fine NeRF.
+    target_weights: (B, T) the fine NeRF weights. These should not have any
+      gradients.
+    eps: a small number to prevent division by zero.
+
+  Returns:
+    The mean loss.
+  """
+  # Each sample covers the interval up to the next sample.
+  far = jnp.full_like(z_vals[..., :1], 1e10)
+  edges = jnp.concatenate([z_vals, far], axis=-1)
+  target_edges = jnp.concatenate([target_z_vals, far], axis=-1)
+  bound = _outer_weights(
+      target_edges[..., :-1], target_edges[..., 1:], edges, weights)
+  loss = jnp.maximum(0.0, target_weights - bound)**2 / (target_weights + eps)
+  return loss.sum(axis=-1).mean()
+
+
+def update_loss_scale(state, new_state, grad, growth_interval: int):
+  """Skips non-finite updates and adjusts the dynamic loss scale.
+
+  The loss scale is halved and the update discarded when any gradient is not
+  finite. It is doubled after `growth_interval` consecutive finite steps.
+
+  Args:
+    state: the training state before the update.
+    new_state: the training state after applying `grad`.
+    grad: the unscaled gradients. These must already be averaged across
+      devices so that every device makes the same decision.
+    growth_interval: the number of finite steps before increasing the scale.
+
+  Returns:
+    The training state with the update applied if it was finite.
+  """
+  grad_finite = jnp.all(jnp.stack(
+      [jnp.all(jnp.isfinite(g)) for g in jax.tree_leaves(grad)]))
+  optimizer = jax.tree_multimap(
+      lambda new, old: jnp.where(grad_finite, new, old),
+      new_state.optimizer, state.optimizer)
+  finite_steps = jnp.where(grad_finite, state.loss_scale_steps + 1, 0)
+  grow = finite_steps >= growth_interval
+  loss_scale = jnp.where(
+      grad_finite,
+      jnp.where(grow, state.loss_scale * 2.0, state.loss_scale),
+      jnp.maximum(state.loss_scale * 0.5, 1.0))
+  return new_state.replace(optimizer=optimizer,
+                           loss_scale=loss_scale,
+                           loss_scale_steps=jnp.where(grow, 0, finite_steps))
+
+
 def train_step(model: models.NerfModel,
                rng_key: Callable[[int], jnp.ndarray],
                state,
@@ -144,7 +287,11 @@ def train_step(model: models.NerfModel,
                elastic_reduce_method: str = 'median',
                elastic_loss_type: str = 'log_svals',
                use_background_loss: bool = False,
-               use_warp_reg_loss: bool = False):
+               use_warp_reg_loss: bool = False,
+               return_ray_errors: bool = False,
+               elastic_topk: int = 1,
+               loss_scale_growth_interval: int = 2000,
+               cameras: Optional[jax_camera.JaxCamera] = None):
   """One optimization step.
 
   Args:
@@ -156,32 +303,54 @@ def train_step(model: models.NerfModel,
     use_elastic_loss: is True use the elastic regularization loss.
     elastic_reduce_method: which method to use to reduce the samples for the
       elastic loss. 'median' selects the median depth point sample while
-      'weight' computes a weighted sum using the density weights.
+      'weight' computes a weighted sum using the density weights. 'topk'
+      computes a weighted sum over the `elastic_topk` samples with the largest
+      weights. For 'median' and 'topk' the model only evaluates the Jacobian
+      at the selected samples.
     elastic_loss_type: which method to use for the elastic loss.
     use_background_loss: if True use the background regularization loss.
     use_warp_reg_loss: if True use the warp regularization loss.
+    elastic_topk: the number of samples used by the 'topk' elastic reduction.
+    return_ray_errors: if True `stats['ray_errors']` contains the per-ray
+      squared error of the finest level and the `item_index` of each ray in
+      the batch. These are not averaged across devices.
+    loss_scale_growth_interval: the number of finite steps after which the
+      dynamic loss scale is doubled. The loss is only scaled if
+      `state.loss_scale` is not None.
+    cameras: the batched training cameras. If given the rays are generated
+      from the `pixels` and `camera_index` of the batch.
 
   Returns:
     new_state: model_utils.TrainState, new training state.
     stats: list. [(loss, psnr), (loss_coarse, psnr_coarse)].
   """
   rng_key, fine_key, coarse_key, reg_key = random.split(rng_key, 4)
+  if cameras is not None:
+    batch = jax_camera.add_rays(cameras, batch)
 
   # pylint: disable=unused-argument
   def _compute_loss_and_stats(params, model_out, use_elastic_loss=False):
-    rgb_loss = ((model_out['rgb'] - batch['rgb'][..., :3])**2).mean()
+    sq_error = (model_out['rgb'] - batch['rgb'][..., :3])**2
+    rgb_loss = sq_error.mean()
     stats = {
         'loss/rgb': rgb_loss,
     }
     loss = rgb_loss
+    if 'loss_weights' in batch:
+      # Importance weights correct for non-uniform sampling of the rays.
+      loss = (batch['loss_weights'] * sq_error.mean(axis=-1)).mean()
+      stats['loss/rgb_weighted'] = loss
     if use_elastic_loss:
       elastic_fn = functools.partial(compute_elastic_loss,
                                      loss_type=elastic_loss_type)
       v_elastic_fn = jax.jit(vmap(vmap(jax.jit(elastic_fn))))
       weights = lax.stop_gradient(model_out['weights'])
       jacobian = model_out['warp_jacobian']
+      if 'warp_jacobian_weights' in model_out:
+        # The model only computed the Jacobian at the selected samples.
+        weights = model_out['warp_jacobian_weights']
       # Pick the median point Jacobian.
-      if elastic_reduce_method == 'median':
+      elif elastic_reduce_method == 'median':
         depth_indices = model_utils.compute_depth_index(weights)
         jacobian = jnp.take_along_axis(
             # Unsqueeze axes: sample axis, Jacobian row, Jacobian col.
@@ -189,7 +358,7 @@ def train_step(model: models.NerfModel,
       # Compute loss using Jacobian.
       elastic_loss, elastic_residual = v_elastic_fn(jacobian)
       # Multiply weight if weighting by density.
-      if elastic_reduce_method == 'weight':
+      if elastic_reduce_method in ('weight', 'topk'):
         elastic_loss = weights * elastic_loss
       elastic_loss = elastic_loss.sum(axis=-1).mean()
       stats['loss/elastic'] = elastic_loss
@@ -225,12 +394,19 @@ def train_step(model: models.NerfModel,
     stats['metric/psnr'] = utils.compute_psnr(rgb_loss)
     return loss, stats
 
+  warp_jacobian_reduce = None
+  if use_elastic_loss and elastic_reduce_method in ('median', 'topk'):
+    warp_jacobian_reduce = elastic_reduce_method
+
   def _loss_fn(params):
     ret = model.apply({'params': params['model']},
                       batch,
                       warp_extra=state.warp_extra,
                       return_points=use_warp_reg_loss,
                       return_weights=(use_warp_reg_loss or use_elastic_loss),
+                      occupancy_grid=state.occupancy_grid,
+                      warp_jacobian_reduce=warp_jacobian_reduce,
+                      warp_jacobian_topk=elastic_topk,
                       rngs={
                           'fine': fine_key,
                           'coarse': coarse_key
@@ -238,12 +414,19 @@ def train_step(model: models.NerfModel,
 
     losses = {}
     stats = {}
+    # The elastic loss uses the first level which evaluates the warp.
+    elastic_level = 'coarse' if 'coarse' in ret else 'fine'
     if 'fine' in ret:
       losses['fine'], stats['fine'] = _compute_loss_and_stats(
-          params, ret['fine'])
+          params, ret['fine'],
+          use_elastic_loss=use_elastic_loss and elastic_level == 'fine')
     if 'coarse' in ret:
       losses['coarse'], stats['coarse'] = _compute_loss_and_stats(
           params, ret['coarse'], use_elastic_loss=use_elastic_loss)
+    if 'proposal' in ret:
+      proposal_loss = compute_proposal_loss(**ret['proposal'])
+      losses['proposal'] = scalar_params.proposal_loss_weight * proposal_loss
+      stats['proposal_loss'] = proposal_loss
 
     if use_background_loss:
       background_loss = compute_background_loss(
@@ -258,14 +441,38 @@ def train_step(model: models.NerfModel,
           scalar_params.background_loss_weight * background_loss)
       stats['background_loss'] = background_loss
 
+    if return_ray_errors:
+      level = 'fine' if 'fine' in ret else 'coarse'
+      ray_error = ((ret[level]['rgb'] - batch['rgb'][..., :3])**2).mean(axis=-1)
+      stats['ray_errors'] = {
+          'item_index': batch['item_index'],
+          'error': lax.stop_gradient(ray_error),
+      }
+
     return sum(losses.values()), stats
 
+  use_loss_scale = state.loss_scale is not None
+
+  def _scaled_loss_fn(params):
+    loss, stats = _loss_fn(params)
+    return loss * state.loss_scale, stats
+
   optimizer = state.optimizer
-  grad_fn = jax.value_and_grad(_loss_fn, has_aux=True)
+  grad_fn = jax.value_and_grad(
+      _scaled_loss_fn if use_loss_scale else _loss_fn, has_aux=True)
   (_, stats), grad = grad_fn(optimizer.target)
+  if use_loss_scale:
+    grad = jax.tree_map(lambda g: g / state.loss_scale, grad)
+  ray_errors = stats.pop('ray_errors', None)
   grad = jax.lax.pmean(grad, axis_name='batch')
   stats = jax.lax.pmean(stats, axis_name='batch')
+  if ray_errors is not None:
+    stats['ray_errors'] = ray_errors
   new_optimizer = optimizer.apply_gradient(
       grad, learning_rate=scalar_params.learning_rate)
   new_state = state.replace(optimizer=new_optimizer)
+  if use_loss_scale:
+    new_state = update_loss_scale(
+        state, new_state, grad, loss_scale_growth_interval)
+    stats['loss_scale'] = new_state.loss_scale
   return new_state, stats, rng_key
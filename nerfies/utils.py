@@ -29,6 +29,8 @@ from scipy import interpolate
 from scipy.spatial import transform as scipy_transform
 import tqdm
 
+from nerfies import camera as camera_lib
+
 
 # pylint: disable=unused-argument
 @functools.partial(jax.custom_jvp, nondiff_argnums=(1, 2, 3))
@@ -151,32 +153,29 @@ def interpolate_cameras(cameras, num_samples: int):
       num_samples: the number of output cameras.
 
     Returns:
-      (List[vision_sfm.Camera]): a list of interpolated cameras.
+      The interpolated cameras. This is a `CameraBatch` if `cameras` is a
+      `CameraBatch` and a list of cameras otherwise.
     """
-    rotations = []
-    positions = []
-    for camera in cameras:
-        rotations.append(camera.orientation)
-        positions.append(camera.position)
+    if isinstance(cameras, camera_lib.CameraBatch):
+        batch = cameras
+    else:
+        batch = camera_lib.CameraBatch.from_cameras(
+            cameras, dtype=cameras[0].dtype)
 
-    in_times = np.linspace(0, 1, len(rotations))
+    in_times = np.linspace(0, 1, len(batch))
     slerp = scipy_transform.Slerp(
-        in_times, scipy_transform.Rotation.from_dcm(rotations)
+        in_times, scipy_transform.Rotation.from_dcm(batch.orientation)
     )
-    spline = interpolate.CubicSpline(in_times, positions)
+    spline = interpolate.CubicSpline(in_times, batch.position)
 
     out_times = np.linspace(0, 1, num_samples)
-    out_rots = slerp(out_times).as_dcm()
-    out_positions = spline(out_times)
-
-    ref_camera = cameras[0]
-    out_cameras = []
-    for out_rot, out_pos in zip(out_rots, out_positions):
-        out_camera = ref_camera.copy()
-        out_camera.orientation = out_rot
-        out_camera.position = out_pos
-        out_cameras.append(out_camera)
-    return out_cameras
+    # All output cameras share the intrinsics of the first camera.
+    out_batch = batch[np.zeros(num_samples, dtype=np.int64)]
+    out_batch.orientation = slerp(out_times).as_dcm().astype(batch.dtype)
+    out_batch.position = spline(out_times).astype(batch.dtype)
+    if isinstance(cameras, camera_lib.CameraBatch):
+        return out_batch
+    return out_batch.to_cameras()
 
 
 def logit(y):
@@ -0,0 +1,113 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches of the warp field evaluated on a voxel grid.
+
+When rendering many frames with the same deformation code (e.g., freezing
+time while moving the camera) the warp is the same for every frame. The warp
+displacement is evaluated once at the vertices of a dense grid covering
+[-bound, bound]^3 and samples are then warped by trilinear interpolation
+instead of evaluating the warp MLP.
+"""
+import collections
+from typing import Callable, Hashable
+
+import jax
+from jax import numpy as jnp
+import numpy as np
+
+
+def compute_warp_grid(warp_fn: Callable[[np.ndarray], np.ndarray],
+                      resolution: int,
+                      bound: float,
+                      chunk: int = 65536) -> np.ndarray:
+  """Evaluates the warp displacement at the vertices of a grid.
+
+  Args:
+    warp_fn: a function mapping (N, 3) points to (N, 3) warped points.
+    resolution: the number of cells along each axis.
+    bound: the half-size of the cube covered by the grid.
+    chunk: the number of points to evaluate at once.
+
+  Returns:
+    A (R+1, R+1, R+1, 3) array of the displacement at each vertex.
+  """
+  ticks = np.linspace(-bound, bound, resolution + 1, dtype=np.float32)
+  vertices = np.stack(np.meshgrid(ticks, ticks, ticks, indexing='ij'), axis=-1)
+  vertices = vertices.reshape((-1, 3))
+  num_points = vertices.shape[0]
+  displacements = []
+  for i in range(0, num_points, chunk):
+    chunk_points = vertices[i:i + chunk]
+    num_chunk_points = chunk_points.shape[0]
+    if num_chunk_points < chunk:
+      chunk_points = np.pad(
+          chunk_points, ((0, chunk - num_chunk_points), (0, 0)), mode='edge')
+    warped = np.asarray(jax.device_get(warp_fn(chunk_points)))
+    displacements.append((warped - chunk_points)[:num_chunk_points])
+  displacement = np.concatenate(displacements, axis=0)
+  return displacement.reshape((resolution + 1,) * 3 + (3,))
+
+
+def warp_points(grid, points, bound: float):
+  """Warps points by trilinearly interpolating a displacement grid.
+
+  Points outside of the grid use the displacement at the boundary.
+
+  Args:
+    grid: (R+1, R+1, R+1, 3) the displacement grid.
+    points: (..., 3) the points to warp.
+    bound: the half-size of the cube covered by the grid.
+
+  Returns:
+    The (..., 3) warped points.
+  """
+  resolution = grid.shape[0] - 1
+  coords = (points / bound + 1.0) * 0.5 * resolution
+  coords = jnp.clip(coords, 0.0, resolution - 1e-4)
+  base = jnp.floor(coords).astype(jnp.int32)
+  frac = coords - base
+  displacement = jnp.zeros_like(points)
+  for dx in (0, 1):
+    for dy in (0, 1):
+      for dz in (0, 1):
+        corner = grid[base[..., 0] + dx, base[..., 1] + dy, base[..., 2] + dz]
+        weight = ((frac[..., 0] if dx else 1.0 - frac[..., 0]) *
+                  (frac[..., 1] if dy else 1.0 - frac[..., 1]) *
+                  (frac[..., 2] if dz else 1.0 - frac[..., 2]))
+        displacement = displacement + weight[..., None] * corner
+  return points + displacement
+
+
+class WarpGridCache:
+  """A least-recently-used cache of warp grids keyed by deformation code."""
+
+  def __init__(self, max_entries: int = 4):
+    self.max_entries = max_entries
+    self._grids = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: Hashable, compute_fn: Callable[[], np.ndarray]):
+    """Returns the grid for `key`, computing it with `compute_fn` if needed."""
+    if key in self._grids:
+      self.hits += 1
+      self._grids.move_to_end(key)
+      return self._grids[key]
+    self.misses += 1
+    grid = compute_fn()
+    self._grids[key] = grid
+    if len(self._grids) > self.max_entries:
+      self._grids.popitem(last=False)
+    return grid
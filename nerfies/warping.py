@@ -13,9 +13,10 @@
 # limitations under the License.
 
 """Warp fields."""
-from typing import Any, Iterable, Optional, Dict
+from typing import Any, Iterable, Mapping, Optional, Dict
 
 from flax import linen as nn
+import immutabledict
 import jax
 import jax.numpy as jnp
 
@@ -71,6 +72,9 @@ class TranslationField(nn.Module):
 
     Attributes:
       points_encoder: the positional encoder for the points.
+      points_encoder_type: the type of the points encoder, either 'sinusoidal'
+        or 'hash_grid'. The warp alpha anneals the frequencies or grid levels.
+      hash_grid_kwargs: extra arguments for the hash-grid encoder.
       metadata_encoder: an encoder for metadata.
       alpha: the alpha for the positional encoding.
       skips: the index of the layers with skip connections.
@@ -80,6 +84,7 @@ class TranslationField(nn.Module):
       metadata_encoded: whether the metadata parameter is pre-encoded or not.
       hidden_initializer: the initializer for the hidden layers.
       output_initializer: the initializer for the last output layer.
+      dtype: the dtype of the MLP computation. The warped points are float32.
     """
 
     num_freqs: int
@@ -88,6 +93,8 @@ class TranslationField(nn.Module):
     min_freq_log2: int = 0
     max_freq_log2: Optional[int] = None
     use_identity_map: bool = True
+    points_encoder_type: str = "sinusoidal"
+    hash_grid_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
 
     metadata_encoder_type: str = "glo"
     metadata_encoder_num_freqs: int = 1
@@ -98,13 +105,17 @@ class TranslationField(nn.Module):
     activation: types.Activation = nn.relu
     hidden_init: types.Initializer = nn.initializers.xavier_uniform()
     output_init: types.Initializer = nn.initializers.uniform(scale=1e-4)
+    dtype: types.Dtype = jnp.float32
 
     def setup(self):
-        self.points_encoder = modules.AnnealedSinusoidalEncoder(
+        self.points_encoder = modules.create_point_encoder(
+            self.points_encoder_type,
             num_freqs=self.num_freqs,
             min_freq_log2=self.min_freq_log2,
             max_freq_log2=self.max_freq_log2,
             use_identity=self.use_identity_map,
+            annealed=True,
+            hash_grid_kwargs=self.hash_grid_kwargs,
         )
 
         if self.metadata_encoder_type == "glo":
@@ -141,6 +152,7 @@ class TranslationField(nn.Module):
             hidden_init=self.hidden_init,
             output_init=self.output_init,
             output_channels=output_dims,
+            dtype=self.dtype,
         )
 
     def encode_metadata(
@@ -166,7 +178,7 @@ class TranslationField(nn.Module):
     ):
         points_embed = self.points_encoder(points, alpha=extra.get("alpha"))
         inputs = jnp.concatenate([points_embed, metadata_embed], axis=-1)
-        translation = self.mlp(inputs)
+        translation = self.mlp(inputs).astype(points.dtype)
         warped_points = points + translation
 
         return warped_points
@@ -214,6 +226,9 @@ class SE3Field(nn.Module):
 
     Attributes:
       points_encoder: the positional encoder for the points.
+      points_encoder_type: the type of the points encoder, either 'sinusoidal'
+        or 'hash_grid'. The warp alpha anneals the frequencies or grid levels.
+      hash_grid_kwargs: extra arguments for the hash-grid encoder.
       metadata_encoder: an encoder for metadata.
       alpha: the alpha for the positional encoding.
       skips: the index of the layers with skip connections.
@@ -223,6 +238,8 @@ class SE3Field(nn.Module):
       metadata_encoded: whether the metadata parameter is pre-encoded or not.
       hidden_initializer: the initializer for the hidden layers.
       output_initializer: the initializer for the last logit layer.
+      dtype: the dtype of the MLP computation. The screw axis and the SE(3)
+        exponential are always computed in float32.
     """
 
     num_freqs: int
@@ -231,6 +248,8 @@ class SE3Field(nn.Module):
     min_freq_log2: int = 0
     max_freq_log2: Optional[int] = None
     use_identity_map: bool = True
+    points_encoder_type: str = "sinusoidal"
+    hash_grid_kwargs: Mapping[str, Any] = immutabledict.immutabledict()
 
     activation: types.Activation = nn.relu
     skips: Iterable[int] = (4,)
@@ -252,13 +271,17 @@ class SE3Field(nn.Module):
 
     use_pivot: bool = False
     use_translation: bool = False
+    dtype: types.Dtype = jnp.float32
 
     def setup(self):
-        self.points_encoder = modules.AnnealedSinusoidalEncoder(
+        self.points_encoder = modules.create_point_encoder(
+            self.points_encoder_type,
             num_freqs=self.num_freqs,
             min_freq_log2=self.min_freq_log2,
             max_freq_log2=self.max_freq_log2,
             use_identity=self.use_identity_map,
+            annealed=True,
+            hash_grid_kwargs=self.hash_grid_kwargs,
         )
 
         if self.metadata_encoder_type == "glo":
@@ -281,6 +304,7 @@ class SE3Field(nn.Module):
             hidden_activation=self.activation,
             hidden_init=self.default_init,
             skips=self.skips,
+            dtype=self.dtype,
         )
 
         branches = {
@@ -291,6 +315,7 @@ class SE3Field(nn.Module):
                 hidden_init=self.default_init,
                 output_init=self.rotation_init,
                 output_channels=3,
+                dtype=self.dtype,
             ),
             "v": modules.MLP(
                 depth=self.pivot_depth,
@@ -299,6 +324,7 @@ class SE3Field(nn.Module):
                 hidden_init=self.default_init,
                 output_init=self.pivot_init,
                 output_channels=3,
+                dtype=self.dtype,
             ),
         }
         if self.use_pivot:
@@ -309,6 +335,7 @@ class SE3Field(nn.Module):
                 hidden_init=self.default_init,
                 output_init=self.pivot_init,
                 output_channels=3,
+                dtype=self.dtype,
             )
         if self.use_translation:
             branches["t"] = modules.MLP(
@@ -318,6 +345,7 @@ class SE3Field(nn.Module):
                 hidden_init=self.default_init,
                 output_init=self.translation_init,
                 output_channels=3,
+                dtype=self.dtype,
             )
         # Note that this must be done this way instead of using mutable operations.
         # See https://github.com/google/flax/issues/524.
@@ -344,8 +372,10 @@ class SE3Field(nn.Module):
         inputs = jnp.concatenate([points_embed, metadata_embed], axis=-1)
         trunk_output = self.trunk(inputs)
 
-        w = self.branches["w"](trunk_output)
-        v = self.branches["v"](trunk_output)
+        # The exponential map is numerically sensitive so the screw axis is
+        # always computed in float32.
+        w = self.branches["w"](trunk_output).astype(points.dtype)
+        v = self.branches["v"](trunk_output).astype(points.dtype)
         theta = jnp.linalg.norm(w, axis=-1)
         w = w / theta[..., jnp.newaxis]
         v = v / theta[..., jnp.newaxis]
@@ -354,7 +384,7 @@ class SE3Field(nn.Module):
 
         warped_points = points
         if self.use_pivot:
-            pivot = self.branches["p"](trunk_output)
+            pivot = self.branches["p"](trunk_output).astype(points.dtype)
             warped_points = warped_points + pivot
 
         warped_points = rigid.from_homogenous(
@@ -365,7 +395,7 @@ class SE3Field(nn.Module):
             warped_points = warped_points - pivot
 
         if self.use_translation:
-            t = self.branches["t"](trunk_output)
+            t = self.branches["t"](trunk_output).astype(points.dtype)
             warped_points = warped_points + t
 
         return warped_points
@@ -400,10 +430,14 @@ class SE3Field(nn.Module):
         else:
             metadata_embed = self.encode_metadata(metadata, extra.get("time_alpha"))
 
-        out = {"warped_points": self.warp(points, metadata_embed, extra)}
-
         if return_jacobian:
-            jac_fn = jax.jacfwd(self.warp, argnums=0)
-            out["jacobian"] = jac_fn(points, metadata_embed, extra)
+            # Linearize once and push the three basis tangents through the
+            # linearized warp so that they share the primal activations.
+            warped_points, warp_jvp = jax.linearize(
+                lambda x: self.warp(x, metadata_embed, extra), points
+            )
+            basis = jnp.eye(points.shape[-1], dtype=points.dtype)
+            jacobian = jax.vmap(warp_jvp, out_axes=-1)(basis)
+            return {"warped_points": warped_points, "jacobian": jacobian}
 
-        return out
+        return {"warped_points": self.warp(points, metadata_embed, extra)}
@@ -0,0 +1,44 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packs a scene into a single file which is read by `PackedDataSource`."""
+
+from absl import app
+from absl import flags
+import tensorflow as tf
+
+from nerfies.datasets import packed
+
+flags.DEFINE_string('data_dir', None, 'input data directory.')
+flags.mark_flag_as_required('data_dir')
+flags.DEFINE_string('output_path', None, 'path of the packed scene.')
+flags.mark_flag_as_required('output_path')
+flags.DEFINE_multi_integer('image_scales', [1], 'image scales to pack.')
+flags.DEFINE_multi_string('camera_paths', None,
+                          'test camera paths to pack, defaults to all.')
+FLAGS = flags.FLAGS
+
+
+def main(argv):
+  tf.config.experimental.set_visible_devices([], 'GPU')
+  del argv
+  packed.pack_nerfies_scene(
+      FLAGS.data_dir,
+      FLAGS.output_path,
+      image_scales=FLAGS.image_scales,
+      camera_paths=FLAGS.camera_paths)
+
+
+if __name__ == '__main__':
+  app.run(main)
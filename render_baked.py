@@ -0,0 +1,180 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Renders a camera path from the latest baked grid of an experiment."""
+import functools
+
+from absl import app
+from absl import flags
+from absl import logging
+from flax import optim
+import gin
+import jax
+from jax import numpy as jnp
+from jax import random
+import numpy as np
+import tensorflow as tf
+
+from nerfies import baking
+from nerfies import configs
+from nerfies import datasets
+from nerfies import gpath
+from nerfies import image_utils
+from nerfies import model_utils
+from nerfies import models
+from nerfies import visualization as viz
+
+flags.DEFINE_string('base_folder', None, 'where to store ckpts and logs')
+flags.mark_flag_as_required('base_folder')
+flags.DEFINE_string('data_dir', None, 'input data directory.')
+flags.DEFINE_string('camera_path', None,
+                    'a directory of camera files to render. Defaults to the '
+                    'test cameras of the dataset.')
+flags.DEFINE_integer('warp_id', 0, 'the warp id to deform the template with.')
+flags.DEFINE_float('time', 0.0,
+                   'the time to deform the template with if the warp is '
+                   'conditioned on time.')
+flags.DEFINE_multi_string('gin_bindings', None, 'Gin parameter bindings.')
+flags.DEFINE_multi_string('gin_configs', (), 'Gin config files.')
+FLAGS = flags.FLAGS
+
+jax.config.parse_flags_with_absl()
+
+
+def main(argv):
+  tf.config.experimental.set_visible_devices([], 'GPU')
+  del argv
+  logging.info('*** Loading Gin configs from: %s', str(FLAGS.gin_configs))
+  gin.parse_config_files_and_bindings(
+      config_files=FLAGS.gin_configs,
+      bindings=FLAGS.gin_bindings,
+      skip_unknown=True)
+
+  exp_config = configs.ExperimentConfig()
+  model_config = configs.ModelConfig(use_stratified_sampling=False)
+  bake_config = configs.BakeConfig()
+
+  exp_dir = gpath.GPath(FLAGS.base_folder)
+  if exp_config.subname:
+    exp_dir = exp_dir / exp_config.subname
+  checkpoint_dir = exp_dir / 'checkpoints'
+  bake_dir = exp_dir / 'baked'
+
+  grid_paths = sorted(bake_dir.glob('*.npz'))
+  if not grid_paths:
+    raise ValueError(f'There are no baked grids in {bake_dir}; run bake.py '
+                     'first.')
+  grid_path = grid_paths[-1]
+  step = int(grid_path.stem)
+  grid = baking.load_grid(grid_path)
+  logging.info('Loaded baked grid %s with %d bricks.', grid_path,
+               grid.num_bricks)
+
+  datasource_spec = exp_config.datasource_spec
+  if datasource_spec is None:
+    datasource_spec = {
+        'type': exp_config.datasource_type,
+        'data_dir': FLAGS.data_dir,
+    }
+  datasource = datasets.from_config(
+      datasource_spec,
+      image_scale=exp_config.image_scale,
+      use_appearance_id=model_config.use_appearance_metadata,
+      use_camera_id=model_config.use_camera_metadata,
+      use_warp_id=model_config.use_warp,
+      use_time=model_config.warp_metadata_encoder_type == 'time',
+      random_seed=exp_config.random_seed,
+      **exp_config.datasource_kwargs)
+
+  # The warp field is the only part of the model evaluated at render time.
+  params = {}
+  model, params['model'] = models.construct_nerf(
+      random.PRNGKey(exp_config.random_seed),
+      model_config,
+      batch_size=1,
+      appearance_ids=datasource.appearance_ids,
+      camera_ids=datasource.camera_ids,
+      warp_ids=datasource.warp_ids,
+      near=datasource.near,
+      far=datasource.far)
+  optimizer = optim.Adam(0.0).create(params)
+  state = model_utils.TrainState(optimizer=optimizer)
+  state = model_utils.restore_checkpoint(checkpoint_dir, state, step=step)
+  model_params = state.optimizer.target['model']
+
+  warp_fn = None
+  warp_code = None
+  if model.use_warp:
+    warp_key = ('time' if model.warp_metadata_encoder_type == 'time'
+                else 'warp')
+    warp_metadata = (jnp.asarray([FLAGS.time], jnp.float32)
+                     if warp_key == 'time'
+                     else jnp.asarray([FLAGS.warp_id], jnp.uint32))
+    encoded = model.apply({'params': model_params}, {warp_key: warp_metadata},
+                          state.warp_extra,
+                          method=models.NerfModel.encode_metadata)
+    warp_code = np.asarray(encoded[warp_key])
+
+    def warp_fn(points, metadata):
+      return model.apply({'params': model_params}, points, metadata,
+                         state.warp_extra, metadata_encoded=True,
+                         method=models.NerfModel.warp_samples)
+
+  render_fn = jax.jit(functools.partial(
+      baking.render_rays,
+      warp_fn=warp_fn,
+      num_samples=bake_config.num_samples,
+      near=datasource.near,
+      far=datasource.far,
+      use_white_background=model.use_white_background,
+      use_sample_at_infinity=model.use_sample_at_infinity))
+
+  if FLAGS.camera_path:
+    cameras = sorted(
+        gpath.GPath(FLAGS.camera_path).glob('*.json'))
+  else:
+    cameras = datasource.load_test_cameras()
+  if not cameras:
+    raise ValueError('There are no cameras to render.')
+  dataset = datasource.create_cameras_dataset(cameras)
+  iterator = datasets.iterator_from_dataset(dataset, batch_size=0,
+                                            repeat=False)
+
+  render_dir = exp_dir / 'baked_renders' / f'{step:08d}'
+  render_dir.mkdir(parents=True, exist_ok=True)
+  colorize_depth = functools.partial(
+      viz.colorize, cmin=datasource.near, cmax=datasource.far, invert=True)
+  for i, batch in enumerate(iterator):
+    logging.info('Rendering frame %d/%d', i + 1, len(cameras))
+    h, w = batch['origins'].shape[:2]
+    rays_dict = {
+        'origins': batch['origins'],
+        'directions': batch['directions'],
+        'metadata': {},
+    }
+    if warp_code is not None:
+      rays_dict['metadata'][warp_key] = np.broadcast_to(
+          warp_code, (h, w, warp_code.shape[-1]))
+    render = baking.render_image(grid, rays_dict, render_fn,
+                                 chunk=bake_config.render_chunk)
+    image_utils.save_image(render_dir / f'rgb_{i:04d}.png',
+                           image_utils.image_to_uint8(render['rgb']))
+    image_utils.save_image(
+        render_dir / f'depth_{i:04d}.png',
+        image_utils.image_to_uint8(colorize_depth(render['med_depth'])))
+  logging.info('Saved %d frames to %s', len(cameras), render_dir)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -6,8 +6,10 @@ import sqlite3
 # convert SQLite BLOBs to/from numpy arrays
 
 
+# the blob is a view of the array's memory (no copy) when the array is already
+# C-contiguous
 def array_to_blob(arr):
-  return np.getbuffer(arr)
+  return memoryview(np.ascontiguousarray(arr))
 
 
 def blob_to_array(blob, dtype, shape=(-1,)):
@@ -31,6 +33,13 @@ def get_image_ids_from_pair_id(pair_id):
   return (pair_id - image_id2) / MAX_IMAGE_ID, image_id2
 
 
+# vectorized version of get_image_ids_from_pair_id; returns an Nx2 array
+def get_image_ids_from_pair_ids(pair_ids):
+  pair_ids = np.asarray(pair_ids, np.int64)
+  image_ids2 = pair_ids % MAX_IMAGE_ID
+  return np.stack([(pair_ids - image_ids2) // MAX_IMAGE_ID, image_ids2], axis=1)
+
+
 #-------------------------------------------------------------------------------
 # create table commands
 
@@ -130,6 +139,10 @@ def add_image(db,
               prior_q[3], prior_t[0], prior_t[1], prior_t[2]))
 
 
+def _matrix_to_blob(M):
+  return None if M is None else array_to_blob(np.asarray(M, np.float64))
+
+
 # config: defaults to fundamental matrix
 def add_inlier_matches(db,
     image_id1,
@@ -145,18 +158,12 @@ def add_inlier_matches(db,
   if image_id1 > image_id2:
     matches = matches[:, ::-1]
 
-  if F is not None:
-    F = np.asarray(F, np.float64)
-  if E is not None:
-    E = np.asarray(E, np.float64)
-  if H is not None:
-    H = np.asarray(H, np.float64)
-
   pair_id = get_pair_id(image_id1, image_id2)
   matches = np.asarray(matches, np.uint32)
-  db.execute("INSERT INTO inlier_matches VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+  db.execute("INSERT INTO two_view_geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
              (pair_id,) + matches.shape +
-             (array_to_blob(matches), config, F, E, H))
+             (array_to_blob(matches), config, _matrix_to_blob(F),
+              _matrix_to_blob(E), _matrix_to_blob(H)))
 
 
 def add_keypoints(db, image_id, keypoints):
@@ -182,15 +189,148 @@ def add_matches(db, image_id1, image_id2, matches):
              (pair_id,) + matches.shape + (array_to_blob(matches),))
 
 
+#-------------------------------------------------------------------------------
+# bulk interface
+#
+# these insert or read many rows with a single executemany/SELECT inside one
+# transaction, which is much faster than one statement per image or pair for
+# e.g. exhaustive matching
+
+
+def add_descriptors_bulk(db, image_ids, descriptors_list):
+  def rows():
+    for image_id, descriptors in zip(image_ids, descriptors_list):
+      descriptors = np.ascontiguousarray(descriptors, np.uint8)
+      yield (image_id,) + descriptors.shape + (array_to_blob(descriptors),)
+
+  with db:
+    db.executemany("INSERT INTO descriptors VALUES (?, ?, ?, ?)", rows())
+
+
+def add_keypoints_bulk(db, image_ids, keypoints_list):
+  def rows():
+    for image_id, keypoints in zip(image_ids, keypoints_list):
+      assert (len(keypoints.shape) == 2)
+      assert (keypoints.shape[1] in [2, 4, 6])
+      keypoints = np.ascontiguousarray(keypoints, np.float32)
+      yield (image_id,) + keypoints.shape + (array_to_blob(keypoints),)
+
+  with db:
+    db.executemany("INSERT INTO keypoints VALUES (?, ?, ?, ?)", rows())
+
+
+def _match_rows(image_pairs, matches_list):
+  for (image_id1, image_id2), matches in zip(image_pairs, matches_list):
+    assert (len(matches.shape) == 2)
+    assert (matches.shape[1] == 2)
+
+    if image_id1 > image_id2:
+      matches = matches[:, ::-1]
+
+    matches = np.ascontiguousarray(matches, np.uint32)
+    yield ((get_pair_id(image_id1, image_id2),) + matches.shape +
+           (array_to_blob(matches),))
+
+
+# image_pairs: list of (image_id1, image_id2)
+def add_matches_bulk(db, image_pairs, matches_list):
+  with db:
+    db.executemany("INSERT INTO matches VALUES (?, ?, ?, ?)",
+                   _match_rows(image_pairs, matches_list))
+
+
+# image_pairs: list of (image_id1, image_id2)
+# config: a single value or one per pair; defaults to fundamental matrix
+# F, E, H: None or one matrix (or None) per pair
+def add_inlier_matches_bulk(db,
+    image_pairs,
+    matches_list,
+    config=2,
+    F=None,
+    E=None,
+    H=None):
+  num_pairs = len(image_pairs)
+  configs = [config] * num_pairs if np.isscalar(config) else config
+  F = [None] * num_pairs if F is None else F
+  E = [None] * num_pairs if E is None else E
+  H = [None] * num_pairs if H is None else H
+
+  def rows():
+    for row, c, F_, E_, H_ in zip(
+        _match_rows(image_pairs, matches_list), configs, F, E, H):
+      yield row + (c, _matrix_to_blob(F_), _matrix_to_blob(E_),
+                   _matrix_to_blob(H_))
+
+  with db:
+    db.executemany(
+        "INSERT INTO two_view_geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows())
+
+
+# reads the rows of a table with (id, rows, cols, data) columns and
+# concatenates the blobs; returns
+#   ids: the id of each row
+#   data: (sum of rows)xcols array
+#   offsets: the data of row i is data[offsets[i]:offsets[i + 1]]
+def _read_table_bulk(db, table, id_column, dtype, cols):
+  ids, num_rows, blobs = [], [], []
+  for id_, rows, data in db.execute(
+      "SELECT {}, rows, data FROM {} ORDER BY {}".format(
+          id_column, table, id_column)):
+    ids.append(id_)
+    num_rows.append(rows)
+    blobs.append(data or b"")
+
+  data = np.frombuffer(b"".join(blobs), dtype).reshape(-1, cols)
+  offsets = np.zeros(len(num_rows) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum(np.asarray(num_rows, dtype=np.int64))
+
+  return np.array(ids, dtype=np.int64), data, offsets
+
+
+# returns image_ids, keypoints (Nxcols float32), offsets
+def read_keypoints_bulk(db):
+  cols = db.execute("SELECT DISTINCT cols FROM keypoints").fetchall()
+  if len(cols) > 1:
+    raise ValueError("keypoints have mixed dimensions: {}".format(
+        sorted(c for c, in cols)))
+  cols = cols[0][0] if cols else 2
+
+  return _read_table_bulk(db, "keypoints", "image_id", np.float32, cols)
+
+
+# returns image_pairs (Px2), matches (Mx2 uint32), offsets; the matches of
+# each pair are ordered from the smaller to the larger image id
+def read_matches_bulk(db):
+  pair_ids, matches, offsets = _read_table_bulk(
+      db, "matches", "pair_id", np.uint32, 2)
+  return get_image_ids_from_pair_ids(pair_ids), matches, offsets
+
+
+# same as read_matches_bulk, for the geometrically verified matches
+def read_inlier_matches_bulk(db):
+  pair_ids, matches, offsets = _read_table_bulk(
+      db, "two_view_geometries", "pair_id", np.uint32, 2)
+  return get_image_ids_from_pair_ids(pair_ids), matches, offsets
+
+
 #-------------------------------------------------------------------------------
 # simple functional interface
 
 
 class COLMAPDatabase(sqlite3.Connection):
 
+  # journal_mode="WAL" and synchronous="NORMAL" avoid an fsync per
+  # transaction, which dominates the cost of many small inserts; pass None to
+  # keep the SQLite defaults
   @staticmethod
-  def connect(database_path):
-    return sqlite3.connect(database_path, factory=COLMAPDatabase)
+  def connect(database_path, journal_mode="WAL", synchronous="NORMAL"):
+    db = sqlite3.connect(database_path, factory=COLMAPDatabase)
+    if journal_mode is not None:
+      db.execute("PRAGMA journal_mode={}".format(journal_mode))
+    if synchronous is not None:
+      db.execute("PRAGMA synchronous={}".format(synchronous))
+    return db
 
   def __init__(self, *args, **kwargs):
     super(COLMAPDatabase, self).__init__(*args, **kwargs)
@@ -219,6 +359,15 @@ class COLMAPDatabase(sqlite3.Connection):
   add_keypoints = add_keypoints
   add_matches = add_matches
 
+  add_descriptors_bulk = add_descriptors_bulk
+  add_inlier_matches_bulk = add_inlier_matches_bulk
+  add_keypoints_bulk = add_keypoints_bulk
+  add_matches_bulk = add_matches_bulk
+
+  read_keypoints_bulk = read_keypoints_bulk
+  read_matches_bulk = read_matches_bulk
+  read_inlier_matches_bulk = read_inlier_matches_bulk
+
 
 #-------------------------------------------------------------------------------
 
@@ -331,6 +480,18 @@ def main(args):
   assert np.all(matches[(2, 3)] == m23)
   assert np.all(matches[(3, 4)] == m34)
 
+  #
+  # check the bulk readers
+  #
+
+  image_ids, keypoints, offsets = db.read_keypoints_bulk()
+  assert list(image_ids) == [1, 2, 3, 4]
+  assert np.allclose(keypoints[offsets[1]:offsets[2]], kp2)
+
+  image_pairs, bulk_matches, offsets = db.read_matches_bulk()
+  assert image_pairs.tolist() == [[1, 2], [2, 3], [3, 4]]
+  assert np.all(bulk_matches[offsets[2]:offsets[3]] == m34)
+
   #
   # clean up
   #
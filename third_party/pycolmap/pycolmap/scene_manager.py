@@ -1,15 +1,202 @@
 # Author: True Price <jtprice at cs.unc.edu>
 
 from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from concurrent import futures
 from io import StringIO
-from itertools import combinations
+import mmap
 import os
 import struct
+from types import MappingProxyType
+import warnings
 
 from .camera import Camera
 from .image import Image
 import numpy as np
 from .rotation import Quaternion
+from scipy import sparse
+
+#-------------------------------------------------------------------------------
+#
+# Binary record layouts
+#
+#-------------------------------------------------------------------------------
+
+# fixed-size part of an image record in images.bin, followed by the
+# null-terminated name, the number of 2D points and the 2D points
+IMAGE_HEADER_DTYPE = np.dtype([
+    ('image_id', '<u4'), ('qvec', '<f8', 4), ('tvec', '<f8', 3),
+    ('camera_id', '<u4')])
+
+POINT2D_DTYPE = np.dtype([('xy', '<f8', 2), ('point3D_id', '<u8')])
+
+# fixed-size part of a point record in points3D.bin, followed by track_len
+# (image id, point2D idx) pairs
+POINT3D_HEADER_DTYPE = np.dtype([
+    ('point3D_id', '<u8'), ('xyz', '<f8', 3), ('rgb', 'u1', 3),
+    ('error', '<f8'), ('track_len', '<u8')])
+
+TRACK_ELEMENT_DTYPE = np.dtype('<u4')
+
+
+def _read_images_bin(data):
+  """Parses images.bin from a buffer.
+
+  Returns a list of (image header, name, points2D records); all arrays are
+  copies so the buffer can be released afterwards.
+  """
+  num_images = int(np.frombuffer(data, '<u8', 1, 0)[0])
+  pos = 8
+  records = []
+  for _ in range(num_images):
+    header = np.frombuffer(data, IMAGE_HEADER_DTYPE, 1, pos).copy()[0]
+    pos += IMAGE_HEADER_DTYPE.itemsize
+    name_end = data.find(b'\x00', pos)
+    name = data[pos:name_end].decode()
+    pos = name_end + 1
+    num_points2D = int(np.frombuffer(data, '<u8', 1, pos)[0])
+    pos += 8
+    points2D = np.frombuffer(
+        data, POINT2D_DTYPE, num_points2D, pos).copy()
+    pos += num_points2D * POINT2D_DTYPE.itemsize
+    records.append((header, name, points2D))
+  return records
+
+
+def _read_points3D_bin(data):
+  """Parses points3D.bin from a buffer.
+
+  Returns the (N,) point headers, the (M, 2) concatenated tracks and the
+  (N + 1,) offsets of each point's track into the concatenated tracks.
+  """
+  num_points3D = int(np.frombuffer(data, '<u8', 1, 0)[0])
+  header_size = POINT3D_HEADER_DTYPE.itemsize
+  element_size = 2 * TRACK_ELEMENT_DTYPE.itemsize
+  track_len_pos = POINT3D_HEADER_DTYPE.fields['track_len'][1]
+
+  # records have a variable length, so only the track lengths are read
+  # sequentially to find the start of each record
+  unpack_from = struct.Struct('<Q').unpack_from
+  record_offsets = np.empty(num_points3D, dtype=np.int64)
+  pos = 8
+  for i in range(num_points3D):
+    record_offsets[i] = pos
+    pos += header_size + element_size * unpack_from(data, pos + track_len_pos)[0]
+
+  # every byte after the count is either part of a header or of a track, so
+  # mark the header bytes and gather both in bulk
+  raw = np.frombuffer(data, np.uint8, pos)
+  delta = np.zeros(pos + 1, dtype=np.int8)
+  delta[record_offsets] += 1
+  delta[record_offsets + header_size] -= 1
+  header_mask = np.cumsum(delta[:-1], dtype=np.int8).astype(bool)
+  headers = raw[header_mask].view(POINT3D_HEADER_DTYPE)
+  header_mask[:8] = True
+  tracks = raw[~header_mask].view(TRACK_ELEMENT_DTYPE).reshape(-1, 2)
+  del raw
+
+  track_offsets = np.zeros(num_points3D + 1, dtype=np.int64)
+  track_offsets[1:] = np.cumsum(headers['track_len'])
+  return headers, tracks, track_offsets
+
+
+def _segment_ids(offsets):
+  """Returns the segment index of each element of a CSR layout."""
+  return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _segment_pairs(offsets, segment_mask=None):
+  """Expands all pairs (i, j), i < j, of elements within each segment.
+
+  Returns the element indices of the first and second element of each pair.
+  Only segments where segment_mask is True are expanded.
+  """
+  lengths = np.diff(offsets)
+  if segment_mask is not None:
+    lengths = np.where(segment_mask, lengths, 0)
+  segment_ends = np.repeat(offsets[1:], lengths)
+  elements = np.repeat(offsets[:-1], lengths) + (
+      np.arange(lengths.sum()) -
+      np.repeat(np.cumsum(lengths) - lengths, lengths))
+  # pair every element with each of the elements after it in its segment
+  num_after = segment_ends - elements - 1
+  first = np.repeat(elements, num_after)
+  group_starts = np.repeat(np.cumsum(num_after) - num_after, num_after)
+  second = first + 1 + (np.arange(len(first)) - group_starts)
+  return first, second
+
+
+def _segment_num_unique(offsets, values):
+  """Returns the number of unique values in each segment."""
+  segment_ids = _segment_ids(offsets)
+  order = np.lexsort((values, segment_ids))
+  segment_ids = segment_ids[order]
+  values = values[order]
+  is_new = np.ones(len(values), dtype=bool)
+  is_new[1:] = ((segment_ids[1:] != segment_ids[:-1]) |
+                (values[1:] != values[:-1]))
+  return np.bincount(segment_ids[is_new], minlength=len(offsets) - 1)
+
+
+def _triangulation_cosines(points3D, tracks, track_offsets, point3D_idxs,
+                           image_ids, image_centers):
+  """Computes the min and max cosine between the viewing rays of each point.
+
+  Only one ray per image is used. Points seen from fewer than two images get
+  a min of inf and a max of -inf.
+
+  Args:
+    points3D: (N, 3) the points.
+    tracks: (M, 2) the (image_id, point2D idx) pairs of all tracks.
+    track_offsets: (N + 1,) the offsets of each point's track.
+    point3D_idxs: (K,) the points to compute the cosines for.
+    image_ids: (I,) sorted image ids.
+    image_centers: (I, 3) the position the rays start from in each image.
+
+  Returns:
+    The (K,) min and (K,) max cosines.
+  """
+  track_lens = track_offsets[point3D_idxs + 1] - track_offsets[point3D_idxs]
+  chunk_offsets = np.zeros(len(point3D_idxs) + 1, dtype=np.int64)
+  chunk_offsets[1:] = np.cumsum(track_lens)
+  segment_ids = _segment_ids(chunk_offsets)
+  elements = (track_offsets[point3D_idxs][segment_ids] +
+              np.arange(chunk_offsets[-1]) - chunk_offsets[segment_ids])
+  track_image_ids = tracks[elements, 0]
+
+  # keep one observation per (point, image)
+  order = np.lexsort((track_image_ids, segment_ids))
+  segment_ids = segment_ids[order]
+  track_image_ids = track_image_ids[order]
+  is_new = np.ones(len(order), dtype=bool)
+  is_new[1:] = ((segment_ids[1:] != segment_ids[:-1]) |
+                (track_image_ids[1:] != track_image_ids[:-1]))
+  segment_ids = segment_ids[is_new]
+  track_image_ids = track_image_ids[is_new]
+  num_images = np.bincount(segment_ids, minlength=len(point3D_idxs))
+  unique_offsets = np.zeros(len(point3D_idxs) + 1, dtype=np.int64)
+  unique_offsets[1:] = np.cumsum(num_images)
+
+  rays = (image_centers[np.searchsorted(image_ids, track_image_ids)] -
+          points3D[point3D_idxs[segment_ids]])
+  rays /= np.linalg.norm(rays, axis=-1)[:,np.newaxis]
+
+  # pairs are ordered by point, so the cosines are reduced per segment
+  first, second = _segment_pairs(unique_offsets)
+  cos_theta = np.einsum('ij,ij->i', rays[first], rays[second])
+  num_pairs = num_images * (num_images - 1) // 2
+  pair_starts = np.cumsum(num_pairs) - num_pairs
+  has_pairs = num_pairs > 0
+
+  min_cos = np.full(len(point3D_idxs), np.inf)
+  max_cos = np.full(len(point3D_idxs), -np.inf)
+  if np.any(has_pairs):
+    min_cos[has_pairs] = np.minimum.reduceat(
+        cos_theta, pair_starts[has_pairs])
+    max_cos[has_pairs] = np.maximum.reduceat(
+        cos_theta, pair_starts[has_pairs])
+  return min_cos, max_cos
+
 
 #-------------------------------------------------------------------------------
 #
@@ -19,6 +206,34 @@ from .rotation import Quaternion
 
 
 
+# read-only view of SceneManager.point3D_id_to_point3D_idx; setting an entry to
+# INVALID_POINT3D, which is how points used to be removed, still works but is
+# deprecated in favor of SceneManager.invalidate_points3D
+class _Point3DIdxView(Mapping):
+  def __init__(self, scene_manager, point3D_id_to_point3D_idx):
+    self._scene_manager = scene_manager
+    self._point3D_id_to_point3D_idx = point3D_id_to_point3D_idx
+
+  def __getitem__(self, point3D_id):
+    return self._point3D_id_to_point3D_idx[point3D_id]
+
+  def __iter__(self):
+    return iter(self._point3D_id_to_point3D_idx)
+
+  def __len__(self):
+    return len(self._point3D_id_to_point3D_idx)
+
+  def __setitem__(self, point3D_id, value):
+    if value != SceneManager.INVALID_POINT3D:
+      raise TypeError(
+          'point3D_id_to_point3D_idx is read-only; use invalidate_points3D')
+    warnings.warn(
+        'setting point3D_id_to_point3D_idx[point3D_id] = INVALID_POINT3D is '
+        'deprecated; use invalidate_points3D', DeprecationWarning,
+        stacklevel=2)
+    self._scene_manager.invalidate_points3D([point3D_id])
+
+
 class SceneManager:
   INVALID_POINT3D = np.uint64(-1)
 
@@ -37,20 +252,131 @@ class SceneManager:
     self.last_camera_id = 0
     self.last_image_id = 0
 
-    # Nx3 array of point3D xyz's
-    self.points3D = np.zeros((0, 3))
+    self._set_points3D(
+        np.empty(0, dtype=np.uint64), np.zeros((0, 3)),
+        np.zeros((0, 3), dtype=np.uint8), np.zeros(0),
+        np.zeros((0, 2), dtype=np.uint32), np.zeros(1, dtype=np.int64))
 
-    # for each element in points3D, stores the id of the point
-    self.point3D_ids = np.empty(0)
+  #---------------------------------------------------------------------------
 
-    # point3D_id => index in self.points3D
-    self.point3D_id_to_point3D_idx = dict()
+  def _set_points3D(self, point3D_ids, points3D, colors, errors, tracks,
+                    track_offsets):
+    self._reset_scene_graph()
+    self._reset_point3D_views()
 
-    # point3D_id => [(image_id, point2D idx in image)]
-    self.point3D_id_to_images = dict()
+    # Nx3 array of point3D xyz's
+    self.points3D = points3D
+
+    # for each element in points3D, stores the id of the point
+    self.point3D_ids = point3D_ids
+
+    # for each element in points3D, False if the point was filtered out
+    self.point3D_valid_mask = np.ones(len(point3D_ids), dtype=bool)
+
+    self.point3D_colors = colors
+    self.point3D_errors = errors
+
+    # tracks in CSR layout: the (image_id, point2D idx in image) pairs of
+    # points3D[i] are point3D_tracks[point3D_track_offsets[i]:
+    # point3D_track_offsets[i + 1]]
+    self.point3D_tracks = tracks
+    self.point3D_track_offsets = track_offsets
+
+    # sorted point3D ids and their index in self.points3D for id lookups
+    self._point3D_id_order = np.argsort(point3D_ids, kind='stable')
+    self._sorted_point3D_ids = point3D_ids[self._point3D_id_order]
+
+  # the co-visibility matrix is built lazily by build_scene_graph; every method
+  # which changes the images, points or tracks must reset it
+  def _reset_scene_graph(self):
+    self.covisibility = None
+    self.covisibility_image_ids = None
+    self._scene_graph = None
+
+  # the dictionary views of the points are built lazily on first access;
+  # every method which changes the points, tracks or valid mask must reset
+  # them (or update them in place)
+  def _reset_point3D_views(self):
+    self._point3D_id_to_point3D_idx = None
+    self._point3D_id_to_images = None
+
+  def _set_tracks(self, tracks, track_lens):
+    self._reset_scene_graph()
+    self._reset_point3D_views()
+    self.point3D_tracks = tracks
+    self.point3D_track_offsets = np.zeros(len(track_lens) + 1, dtype=np.int64)
+    self.point3D_track_offsets[1:] = np.cumsum(track_lens)
+
+  # returns the index in self.points3D of each point3D id, or -1 for unknown
+  # ids (including INVALID_POINT3D)
+  def get_point3D_idxs(self, point3D_ids):
+    point3D_ids = np.asarray(point3D_ids, dtype=np.uint64)
+    if len(self._sorted_point3D_ids) == 0:
+      return np.full(point3D_ids.shape, -1, dtype=np.int64)
+    pos = np.searchsorted(self._sorted_point3D_ids, point3D_ids)
+    pos = np.minimum(pos, len(self._sorted_point3D_ids) - 1)
+    found = self._sorted_point3D_ids[pos] == point3D_ids
+    return np.where(found, self._point3D_id_order[pos], -1)
+
+  def get_track(self, point3D_idx):
+    return self.point3D_tracks[
+        self.point3D_track_offsets[point3D_idx]:
+        self.point3D_track_offsets[point3D_idx + 1]]
+
+  @property
+  def point3D_track_lens(self):
+    return np.diff(self.point3D_track_offsets)
+
+  # read-only dictionary views of the points and tracks; these are built on
+  # first access and cached until the points change. Use invalidate_points3D
+  # to remove points; NOTE: the views used to be plain dicts, assigning them
+  # now raises and modifying their entries is no longer supported, except for
+  # the deprecated point3D_id_to_point3D_idx[id] = INVALID_POINT3D
+
+  @property
+  def point3D_id_to_point3D_idx(self):
+    if self._point3D_id_to_point3D_idx is None:
+      idxs = np.where(self.point3D_valid_mask,
+                      np.arange(len(self.point3D_ids), dtype=np.uint64),
+                      SceneManager.INVALID_POINT3D)
+      self._point3D_id_to_point3D_idx = dict(zip(self.point3D_ids, idxs))
+    return _Point3DIdxView(self, self._point3D_id_to_point3D_idx)
+
+  @point3D_id_to_point3D_idx.setter
+  def point3D_id_to_point3D_idx(self, value):
+    raise AttributeError(
+        'point3D_id_to_point3D_idx is read-only; use invalidate_points3D')
+
+  @property
+  def point3D_id_to_images(self):
+    if self._point3D_id_to_images is None:
+      self._point3D_id_to_images = dict(zip(
+          self.point3D_ids,
+          np.split(self.point3D_tracks, self.point3D_track_offsets[1:-1])))
+    return MappingProxyType(self._point3D_id_to_images)
+
+  @point3D_id_to_images.setter
+  def point3D_id_to_images(self, value):
+    raise AttributeError('point3D_id_to_images is read-only')
+
+  # marks the given points as invalid and removes them from the images; this
+  # replaces setting point3D_id_to_point3D_idx[id] = INVALID_POINT3D
+  def invalidate_points3D(self, point3D_ids):
+    self._reset_scene_graph()
+    point3D_ids = np.asarray(point3D_ids, dtype=np.uint64)
+    point3D_idxs = self.get_point3D_idxs(point3D_ids)
+    found = point3D_idxs >= 0
+    self.point3D_valid_mask[point3D_idxs[found]] = False
+    # update the cached view in place so that invalidating points one at a
+    # time does not rebuild it
+    if self._point3D_id_to_point3D_idx is not None:
+      for point3D_id in point3D_ids[found]:
+        self._point3D_id_to_point3D_idx[point3D_id] = (
+            SceneManager.INVALID_POINT3D)
 
-    self.point3D_colors = np.zeros((0, 3), dtype=np.uint8)
-    self.point3D_errors = np.zeros(0)
+    for image in self.images.values():
+      mask = np.isin(image.point3D_ids, point3D_ids)
+      image.point3D_ids[mask] = SceneManager.INVALID_POINT3D
 
   #---------------------------------------------------------------------------
 
@@ -125,6 +451,7 @@ class SceneManager:
   #---------------------------------------------------------------------------
 
   def load_images(self, input_file=None):
+    self._reset_scene_graph()
     if input_file is None:
       input_file = self.folder + 'images.bin'
       if os.path.exists(input_file):
@@ -139,29 +466,25 @@ class SceneManager:
   def _load_images_bin(self, input_file):
     self.images = OrderedDict()
 
-    with open(input_file, 'rb') as f:
-      num_images = struct.unpack('L', f.read(8))[0]
-      for _ in range(num_images):
-        image_id = struct.unpack('I', f.read(4))[0]
-        q = Quaternion(np.array(struct.unpack('dddd', f.read(32))))
-        t = np.array(struct.unpack('ddd', f.read(24)))
-        camera_id = struct.unpack('I', f.read(4))[0]
-        name = b''.join(c for c in iter(lambda: f.read(1), b'\x00')).decode()
-
-        image = Image(name, camera_id, q, t)
+    with open(input_file, 'rb') as f, \
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      records = _read_images_bin(data)
 
-        num_points2D = struct.unpack('L', f.read(8))[0]
+    for header, name, points2D in records:
+      image_id = int(header['image_id'])
+      q = Quaternion(header['qvec'].astype(np.float64))
+      t = header['tvec'].astype(np.float64)
+      camera_id = int(header['camera_id'])
 
-        image.points2D = np.empty((num_points2D, 2))
-        image.point3D_ids = np.empty(num_points2D, dtype=np.uint64)
-        for j in range(num_points2D):
-          image.points2D[j] = np.array(struct.unpack('dd', f.read(16)))
-          image.point3D_ids[j] = np.array(struct.unpack('Q', f.read(8)))
+      image = Image(name, camera_id, q, t)
+      image.points2D = np.ascontiguousarray(points2D['xy'], dtype=np.float64)
+      image.point3D_ids = np.ascontiguousarray(
+          points2D['point3D_id'], dtype=np.uint64)
 
-        self.images[image_id] = image
-        self.name_to_image_id[image.name] = image_id
+      self.images[image_id] = image
+      self.name_to_image_id[image.name] = image_id
 
-        self.last_image_id = max(self.last_image_id, image_id)
+      self.last_image_id = max(self.last_image_id, image_id)
 
   def _load_images_txt(self, input_file):
     self.images = OrderedDict()
@@ -213,38 +536,24 @@ class SceneManager:
           raise IOError('no points3D file found')
 
   def _load_points3D_bin(self, input_file):
-    with open(input_file, 'rb') as f:
-      num_points3D = struct.unpack('L', f.read(8))[0]
-
-      self.points3D = np.empty((num_points3D, 3))
-      self.point3D_ids = np.empty(num_points3D, dtype=np.uint64)
-      self.point3D_colors = np.empty((num_points3D, 3), dtype=np.uint8)
-      self.point3D_id_to_point3D_idx = dict()
-      self.point3D_id_to_images = dict()
-      self.point3D_errors = np.empty(num_points3D)
-
-      for i in range(num_points3D):
-        self.point3D_ids[i] = struct.unpack('L', f.read(8))[0]
-        self.points3D[i] = struct.unpack('ddd', f.read(24))
-        self.point3D_colors[i] = struct.unpack('BBB', f.read(3))
-        self.point3D_errors[i] = struct.unpack('d', f.read(8))[0]
-
-        self.point3D_id_to_point3D_idx[self.point3D_ids[i]] = i
-
-        # load (image id, point2D idx) pairs
-        track_len = struct.unpack('L', f.read(8))[0]
-        data = struct.unpack(
-            'I' * (2 * track_len), f.read(2 * track_len * 4))
-        self.point3D_id_to_images[self.point3D_ids[i]] = \
-          np.array(data, dtype=np.uint32).reshape(track_len, 2)
+    with open(input_file, 'rb') as f, \
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      headers, tracks, track_offsets = _read_points3D_bin(data)
+
+    self._set_points3D(
+        headers['point3D_id'].astype(np.uint64),
+        headers['xyz'].astype(np.float64),
+        headers['rgb'].astype(np.uint8),
+        headers['error'].astype(np.float64),
+        tracks.astype(np.uint32),
+        track_offsets)
 
   def _load_points3D_txt(self, input_file):
-    self.points3D = []
-    self.point3D_ids = []
-    self.point3D_colors = []
-    self.point3D_id_to_point3D_idx = dict()
-    self.point3D_id_to_images = dict()
-    self.point3D_errors = []
+    point3D_ids = []
+    points3D = []
+    colors = []
+    errors = []
+    tracks = []
 
     with open(input_file, 'r') as f:
       for line in iter(lambda: f.readline().strip(), ''):
@@ -252,22 +561,30 @@ class SceneManager:
           continue
 
         data = line.split()
-        point3D_id = np.uint64(data[0])
-
-        self.point3D_ids.append(point3D_id)
-        self.point3D_id_to_point3D_idx[point3D_id] = len(self.points3D)
-        self.points3D.append(list(map(np.float64, data[1:4])))
-        self.point3D_colors.append(list(map(np.uint8, data[4:7])))
-        self.point3D_errors.append(np.float64(data[7]))
+        point3D_ids.append(np.uint64(data[0]))
+        points3D.append(list(map(np.float64, data[1:4])))
+        colors.append(list(map(np.uint8, data[4:7])))
+        errors.append(np.float64(data[7]))
 
         # load (image id, point2D idx) pairs
-        self.point3D_id_to_images[point3D_id] = \
-          np.array(list(map(np.uint32, data[8:]))).reshape(-1, 2)
+        tracks.append(
+            np.array(list(map(np.uint32, data[8:])), dtype=np.uint32))
+
+    track_lens = np.array([len(track) // 2 for track in tracks], dtype=np.int64)
+    track_offsets = np.zeros(len(tracks) + 1, dtype=np.int64)
+    track_offsets[1:] = np.cumsum(track_lens)
+    if tracks:
+      tracks = np.concatenate(tracks).reshape(-1, 2)
+    else:
+      tracks = np.zeros((0, 2), dtype=np.uint32)
 
-    self.points3D = np.array(self.points3D)
-    self.point3D_ids = np.array(self.point3D_ids)
-    self.point3D_colors = np.array(self.point3D_colors)
-    self.point3D_errors = np.array(self.point3D_errors)
+    self._set_points3D(
+        np.array(point3D_ids, dtype=np.uint64),
+        np.array(points3D, dtype=np.float64).reshape(-1, 3),
+        np.array(colors, dtype=np.uint8).reshape(-1, 3),
+        np.array(errors, dtype=np.float64),
+        tracks,
+        track_offsets)
 
   #---------------------------------------------------------------------------
 
@@ -383,55 +700,38 @@ class SceneManager:
       self._save_points3D_txt(output_file)
 
   def _save_points3D_bin(self, output_file):
-    num_valid_points3D = sum(
-        1 for point3D_idx in self.point3D_id_to_point3D_idx.values()
-        if point3D_idx != SceneManager.INVALID_POINT3D)
-
-    iter_point3D_id_to_point3D_idx = \
-      self.point3D_id_to_point3D_idx.items()
+    point3D_idxs = np.flatnonzero(self.point3D_valid_mask)
 
     with open(output_file, 'wb') as fid:
-      fid.write(struct.pack('L', num_valid_points3D))
-
-      for point3D_id, point3D_idx in iter_point3D_id_to_point3D_idx:
-        if point3D_idx == SceneManager.INVALID_POINT3D:
-          continue
+      fid.write(struct.pack('L', len(point3D_idxs)))
 
-        fid.write(struct.pack('L', point3D_id))
+      for point3D_idx in point3D_idxs:
+        track = self.get_track(point3D_idx)
+        fid.write(struct.pack('L', self.point3D_ids[point3D_idx]))
         fid.write(self.points3D[point3D_idx].tobytes())
         fid.write(self.point3D_colors[point3D_idx].tobytes())
         fid.write(self.point3D_errors[point3D_idx].tobytes())
-        fid.write(
-            struct.pack('L', len(self.point3D_id_to_images[point3D_id])))
-        fid.write(self.point3D_id_to_images[point3D_id].tobytes())
+        fid.write(struct.pack('L', len(track)))
+        fid.write(track.tobytes())
 
   def _save_points3D_txt(self, output_file):
-    num_valid_points3D = sum(
-        1 for point3D_idx in self.point3D_id_to_point3D_idx.values()
-        if point3D_idx != SceneManager.INVALID_POINT3D)
+    point3D_idxs = np.flatnonzero(self.point3D_valid_mask)
 
     array_to_string = lambda arr: ' '.join(str(x) for x in arr)
 
-    iter_point3D_id_to_point3D_idx = \
-      self.point3D_id_to_point3D_idx.items()
-
     with open(output_file, 'w') as fid:
       print('# 3D point list with one line of data per point:', file=fid)
       print('#   POINT3D_ID, X, Y, Z, R, G, B, ERROR, TRACK[] as ', file=fid)
       print('# (IMAGE_ID, POINT2D_IDX)', file=fid)
-      print('# Number of points: {},'.format(num_valid_points3D), file=fid)
+      print('# Number of points: {},'.format(len(point3D_idxs)), file=fid)
       print('# mean track length: unknown', file=fid)
 
-      for point3D_id, point3D_idx in iter_point3D_id_to_point3D_idx:
-        if point3D_idx == SceneManager.INVALID_POINT3D:
-          continue
-
-        print(point3D_id, file=fid)
+      for point3D_idx in point3D_idxs:
+        print(self.point3D_ids[point3D_idx], file=fid)
         print(array_to_string(self.points3D[point3D_idx]), file=fid)
         print(array_to_string(self.point3D_colors[point3D_idx]), file=fid)
         print(self.point3D_errors[point3D_idx], file=fid)
-        print(array_to_string(
-            self.point3D_id_to_images[point3D_id].flat), file=fid)
+        print(array_to_string(self.get_track(point3D_idx).flat), file=fid)
 
   #---------------------------------------------------------------------------
 
@@ -450,18 +750,14 @@ class SceneManager:
   def get_points3D(self, image_id, return_points2D=True, return_colors=False):
     image = self.images[image_id]
 
-    mask = (image.point3D_ids != SceneManager.INVALID_POINT3D)
-
-    point3D_idxs = np.array([
-        self.point3D_id_to_point3D_idx[point3D_id]
-        for point3D_id in image.point3D_ids[mask]])
-    # detect filtered points
-    filter_mask = (point3D_idxs != SceneManager.INVALID_POINT3D)
-    point3D_idxs = point3D_idxs[filter_mask]
+    point3D_idxs = self.get_point3D_idxs(image.point3D_ids)
+    # detect unset and filtered points
+    mask = point3D_idxs >= 0
+    mask[mask] = self.point3D_valid_mask[point3D_idxs[mask]]
+    point3D_idxs = point3D_idxs[mask]
     result = [self.points3D[point3D_idxs,:]]
 
     if return_points2D:
-      mask[mask] &= filter_mask
       result += [image.points2D[mask]]
     if return_colors:
       result += [self.point3D_colors[point3D_idxs,:]]
@@ -471,19 +767,18 @@ class SceneManager:
   #---------------------------------------------------------------------------
 
   def point3D_valid(self, point3D_id):
-    return (self.point3D_id_to_point3D_idx[point3D_id] !=
-            SceneManager.INVALID_POINT3D)
+    point3D_idx = self.get_point3D_idxs([point3D_id])[0]
+    if point3D_idx < 0:
+      raise KeyError(point3D_id)
+    return bool(self.point3D_valid_mask[point3D_idx])
 
   #---------------------------------------------------------------------------
 
   def get_filtered_points3D(self, return_colors=False):
-    point3D_idxs = [
-        idx for idx in self.point3D_id_to_point3D_idx.values()
-        if idx != SceneManager.INVALID_POINT3D]
-    result = [self.points3D[point3D_idxs,:]]
+    result = [self.points3D[self.point3D_valid_mask,:]]
 
     if return_colors:
-      result += [self.point3D_colors[point3D_idxs,:]]
+      result += [self.point3D_colors[self.point3D_valid_mask,:]]
 
     return result if len(result) > 1 else result[0]
 
@@ -491,13 +786,11 @@ class SceneManager:
 
   # return 3D points shared by two images
   def get_shared_points3D(self, image_id1, image_id2):
-    point3D_ids = (
-        set(self.images[image_id1].point3D_ids) &
-        set(self.images[image_id2].point3D_ids))
-    point3D_ids.discard(SceneManager.INVALID_POINT3D)
-
-    point3D_idxs = np.array([self.point3D_id_to_point3D_idx[point3D_id]
-                             for point3D_id in point3D_ids])
+    point3D_ids = np.intersect1d(
+        self.images[image_id1].point3D_ids,
+        self.images[image_id2].point3D_ids)
+    point3D_idxs = self.get_point3D_idxs(point3D_ids)
+    point3D_idxs = point3D_idxs[point3D_idxs >= 0]
 
     return self.points3D[point3D_idxs,:]
 
@@ -509,10 +802,7 @@ class SceneManager:
     image = self.images[image_id]
 
     # get unfiltered points
-    point3D_idxs = set(self.point3D_id_to_point3D_idx.values())
-    point3D_idxs.discard(SceneManager.INVALID_POINT3D)
-    point3D_idxs = list(point3D_idxs)
-    points3D = self.points3D[point3D_idxs,:]
+    points3D = self.points3D[self.point3D_valid_mask,:]
 
     # orient points relative to camera
     R = image.q.ToR()
@@ -543,6 +833,7 @@ class SceneManager:
   #---------------------------------------------------------------------------
 
   def add_image(self, image):
+    self._reset_scene_graph()
     self.last_image_id += 1
     self.images[self.last_image_id] = image
     return self.last_image_id
@@ -555,100 +846,202 @@ class SceneManager:
       if image_id in self.images:
         del self.images[image_id]
 
-    keep_set = set(self.images.iterkeys())
+    keep_ids = np.fromiter(self.images.keys(), dtype=np.uint32)
 
     # delete references to specified images, and ignore any points that are
-    # invalidated
-    iter_point3D_id_to_point3D_idx = \
-      self.point3D_id_to_point3D_idx.items()
-
-    for point3D_id, point3D_idx in iter_point3D_id_to_point3D_idx:
-      if point3D_idx == SceneManager.INVALID_POINT3D:
-        continue
-
-      mask = np.array([
-          image_id in keep_set
-          for image_id in self.point3D_id_to_images[point3D_id][:,0]])
-      if np.any(mask):
-        self.point3D_id_to_images[point3D_id] = \
-          self.point3D_id_to_images[point3D_id][mask]
-      else:
-        self.point3D_id_to_point3D_idx[point3D_id] = \
-          SceneManager.INVALID_POINT3D
+    # invalidated; tracks of already filtered points are left untouched
+    track_point3D_idxs = _segment_ids(self.point3D_track_offsets)
+    keep = (np.isin(self.point3D_tracks[:,0], keep_ids) |
+            ~self.point3D_valid_mask[track_point3D_idxs])
+    track_lens = np.bincount(
+        track_point3D_idxs[keep], minlength=len(self.point3D_ids))
+    self.point3D_valid_mask &= track_lens > 0
+    self._set_tracks(self.point3D_tracks[keep], track_lens)
 
   #---------------------------------------------------------------------------
 
   # camera_list: set of cameras whose points we'd like to keep
   # min/max triangulation angle: in degrees
+  # num_threads: threads used for the triangulation angles, which are
+  # computed in chunks of chunk_size points (None uses all cores)
   def filter_points3D(self,
       min_track_len=0, max_error=np.inf, min_tri_angle=0,
-      max_tri_angle=180, image_set=set()):
+      max_tri_angle=180, image_set=set(), num_threads=None,
+      max_pairs_per_chunk=2**22):
 
-    image_set = set(image_set)
+    image_set = np.array(sorted(image_set), dtype=np.uint32)
 
     check_triangulation_angles = (min_tri_angle > 0 or max_tri_angle < 180)
     if check_triangulation_angles:
       max_tri_prod = np.cos(np.radians(min_tri_angle))
       min_tri_prod = np.cos(np.radians(max_tri_angle))
 
-    iter_point3D_id_to_point3D_idx = \
-      self.point3D_id_to_point3D_idx.items()
-
-    image_ids = []
-
-    for point3D_id, point3D_idx in iter_point3D_id_to_point3D_idx:
-      if point3D_idx == SceneManager.INVALID_POINT3D:
-        continue
-
-      if image_set or min_track_len > 0:
-        image_ids = set(self.point3D_id_to_images[point3D_id][:,0])
-
-      # check if error and min track length are sufficient, or if none of
-      # the selected cameras see the point
-      if (len(image_ids) < min_track_len or
-          self.point3D_errors[point3D_idx] > max_error or
-          image_set and image_set.isdisjoint(image_ids)):
-        self.point3D_id_to_point3D_idx[point3D_id] = \
-          SceneManager.INVALID_POINT3D
-
-      # find dot product between all camera viewing rays
-      elif check_triangulation_angles:
-        xyz = self.points3D[point3D_idx,:]
-        tvecs = np.array(
-            [(self.images[image_id].tvec - xyz)
-             for image_id in image_ids])
-        tvecs /= np.linalg.norm(tvecs, axis=-1)[:,np.newaxis]
-
-        cos_theta = np.array(
-            [u.dot(v) for u,v in combinations(tvecs, 2)])
-
+    track_image_ids = self.point3D_tracks[:,0]
+
+    # check if error and min track length are sufficient, or if none of
+    # the selected cameras see the point
+    valid = self.point3D_valid_mask & (self.point3D_errors <= max_error)
+    if min_track_len > 0:
+      valid &= _segment_num_unique(
+          self.point3D_track_offsets, track_image_ids) >= min_track_len
+    if len(image_set) > 0:
+      track_point3D_idxs = _segment_ids(self.point3D_track_offsets)
+      valid &= np.bincount(
+          track_point3D_idxs[np.isin(track_image_ids, image_set)],
+          minlength=len(valid)) > 0
+
+    # find dot product between all camera viewing rays
+    if check_triangulation_angles:
+      image_ids = np.array(sorted(self.images.keys()), dtype=np.uint32)
+      image_centers = np.array(
+          [self.images[image_id].tvec for image_id in image_ids],
+          dtype=np.float64).reshape(-1, 3)
+      point3D_idxs = np.flatnonzero(valid)
+
+      # the cost of a point is quadratic in its track length, so the chunks
+      # are split by their (upper bound on the) number of ray pairs; a point
+      # whose track alone exceeds the budget gets a chunk of its own
+      track_lens = self.point3D_track_lens[point3D_idxs]
+      num_pairs = track_lens * (track_lens - 1) // 2
+      chunk_ids = (np.cumsum(num_pairs) - num_pairs) // max_pairs_per_chunk
+      chunks = (np.split(point3D_idxs, np.flatnonzero(np.diff(chunk_ids)) + 1)
+                if len(point3D_idxs) > 0 else [])
+
+      def _compute(chunk):
+        return _triangulation_cosines(
+            self.points3D, self.point3D_tracks, self.point3D_track_offsets,
+            chunk, image_ids, image_centers)
+
+      # NumPy releases the GIL for the bulk of the work
+      with futures.ThreadPoolExecutor(num_threads) as executor:
+        results = list(executor.map(_compute, chunks))
+
+      for chunk, (min_cos, max_cos) in zip(chunks, results):
         # min_prod = cos(maximum viewing angle), and vice versa
         # if maximum viewing angle is too small or too large,
         # don't add this point
-        if (np.min(cos_theta) > max_tri_prod or
-            np.max(cos_theta) < min_tri_prod):
-          self.point3D_id_to_point3D_idx[point3D_id] = \
-            SceneManager.INVALID_POINT3D
+        valid[chunk] = (min_cos <= max_tri_prod) & (max_cos >= min_tri_prod)
+
+    self.point3D_valid_mask = valid
+    self._reset_scene_graph()
+    self._reset_point3D_views()
 
     # apply the filters to the image point3D_ids
     for image in self.images.values():
-      mask = np.array([
-          self.point3D_id_to_point3D_idx.get(point3D_id, 0) \
-          == SceneManager.INVALID_POINT3D
-          for point3D_id in image.point3D_ids])
+      point3D_idxs = self.get_point3D_idxs(image.point3D_ids)
+      mask = point3D_idxs >= 0
+      mask[mask] = ~valid[point3D_idxs[mask]]
       image.point3D_ids[mask] = SceneManager.INVALID_POINT3D
 
   #---------------------------------------------------------------------------
 
-  # scene graph: {image_id: [image_id: #shared points]}
-  def build_scene_graph(self):
-    self.scene_graph = defaultdict(lambda: defaultdict(int))
-    point3D_iter = self.point3D_id_to_images.items()
-
-    for i, (point3D_id, images) in enumerate(point3D_iter):
-      if not self.point3D_valid(point3D_id):
+  # co-visibility graph: sparse (num_images, num_images) matrix of the number
+  # of shared points; row/column i corresponds to covisibility_image_ids[i]
+  # the image pairs are expanded in chunks of points of about
+  # max_pairs_per_chunk pairs, as in filter_points3D
+  def build_scene_graph(self, max_pairs_per_chunk=2**22):
+    image_ids = np.union1d(
+        np.fromiter(self.images.keys(), dtype=np.uint32,
+                    count=len(self.images)),
+        self.point3D_tracks[:, 0])
+    num_images = len(image_ids)
+
+    valid = self.point3D_valid_mask
+    track_lens = np.where(valid, self.point3D_track_lens, 0)
+    num_pairs = track_lens * (track_lens - 1) // 2
+    chunk_ids = (np.cumsum(num_pairs) - num_pairs) // max_pairs_per_chunk
+    bounds = np.concatenate(
+        [[0], np.flatnonzero(np.diff(chunk_ids)) + 1, [len(valid)]])
+
+    covisibility = sparse.csr_matrix((num_images, num_images), dtype=np.int64)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+      first, second = _segment_pairs(
+          self.point3D_track_offsets[start:end + 1], valid[start:end])
+      if len(first) == 0:
         continue
+      image_idxs1 = np.searchsorted(image_ids, self.point3D_tracks[first, 0])
+      image_idxs2 = np.searchsorted(image_ids, self.point3D_tracks[second, 0])
+
+      # duplicate (row, col) entries are summed when converting to CSR
+      counts = np.ones(2 * len(first), dtype=np.int64)
+      covisibility += sparse.coo_matrix(
+          (counts, (np.concatenate([image_idxs1, image_idxs2]),
+                    np.concatenate([image_idxs2, image_idxs1]))),
+          shape=(num_images, num_images)).tocsr()
 
-      for image_id1, image_id2 in combinations(images[:,0], 2):
-        self.scene_graph[image_id1][image_id2] += 1
-        self.scene_graph[image_id2][image_id1] += 1
+    self.covisibility = covisibility
+    self.covisibility_image_ids = image_ids
+    self._scene_graph = None
+
+    return self.covisibility
+
+  # scene graph: {image_id: [image_id: #shared points]}
+  # this is a dict view of the co-visibility matrix for compatibility; prefer
+  # using self.covisibility directly for large scenes. The dict is built once
+  # and cached until the scene changes, so it must not be modified
+  @property
+  def scene_graph(self):
+    if self.covisibility is None:
+      self.build_scene_graph()
+    if self._scene_graph is not None:
+      return self._scene_graph
+
+    graph = defaultdict(lambda: defaultdict(int))
+    coo = self.covisibility.tocoo()
+    image_ids = self.covisibility_image_ids
+    for image_id1, image_id2, count in zip(
+        image_ids[coo.row], image_ids[coo.col], coo.data):
+      graph[image_id1][image_id2] = int(count)
+    self._scene_graph = graph
+
+    return graph
+
+  # returns the k images sharing the most points with the given image as a
+  # list of (image_id, #shared points), sorted by decreasing #shared points
+  def get_nearest_views(self, image_id, k):
+    if self.covisibility is None:
+      self.build_scene_graph()
+
+    image_ids = self.covisibility_image_ids
+    image_idx = np.searchsorted(image_ids, image_id)
+    if image_idx == len(image_ids) or image_ids[image_idx] != image_id:
+      return []
+
+    row = self.covisibility.getrow(image_idx)
+    mask = row.indices != image_idx
+    neighbor_idxs, counts = row.indices[mask], row.data[mask]
+    if len(counts) > k:
+      top = np.argpartition(-counts, k - 1)[:k]
+      neighbor_idxs, counts = neighbor_idxs[top], counts[top]
+    order = np.argsort(-counts, kind='stable')
+
+    return [(image_ids[i], int(c))
+            for i, c in zip(neighbor_idxs[order], counts[order])]
+
+  # k nearest views of every image at once; returns
+  #   image_ids: (N,) the image id of each row
+  #   neighbor_ids: (N, k) the ids of the k images sharing the most points
+  #     with each image, padded with -1 for images with fewer neighbors
+  #   shared_counts: (N, k) the corresponding number of shared points
+  def get_all_nearest_views(self, k):
+    if self.covisibility is None:
+      self.build_scene_graph()
+
+    image_ids = self.covisibility_image_ids
+    num_images = len(image_ids)
+    coo = self.covisibility.tocoo()
+    mask = coo.row != coo.col
+    rows, cols, counts = coo.row[mask], coo.col[mask], coo.data[mask]
+
+    # sort by row, then by decreasing count, and keep the first k per row
+    order = np.lexsort((-counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    keep = rank < k
+
+    neighbor_ids = np.full((num_images, k), -1, dtype=np.int64)
+    shared_counts = np.zeros((num_images, k), dtype=np.int64)
+    neighbor_ids[rows[keep], rank[keep]] = image_ids[cols[keep]]
+    shared_counts[rows[keep], rank[keep]] = counts[keep]
+
+    return image_ids, neighbor_ids, shared_counts
@@ -23,7 +23,6 @@ from absl import logging
 from flax import jax_utils
 from flax import optim
 from flax.metrics import tensorboard
-from flax.training import checkpoints
 import gin
 import jax
 from jax import numpy as jnp
@@ -36,6 +35,7 @@ from nerfies import datasets
 from nerfies import gpath
 from nerfies import model_utils
 from nerfies import models
+from nerfies import occupancy
 from nerfies import schedules
 from nerfies import training
 from nerfies import utils
@@ -64,6 +64,8 @@ def _log_to_tensorboard(writer: tensorboard.SummaryWriter,
   writer.scalar('params/learning_rate', scalar_params.learning_rate, step)
   writer.scalar('params/warp_alpha', state.warp_alpha, step)
   writer.scalar('params/time_alpha', state.time_alpha, step)
+  if state.nerf_alpha is not None:
+    writer.scalar('params/nerf_alpha', state.nerf_alpha, step)
   writer.scalar('params/elastic_loss/weight',
                 scalar_params.elastic_loss_weight, step)
 
@@ -76,6 +78,10 @@ def _log_to_tensorboard(writer: tensorboard.SummaryWriter,
 
   if 'background_loss' in stats:
     writer.scalar('loss/background', stats['background_loss'], step)
+  if 'proposal_loss' in stats:
+    writer.scalar('loss/proposal', stats['proposal_loss'], step)
+  if 'loss_scale' in stats:
+    writer.scalar('params/loss_scale', stats['loss_scale'], step)
 
   for k, v in time_dict.items():
     writer.scalar(f'time/{k}', v, step)
@@ -171,16 +177,59 @@ def main(argv):
       use_warp_id=model_config.use_warp,
       use_time=model_config.warp_metadata_encoder_type == 'time',
       random_seed=exp_config.random_seed,
+      device_rays=train_config.use_device_rays,
       **exp_config.datasource_kwargs)
-  train_iter = datasource.create_iterator(
-      datasource.train_ids,
-      flatten=True,
-      shuffle=True,
-      batch_size=train_config.batch_size,
-      prefetch_size=3,
-      shuffle_buffer_size=train_config.shuffle_buffer_size,
-      devices=devices,
-  )
+  train_cameras = None
+  if train_config.use_device_rays:
+    train_cameras = datasource.load_jax_cameras(datasource.train_ids)
+  ray_sampler = None
+  if train_config.use_importance_sampling and not train_config.use_ray_sampler:
+    raise ValueError('Importance sampling requires use_ray_sampler=True.')
+  if train_config.use_device_rays and not train_config.use_ray_sampler:
+    raise ValueError('Device rays require use_ray_sampler=True.')
+  if train_config.use_streaming_sampler and (
+      not train_config.use_ray_sampler
+      or train_config.use_importance_sampling):
+    raise ValueError('The streaming sampler requires use_ray_sampler=True and '
+                     'use_importance_sampling=False.')
+  if train_config.use_importance_sampling:
+    ray_sampler = datasource.create_ray_sampler(
+        datasource.train_ids,
+        batch_size=train_config.batch_size,
+        devices=devices,
+        use_importance_sampling=True,
+        uniform_fraction=train_config.importance_uniform_fraction,
+        error_decay=train_config.importance_error_decay,
+    )
+    train_iter = datasets.iterator_from_sampler(
+        ray_sampler, prefetch_size=3, devices=devices)
+  elif train_config.use_streaming_sampler:
+    streaming_sampler = datasource.create_streaming_sampler(
+        datasource.train_ids,
+        batch_size=train_config.batch_size,
+        devices=devices,
+        reservoir_size=train_config.streaming_reservoir_size,
+        num_workers=train_config.streaming_num_workers,
+    )
+    train_iter = datasets.iterator_from_sampler(
+        streaming_sampler, prefetch_size=3, devices=devices)
+  elif train_config.use_ray_sampler:
+    train_iter = datasource.create_sampler_iterator(
+        datasource.train_ids,
+        batch_size=train_config.batch_size,
+        prefetch_size=3,
+        devices=devices,
+    )
+  else:
+    train_iter = datasource.create_iterator(
+        datasource.train_ids,
+        flatten=True,
+        shuffle=True,
+        batch_size=train_config.batch_size,
+        prefetch_size=3,
+        shuffle_buffer_size=train_config.shuffle_buffer_size,
+        devices=devices,
+    )
 
   points_iter = None
   if train_config.use_background_loss:
@@ -199,6 +248,9 @@ def main(argv):
   learning_rate_sched = schedules.from_config(train_config.lr_schedule)
   warp_alpha_sched = schedules.from_config(train_config.warp_alpha_schedule)
   time_alpha_sched = schedules.from_config(train_config.time_alpha_schedule)
+  nerf_alpha_sched = None
+  if train_config.nerf_alpha_schedule is not None:
+    nerf_alpha_sched = schedules.from_config(train_config.nerf_alpha_schedule)
   elastic_loss_weight_sched = schedules.from_config(
       train_config.elastic_loss_weight_schedule)
 
@@ -216,20 +268,41 @@ def main(argv):
       use_warp_jacobian=train_config.use_elastic_loss,
       use_weights=train_config.use_elastic_loss)
 
+  occupancy_grid = None
+  if model_config.use_occupancy_grid:
+    if train_config.occupancy_init_from_points:
+      occupancy_grid = occupancy.grid_from_points(
+          datasource.load_points(),
+          resolution=model_config.occupancy_grid_resolution,
+          bound=model.occupancy_bound,
+          dilation=model_config.occupancy_dilation)
+    else:
+      occupancy_grid = occupancy.create_grid(
+          model_config.occupancy_grid_resolution)
+    logging.info('Initialized occupancy grid: occupied=%.04f',
+                 occupancy.occupancy_fraction(occupancy_grid))
+
   optimizer_def = optim.Adam(learning_rate_sched(0))
   optimizer = optimizer_def.create(params)
   state = model_utils.TrainState(
       optimizer=optimizer,
       warp_alpha=warp_alpha_sched(0),
-      time_alpha=time_alpha_sched(0))
+      time_alpha=time_alpha_sched(0),
+      occupancy_grid=occupancy_grid,
+      nerf_alpha=nerf_alpha_sched(0) if nerf_alpha_sched else None)
+  if train_config.loss_scale is not None:
+    state = state.replace(
+        loss_scale=jnp.array(train_config.loss_scale, jnp.float32),
+        loss_scale_steps=jnp.array(0, jnp.int32))
   scalar_params = training.ScalarParams(
       learning_rate=learning_rate_sched(0),
       elastic_loss_weight=elastic_loss_weight_sched(0),
       warp_reg_loss_weight=train_config.warp_reg_loss_weight,
       warp_reg_loss_alpha=train_config.warp_reg_loss_alpha,
       warp_reg_loss_scale=train_config.warp_reg_loss_scale,
-      background_loss_weight=train_config.background_loss_weight)
-  state = checkpoints.restore_checkpoint(checkpoint_dir, state)
+      background_loss_weight=train_config.background_loss_weight,
+      proposal_loss_weight=train_config.proposal_loss_weight)
+  state = model_utils.restore_checkpoint(checkpoint_dir, state)
   init_step = state.optimizer.state.step + 1
   state = jax_utils.replicate(state, devices=devices)
   del params
@@ -247,9 +320,13 @@ def main(argv):
       model,
       elastic_reduce_method=train_config.elastic_reduce_method,
       elastic_loss_type=train_config.elastic_loss_type,
+      elastic_topk=train_config.elastic_topk,
       use_elastic_loss=train_config.use_elastic_loss,
       use_background_loss=train_config.use_background_loss,
       use_warp_reg_loss=train_config.use_warp_reg_loss,
+      return_ray_errors=train_config.use_importance_sampling,
+      loss_scale_growth_interval=train_config.loss_scale_growth_interval,
+      cameras=train_cameras,
   )
   ptrain_step = jax.pmap(
       train_step,
@@ -261,6 +338,12 @@ def main(argv):
       donate_argnums=(2,),  # Donate the 'batch' argument.
   )
 
+  template_density_fn = jax.jit(
+      lambda params, points: model.apply(
+          {'params': params}, points,
+          method=models.NerfModel.query_template_density))
+  occupancy_rng = np.random.RandomState(exp_config.random_seed)
+
   if devices:
     n_local_devices = len(devices)
   else:
@@ -269,6 +352,9 @@ def main(argv):
   logging.info('Starting training')
   rng = rng + jax.process_index()  # Make random seed separate across hosts.
   keys = random.split(rng, n_local_devices)
+  checkpointer = None
+  if train_config.async_checkpointing:
+    checkpointer = training.AsyncCheckpointer(checkpoint_dir, keep=2)
   time_tracker = utils.TimeTracker()
   time_tracker.tic('data', 'total')
   for step, batch in zip(range(init_step, train_config.max_steps + 1),
@@ -283,25 +369,59 @@ def main(argv):
     warp_alpha = jax_utils.replicate(warp_alpha_sched(step), devices)
     time_alpha = jax_utils.replicate(time_alpha_sched(step), devices)
     state = state.replace(warp_alpha=warp_alpha, time_alpha=time_alpha)
+    if nerf_alpha_sched is not None:
+      state = state.replace(
+          nerf_alpha=jax_utils.replicate(nerf_alpha_sched(step), devices))
+
+    if (model_config.use_occupancy_grid
+        and (step == init_step
+             or step % train_config.occupancy_update_every == 0)):
+      with time_tracker.record_time('occupancy'):
+        model_params = jax_utils.unreplicate(state.optimizer.target['model'])
+        density_grid = occupancy.grid_from_density(
+            functools.partial(template_density_fn, model_params),
+            resolution=model_config.occupancy_grid_resolution,
+            bound=model.occupancy_bound,
+            threshold=model_config.occupancy_density_threshold,
+            rng=occupancy_rng,
+            dilation=model_config.occupancy_dilation)
+        if step == init_step:
+          # The template may not be trained yet, so the first refresh only
+          # adds to the initial (seeded or restored) grid.
+          density_grid |= np.asarray(
+              jax_utils.unreplicate(state.occupancy_grid))
+        occupancy_grid = density_grid
+        state = state.replace(
+            occupancy_grid=jax_utils.replicate(occupancy_grid, devices))
+      if jax.process_index() == 0:
+        logging.info('Updated occupancy grid: occupied=%.04f',
+                     occupancy.occupancy_fraction(occupancy_grid))
 
     with time_tracker.record_time('train_step'):
       state, stats, keys = ptrain_step(keys, state, batch, scalar_params)
       time_tracker.toc('total')
 
+    if ray_sampler is not None:
+      ray_errors = stats.pop('ray_errors')
+      if step % train_config.importance_update_every == 0:
+        ray_errors = jax.device_get(ray_errors)
+        ray_sampler.update(ray_errors['item_index'], ray_errors['error'])
+
     if step % train_config.print_every == 0 and jax.process_index() == 0:
       logging.info('step=%d, warp_alpha=%.04f, time_alpha=%.04f, %s', step,
                    warp_alpha_sched(step), time_alpha_sched(step),
                    time_tracker.summary_str('last'))
-      coarse_metrics_str = ', '.join(
-          [f'{k}={v.mean():.04f}' for k, v in stats['coarse'].items()])
-      fine_metrics_str = ', '.join(
-          [f'{k}={v.mean():.04f}' for k, v in stats['fine'].items()])
-      logging.info('\tcoarse metrics: %s', coarse_metrics_str)
-      if 'fine' in stats:
-        logging.info('\tfine metrics: %s', fine_metrics_str)
+      for level in ('coarse', 'fine'):
+        if level in stats:
+          metrics_str = ', '.join(
+              [f'{k}={v.mean():.04f}' for k, v in stats[level].items()])
+          logging.info('\t%s metrics: %s', level, metrics_str)
 
     if step % train_config.save_every == 0 and jax.process_index() == 0:
-      training.save_checkpoint(checkpoint_dir, state)
+      if checkpointer is not None:
+        checkpointer.save(state)
+      else:
+        training.save_checkpoint(checkpoint_dir, state)
 
     if step % train_config.log_every == 0 and jax.process_index() == 0:
       # Only log via host 0.
@@ -318,6 +438,8 @@ def main(argv):
 
     time_tracker.tic('data', 'total')
 
+  if checkpointer is not None:
+    checkpointer.wait()
   if train_config.max_steps % train_config.save_every != 0:
     training.save_checkpoint(checkpoint_dir, state)
 